@@ -0,0 +1,276 @@
+# coding:utf-8
+import json
+import time
+import asyncio
+import aiohttp
+from datetime import timedelta
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+from allure import attach, attachment_type
+from ..util import logging, step, StepMode
+from .requests import HTTPDriver, Resp, LatencyStats, UploadStream
+
+
+class AsyncResponse:
+    """
+    已读取完毕的 aiohttp 响应，属性与 requests.Response 保持一致，供 Assertion/Extraction 使用
+    """
+    def __init__(self, response, content, elapsed):
+        self.raw = response
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.history = response.history
+        self.cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+        self.encoding = response.get_encoding()
+        self.content = content
+        self.elapsed = elapsed
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+
+class AsyncHTTPDriver(HTTPDriver):
+    """
+    异步接口 Driver 类, 支持流式调用
+
+    初始化和断言的用法与 HTTPDriver 相同，发送请求的方法需要 await，
+    同一个 Driver 可以用 asyncio.gather 并发发送多个请求，每个请求返回独立的 Resp；
+    allure 步骤不能跨越 await，请求完成后才记录该请求的步骤，因此并发的请求不会互相嵌套
+
+    Resp.metrics 与 HTTPDriver 相同，但 aiohttp 无法单独统计 TLS 握手，connect 包括握手时间，tls 总是 0
+
+    不支持流式读取、录制/回放、重试策略和流式上传，设置了这些初始化参数时发送请求会抛出 NotImplementedError
+    """
+    def __init__(self, *args, limit=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limit = limit
+        self.client: aiohttp.ClientSession = None
+        # 已导入 aiohttp cookie_jar 的 requests Cookies，Arrangement.cookies 替换后重新导入
+        self._cookie_source = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        关闭连接池
+        """
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def _client(self):
+        # ClientSession 必须在事件循环中创建，因此延迟到第一次发送请求时
+        if self.client is None or self.client.closed:
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                # 测试环境常用 IP 访问，允许 IP 地址的 Cookies
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                trace_configs=[self._trace_config()]
+            )
+            self._cookie_source = None
+        if self._cookie_source is not self.session.cookies:
+            self._load_cookies(self.client.cookie_jar)
+        return self.client
+
+    @staticmethod
+    def _trace_config():
+        """
+        把建立连接和收到响应头的时间点记录到请求的 trace_request_ctx（dict）中
+        """
+        async def on_connection_create_start(session, context, params):
+            context.trace_request_ctx['connect_start'] = time.perf_counter()
+
+        async def on_connection_create_end(session, context, params):
+            timing = context.trace_request_ctx
+            timing['connect'] = time.perf_counter() - timing['connect_start']
+
+        async def on_request_end(session, context, params):
+            context.trace_request_ctx['headers'] = time.perf_counter()
+
+        config = aiohttp.TraceConfig()
+        config.on_connection_create_start.append(on_connection_create_start)
+        config.on_connection_create_end.append(on_connection_create_end)
+        config.on_request_end.append(on_request_end)
+        return config
+
+    def _load_cookies(self, jar):
+        """
+        把 self.session.cookies 导入 aiohttp 的 cookie_jar，保留 domain 和 path
+        """
+        jar.clear()
+        for cookie in self.session.cookies:
+            morsel = SimpleCookie()
+            morsel[cookie.name] = cookie.value
+            if cookie.domain:
+                morsel[cookie.name]['domain'] = cookie.domain
+            morsel[cookie.name]['path'] = cookie.path or '/'
+            jar.update_cookies(morsel)
+        self._cookie_source = self.session.cookies
+
+    def _save_cookies(self, response):
+        # 同步到 self.session.cookies，供 Extraction 和之后创建的 HTTPDriver 使用
+        host = urlsplit(response.url).hostname
+        for name, morsel in response.raw.cookies.items():
+            self.session.cookies.set(name, morsel.value, domain=morsel['domain'] or host,
+                                     path=morsel['path'] or '/')
+
+    def _check_supported(self, kwargs):
+        if self.cassette is not None:
+            raise NotImplementedError('AsyncHTTPDriver 不支持录制/回放，请使用 HTTPDriver')
+        if self.retry is not None:
+            raise NotImplementedError('AsyncHTTPDriver 不支持重试策略，请使用 HTTPDriver')
+        if kwargs.get('stream'):
+            raise NotImplementedError('AsyncHTTPDriver 不支持流式读取响应，请使用 HTTPDriver')
+        if isinstance(kwargs.get('data'), UploadStream):
+            raise NotImplementedError('AsyncHTTPDriver 不支持流式上传，请使用 HTTPDriver')
+
+    def _convert(self, url, kwargs):
+        """
+        将 requests 风格的参数转换为 aiohttp 的参数
+        """
+        for name in ('params', 'data', 'json', 'headers', 'files'):
+            if kwargs.get(name) in (None, '', {}):
+                kwargs.pop(name, None)
+        timeout = kwargs.pop('timeout', None)
+        if isinstance(timeout, tuple):
+            kwargs['timeout'] = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        elif timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        proxies = kwargs.pop('proxies', None) or {}
+        proxy = proxies.get(urlsplit(url).scheme)
+        if proxy:
+            kwargs['proxy'] = proxy
+        if kwargs.pop('verify', True) is False:
+            kwargs['ssl'] = False
+        files = kwargs.pop('files', None)
+        if files:
+            form = aiohttp.FormData(kwargs.pop('data', None) or {})
+            for name, value in files.items():
+                if isinstance(value, tuple):
+                    form.add_field(name, value[1], filename=value[0],
+                                   content_type=value[2] if len(value) > 2 else None)
+                else:
+                    form.add_field(name, value)
+            kwargs['data'] = form
+        if not kwargs.get('cookies'):
+            kwargs.pop('cookies', None)
+        kwargs.pop('stream', None)
+        return kwargs
+
+    async def _send(self, method, url='', **kwargs):
+        """
+        发送请求并返回独立的 Resp，不修改 self.resp
+        """
+        endpoint = self._endpoint(method, url)
+        url, kwargs = self._prepare(method, url, **kwargs)
+        self._check_supported(kwargs)
+        kwargs = self._convert(url, kwargs)
+        timing = dict()
+        start = time.perf_counter()
+        try:
+            async with self._client().request(method.upper(), url, trace_request_ctx=timing, **kwargs) as response:
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            LatencyStats.record(endpoint, time.perf_counter() - start)
+            raise
+        total = time.perf_counter() - start
+        ttfb = timing.get('headers', start + total) - start
+        # 与 requests 一致，elapsed 为收到响应头的时间
+        response = AsyncResponse(response, content, timedelta(seconds=ttfb))
+        self._save_cookies(response)
+        resp = Resp(response, self)
+        resp.metrics.update(connect=timing.get('connect', 0.0), tls=0.0, ttfb=ttfb,
+                            download=max(total - ttfb, 0.0), total=total)
+        LatencyStats.record(endpoint, total, response.status_code)
+        return resp
+
+    async def _request(self, method, url='', **kwargs):
+        # 步骤不能跨越 await，否则并发的请求会嵌套在彼此的步骤中
+        try:
+            resp = await self._send(method, url, **kwargs)
+        except Exception:
+            with step(method):
+                raise
+        with step(method):
+            if StepMode.enabled and not StepMode.lean:
+                attach(json.dumps(resp.metrics, indent=2), name='耗时（秒）', attachment_type=attachment_type.JSON)
+        self.resp = resp
+        return resp
+
+    def _step_send(self, method, url='', **kwargs):
+        raise NotImplementedError('AsyncHTTPDriver 的请求方法需要 await')
+
+    async def send(self, *args, **kwargs):
+        """
+        按 Arrangement.method 设置的请求方法发送请求
+        """
+        assert self.method in ('get', 'post', 'head', 'options', 'put', 'delete')
+        return await self._request(self.method, *args, **kwargs)
+
+    async def send_many(self, specs, max_workers=10):
+        """
+        并发发送一批请求，同时进行的请求不超过 max_workers 个，按顺序返回各自独立的 Resp，不修改 self.resp
+
+        :param specs: 请求描述的列表，与 HTTPDriver.send_many 相同
+        """
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def send(spec):
+            spec = dict(spec)
+            async with semaphore:
+                return await self._send(spec.pop('method', 'get').lower(), spec.pop('url', ''), **spec)
+
+        try:
+            resps = await asyncio.gather(*(send(spec) for spec in specs))
+        except Exception:
+            with step('send_many'):
+                raise
+        with step('send_many'):
+            logging.info('Sent {} requests with {} workers.'.format(len(resps), max_workers))
+        return list(resps)
+
+    async def get(self, url='', **kwargs):
+        """
+        发送 get 请求
+        """
+        return await self._request('get', url, **kwargs)
+
+    async def head(self, url='', **kwargs):
+        """
+        发送 head 请求
+        """
+        return await self._request('head', url, **kwargs)
+
+    async def options(self, url='', **kwargs):
+        """
+        发送 options 请求
+        """
+        return await self._request('options', url, **kwargs)
+
+    async def post(self, url='', **kwargs):
+        """
+        发送 post 请求
+        """
+        return await self._request('post', url, **kwargs)
+
+    async def put(self, url='', **kwargs):
+        """
+        发送 put 请求
+        """
+        return await self._request('put', url, **kwargs)
+
+    async def delete(self, url='', **kwargs):
+        """
+        发送 delete 请求
+        """
+        return await self._request('delete', url, **kwargs)
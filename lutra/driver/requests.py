@@ -1,9 +1,39 @@
 # coding:utf-8
+import os
+import dbm
+import mmap
+import uuid
+import json
+import base64
+import socket
+import time
+import math
+import codecs
+import hashlib
+import random
+import threading
+import yaml
 import requests
-from urllib.parse import urljoin
-from ..util import logging, json_parser
+import jsonschema
+from datetime import timedelta, datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit, parse_qsl, urlencode
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from ..util import logging, json_parser, json_loads, step, StepMode, brief
 from functools import wraps
-from allure import step
+from allure import attach, attachment_type
+
+# 各请求方法缺省携带的驱动参数
+METHOD_ARGS = {
+    'get': ('headers', 'params'),
+    'head': ('headers', 'params'),
+    'options': ('headers', 'params'),
+    'post': ('headers', 'data', 'params'),
+    'put': ('headers', 'data', 'json', 'files'),
+    'delete': ('headers', 'data', 'json', 'files'),
+}
 
 
 def fail_to_log(func):
@@ -12,18 +42,657 @@ def fail_to_log(func):
         try:
             return func(self, *args, **kwargs)
         except Exception as e:
-            logging.error(self.response.text)
+            # 流式响应的内容可能已被读取或很大，不再记录
+            if not self.resp.stream:
+                logging.error('%s', brief(self.response.text))
             raise e
 
     return wrapper
 
 
+def iter_json_records(chunks, format=None):
+    """
+    从文本块中逐条解析记录，支持 JSON 数组（array）和每行一个 JSON（ndjson），缺省时按首个字符判断
+
+    只缓存尚未解析完的一条记录，内存占用与响应体大小无关
+    """
+    chunks = iter(chunks)
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        if buffer.strip():
+            break
+    if format is None:
+        format = 'array' if buffer.lstrip().startswith('[') else 'ndjson'
+    if format == 'ndjson':
+        while True:
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                if line.strip():
+                    yield json_loads(line)
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            buffer += chunk
+        if buffer.strip():
+            yield json_loads(buffer)
+        return
+    decoder = json.JSONDecoder()
+    buffer = buffer.lstrip()[1:]
+    final = False
+    while True:
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if final:
+                    raise
+                break
+            # 数字可能被截断在块的末尾（如 3. 或 1e），后面是分隔符时才是完整的值，否则等下一个块
+            if not final and (end == len(buffer) or buffer[end] not in ' \t\r\n,]'):
+                break
+            yield record
+            pos = end
+        buffer = buffer[pos:]
+        if final:
+            return
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            buffer += chunk
+
+
+# 当前线程最近一次建立连接的耗时，连接复用时为空
+_conn_timing = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        conn = super()._new_conn()
+        _conn_timing.connect = time.perf_counter() - start
+        return conn
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        conn = super()._new_conn()
+        _conn_timing.connect = time.perf_counter() - start
+        return conn
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        # connect 包含 TCP 连接和 TLS 握手，减去 TCP 连接的耗时即为 TLS 握手耗时
+        _conn_timing.tls = max(time.perf_counter() - start - getattr(_conn_timing, 'connect', 0.0), 0.0)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+TIMED_POOL_CLASSES = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    """
+    开启 TCP keep-alive 的 HTTPAdapter，避免池中空闲连接被中间设备静默断开
+    """
+    def __init__(self, keep_alive=True, shared=False, **kwargs):
+        self.socket_options = HTTPConnection.default_socket_options + (
+            [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] if keep_alive else []
+        )
+        # PoolRegistry 共享的连接池不随某个 Session.close() 关闭，由 PoolRegistry.close_all() 关闭
+        self.shared = shared
+        super().__init__(**kwargs)
+
+    def close(self):
+        if not self.shared:
+            super().close()
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = TIMED_POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        manager = super().proxy_manager_for(proxy, **kwargs)
+        manager.pool_classes_by_scheme = TIMED_POOL_CLASSES
+        return manager
+
+
+class PoolRegistry:
+    """
+    进程级连接池注册表，按 (scheme, host, proxy) 在所有 HTTPDriver 之间共享连接池
+
+    各 Driver 仍然使用自己的 Session 和 Cookies，只借用连接，同一地址的 TCP/TLS 握手只需要做一次
+    """
+    pool_connections = 10
+    pool_maxsize = 10
+    max_retries = 0
+    keep_alive = True
+    _adapters = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, pool_connections=None, pool_maxsize=None, max_retries=None, keep_alive=None):
+        """
+        修改连接池配置，对之后新建的连接池生效
+        """
+        if pool_connections is not None:
+            cls.pool_connections = pool_connections
+        if pool_maxsize is not None:
+            cls.pool_maxsize = pool_maxsize
+        if max_retries is not None:
+            cls.max_retries = max_retries
+        if keep_alive is not None:
+            cls.keep_alive = keep_alive
+
+    @classmethod
+    def adapter(cls, scheme, host, proxy=None, pool_maxsize=None):
+        """
+        获取共享的连接池，已有连接池容量不足 pool_maxsize 时替换为更大的连接池
+        """
+        key = scheme, host, proxy
+        pool_maxsize = max(pool_maxsize or 0, cls.pool_maxsize)
+        with cls._lock:
+            adapter = cls._adapters.get(key)
+            if adapter is None or adapter._pool_maxsize < pool_maxsize:
+                adapter = cls._adapters[key] = KeepAliveAdapter(
+                    keep_alive=cls.keep_alive,
+                    shared=True,
+                    pool_connections=cls.pool_connections,
+                    pool_maxsize=pool_maxsize,
+                    max_retries=cls.max_retries
+                )
+        return adapter
+
+    @classmethod
+    def mount(cls, session, url, proxies=None, pool_maxsize=None):
+        """
+        为 session 挂载 url 所在地址的共享连接池
+        """
+        parts = urlsplit(url)
+        if not parts.scheme or not parts.netloc:
+            return
+        prefix = '{}://{}/'.format(parts.scheme, parts.netloc)
+        if prefix in session.adapters and pool_maxsize is None:
+            return
+        proxy = (proxies or {}).get(parts.scheme)
+        adapter = cls.adapter(parts.scheme, parts.netloc, proxy, pool_maxsize)
+        if session.adapters.get(prefix) is not adapter:
+            session.mount(prefix, adapter)
+
+    @classmethod
+    def close_all(cls):
+        """
+        关闭并清空所有共享连接池；各 Session.close() 不会关闭共享的连接池
+        """
+        with cls._lock:
+            for adapter in cls._adapters.values():
+                requests.adapters.HTTPAdapter.close(adapter)
+            cls._adapters.clear()
+
+    clear = close_all
+
+
+class RetryPolicy:
+    """
+    传输层重试策略，用于 502/503/504、连接被重置等偶发错误，避免整个用例失败重跑
+
+    - methods: 视为幂等、允许重试的请求方法；带 Idempotency-Key 请求头的请求也会重试
+    - 第 n 次重试前等待 min(backoff * 2 ** (n - 1), max_backoff) 秒，jitter 时在 0 到该值之间随机取值；
+      响应带 Retry-After 时按其等待（不超过 max_backoff）
+    - budget: 同一个 Driver（Session）所有请求合计最多重试的次数，缺省不限制
+    """
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'))
+    RETRY_STATUSES = frozenset((502, 503, 504))
+
+    def __init__(self, total=3, backoff=0.5, max_backoff=30, jitter=True, statuses=None, methods=None,
+                 respect_retry_after=True, budget=None):
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses) if statuses is not None else self.RETRY_STATUSES
+        self.methods = frozenset(m.upper() for m in methods) if methods is not None else self.IDEMPOTENT_METHODS
+        self.respect_retry_after = respect_retry_after
+        self.budget = budget
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def allows(self, method, headers=None):
+        """
+        该请求是否可以重试
+        """
+        return method.upper() in self.methods or 'Idempotency-Key' in (headers or {})
+
+    def _take_budget(self):
+        with self._lock:
+            if self.budget is not None and self.used >= self.budget:
+                return False
+            self.used += 1
+            return True
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, response=None):
+        """
+        第 attempt 次重试前等待的秒数
+        """
+        if self.respect_retry_after:
+            retry_after = self._retry_after(response)
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def send(self, send, upload=None):
+        """
+        调用 send 发送请求，按策略重试，返回最后一次的响应和重试次数；每次重试记录为一个步骤
+        """
+        attempt = 0
+        while True:
+            if upload is not None and attempt:
+                upload.rewind()
+            response = error = None
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if error is None and response.status_code not in self.statuses:
+                return response, attempt
+            if attempt >= self.total or not self._take_budget():
+                if error is not None:
+                    raise error
+                return response, attempt
+            attempt += 1
+            reason = '{}: {}'.format(type(error).__name__, error) if error is not None else \
+                'HTTP {}'.format(response.status_code)
+            delay = self.delay(attempt, response)
+            if response is not None:
+                response.close()
+            logging.warning('Retrying (%s/%s) in %.2fs after %s', attempt, self.total, delay, brief(reason))
+            with step('第 {} 次重试：{}'.format(attempt, reason[:200])):
+                time.sleep(delay)
+
+
+class Cassette:
+    """
+    请求录制/回放文件，每行一个 JSON，记录一次请求和响应
+
+    同名的 .idx 文件（dbm）保存「请求指纹 -> 行偏移量」索引，回放时只按偏移量读取命中的行，
+    打开文件的耗时与录制文件的大小无关
+
+    - sensitive_headers: 录制时只保留名字、不保存值的请求头和响应头，缺省为 Cookie、Authorization、Set-Cookie；
+      请求指纹不包括请求头，这些请求头的值不影响回放时的匹配
+    """
+    SENSITIVE_HEADERS = frozenset(('Cookie', 'Authorization', 'Set-Cookie'))
+    REDACTED = '[REDACTED]'
+
+    def __init__(self, path, mode='replay', sensitive_headers=None):
+        assert mode in ('record', 'replay')
+        self.path = path
+        self.mode = mode
+        self.sensitive_headers = frozenset(name.lower() for name in (
+            sensitive_headers if sensitive_headers is not None else self.SENSITIVE_HEADERS
+        ))
+        self.index_path = path + '.idx'
+        self._lock = threading.Lock()
+        # 同一个请求录制了多次时，按顺序回放，用完后一直回放最后一次
+        self._replayed = {}
+        if mode == 'record':
+            self.file = open(path, 'ab')
+            self.index = dbm.open(self.index_path, 'c')
+        else:
+            if dbm.whichdb(self.index_path) is None:
+                self._build_index()
+            self.file = open(path, 'rb')
+            self.index = dbm.open(self.index_path, 'r')
+
+    def _build_index(self):
+        # 索引丢失时（例如只拷贝了录制文件），扫描一遍录制文件重建索引
+        logging.info('Building cassette index: {}'.format(self.index_path))
+        with open(self.path, 'rb') as f, dbm.open(self.index_path, 'n') as index:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    key = json.loads(line)['key']
+                    index[key] = index.get(key, b'') + b'%d:%d ' % (offset, len(line))
+                offset += len(line)
+
+    @staticmethod
+    def fingerprint(method, url, body):
+        """
+        请求指纹，由请求方法、带查询参数的 URL 和请求体决定
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, bytes):
+            body = b''
+        return hashlib.sha1(b'%s %s\n%s' % (method.upper().encode(), url.encode('utf-8'), body)).hexdigest()
+
+    @staticmethod
+    def _dump_body(body):
+        if body is None:
+            return None, None
+        if isinstance(body, str):
+            return body, None
+        if not isinstance(body, bytes):
+            return None, None
+        try:
+            return body.decode('utf-8'), None
+        except UnicodeDecodeError:
+            return None, base64.b64encode(body).decode('ascii')
+
+    def _redact(self, headers):
+        return {name: self.REDACTED if name.lower() in self.sensitive_headers else value
+                for name, value in headers.items()}
+
+    def record(self, response):
+        """
+        追加一条录制记录
+        """
+        request = (response.history[0] if response.history else response).request
+        key = self.fingerprint(request.method, request.url, request.body)
+        body, body_base64 = self._dump_body(request.body)
+        text, content_base64 = self._dump_body(response.content)
+        entry = {
+            'key': key,
+            'method': request.method,
+            'url': request.url,
+            'params': dict(parse_qsl(urlsplit(request.url).query)),
+            'body': body,
+            'body_base64': body_base64,
+            'headers': self._redact(request.headers),
+            'status': response.status_code,
+            'reason': response.reason,
+            'response_url': response.url,
+            'response_headers': self._redact(response.headers),
+            'encoding': response.encoding,
+            'text': text,
+            'content_base64': content_base64,
+            'elapsed': response.elapsed.total_seconds(),
+        }
+        line = json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n'
+        with self._lock:
+            offset = self.file.tell()
+            self.file.write(line)
+            self.file.flush()
+            self.index[key] = self.index.get(key, b'') + b'%d:%d ' % (offset, len(line))
+
+    def replay(self, session, method, url, kwargs):
+        """
+        按请求指纹查找录制记录，构造 requests.Response，不访问网络
+        """
+        request = session.prepare_request(requests.Request(
+            method=method.upper(),
+            url=url,
+            headers=kwargs.get('headers'),
+            files=kwargs.get('files'),
+            data=kwargs.get('data') or {},
+            json=kwargs.get('json'),
+            params=kwargs.get('params') or {},
+            cookies=kwargs.get('cookies'),
+        ))
+        key = self.fingerprint(request.method, request.url, request.body)
+        with self._lock:
+            offsets = self.index.get(key, b'').split()
+            if not offsets:
+                raise Exception('录制文件中没有匹配的请求：{} {}'.format(request.method, request.url))
+            n = self._replayed.get(key, 0)
+            self._replayed[key] = n + 1
+            offset, length = map(int, offsets[min(n, len(offsets) - 1)].split(b':'))
+            self.file.seek(offset)
+            entry = json.loads(self.file.read(length))
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.url = entry['response_url']
+        response.headers = requests.structures.CaseInsensitiveDict(entry['response_headers'])
+        response.encoding = entry['encoding']
+        if entry['content_base64'] is not None:
+            response._content = base64.b64decode(entry['content_base64'])
+        else:
+            response._content = (entry['text'] or '').encode('utf-8')
+        response.elapsed = timedelta(seconds=entry['elapsed'])
+        response.request = request
+        return response
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+            self.index.close()
+
+
+class UploadStream:
+    """
+    流式上传的请求体，文件按块从内存映射中读取，内存占用与文件大小无关
+
+    chunked=True 时不发送 Content-Length，使用分块传输编码
+    """
+    def __init__(self, segments, content_type, chunked=False, chunk_size=1024 * 1024):
+        # 每段是 bytes 或文件路径
+        self.segments = segments
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.total = sum(len(seg) if isinstance(seg, bytes) else os.path.getsize(seg) for seg in segments)
+        # requests 通过 len 决定 Content-Length，为 0 时使用分块传输编码
+        self.len = 0 if chunked else self.total
+        self._file = self._mmap = None
+        self.rewind()
+
+    @classmethod
+    def file(cls, path, content_type='application/octet-stream', chunked=False, chunk_size=1024 * 1024):
+        return cls([path], content_type, chunked, chunk_size)
+
+    @classmethod
+    def multipart(cls, files, fields=None, chunked=False, chunk_size=1024 * 1024):
+        """
+        :param files: {字段名: 文件路径} 或 {字段名: (文件路径, 文件名, Content-Type)}
+        :param fields: 普通表单字段
+        """
+        boundary = uuid.uuid4().hex
+        segments = []
+        for name, value in (fields or {}).items():
+            segments.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                boundary, name, value
+            ).encode('utf-8'))
+        for name, value in files.items():
+            path, filename, content_type = value if isinstance(value, tuple) else (
+                value, os.path.basename(value), 'application/octet-stream'
+            )
+            segments.append(
+                '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(
+                    boundary, name, filename, content_type
+                ).encode('utf-8')
+            )
+            segments.append(path)
+            segments.append(b'\r\n')
+        segments.append('--{}--\r\n'.format(boundary).encode('utf-8'))
+        return cls(segments, 'multipart/form-data; boundary=' + boundary, chunked, chunk_size)
+
+    def _close_file(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = self._mmap = None
+
+    def _map(self, path):
+        if self._file is None:
+            self._file = open(path, 'rb')
+            if os.fstat(self._file.fileno()).st_size:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(self._mmap, 'madvise'):
+                    self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+        return self._mmap
+
+    def rewind(self):
+        """
+        回到开头，每次发送前调用
+        """
+        self._close_file()
+        self._index = 0
+        self._offset = 0
+        self.sent = 0
+        self.started = self.finished = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        if self.started is None:
+            self.started = time.perf_counter()
+        while self._index < len(self.segments):
+            segment = self.segments[self._index]
+            if isinstance(segment, bytes):
+                data = segment[self._offset:self._offset + size]
+            else:
+                mapped = self._map(segment)
+                data = mapped[self._offset:self._offset + size] if mapped is not None else b''
+            if data:
+                self._offset += len(data)
+                self.sent += len(data)
+                return data
+            self._index += 1
+            self._offset = 0
+            self._close_file()
+        if self.finished is None:
+            self.finished = time.perf_counter()
+        return b''
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def metrics(self):
+        seconds = ((self.finished or time.perf_counter()) - self.started) if self.started else 0.0
+        return {
+            'upload_bytes': self.sent,
+            'upload_seconds': seconds,
+            'upload_throughput': self.sent / seconds if seconds else 0.0,
+        }
+
+
+class SchemaCache:
+    """
+    契约校验器缓存，按 (文件路径, 修改时间) 缓存编译好的校验器，每个 schema 文件在一次运行中只编译一次
+    """
+    _validators = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def validator(cls, path):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime
+        with cls._lock:
+            cached = cls._validators.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with open(path, encoding='utf-8') as f:
+            schema = json.load(f) if path.endswith('.json') else yaml.safe_load(f)
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        logging.info('Compiled schema: %s', path)
+        with cls._lock:
+            cls._validators[path] = mtime, validator
+        return validator
+
+
+class LatencyStats:
+    """
+    进程级的接口耗时统计，按「请求方法 + 未填充路径参数的 URL」汇总 p50/p95/p99
+
+    在 session 级别的 fixture 结束时调用 LatencyStats.dump(path) 输出统计文件，
+    使用 pytest-xdist 时每个 worker 各输出一个文件
+    """
+    # 关闭后不再保存样本，只通知 listeners（压测时样本量很大，由压测自己统计直方图）
+    keep_samples = True
+    # 每个请求完成后调用 listener(endpoint, seconds, status_code)
+    listeners = []
+    _samples = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def record(cls, endpoint, seconds, status_code=None):
+        if cls.keep_samples:
+            with cls._lock:
+                cls._samples.setdefault(endpoint, []).append(seconds)
+        for listener in cls.listeners:
+            listener(endpoint, seconds, status_code)
+
+    @staticmethod
+    def percentile(samples, p):
+        """
+        最近秩法：已排序样本中第 ceil(p% * n) 个值
+        """
+        return samples[min(len(samples) - 1, max(0, math.ceil(p / 100 * len(samples)) - 1))]
+
+    @classmethod
+    def summary(cls):
+        with cls._lock:
+            samples = {endpoint: sorted(values) for endpoint, values in cls._samples.items()}
+        return {
+            endpoint: {
+                'count': len(values),
+                'p50': cls.percentile(values, 50),
+                'p95': cls.percentile(values, 95),
+                'p99': cls.percentile(values, 99),
+                'max': values[-1],
+            } for endpoint, values in samples.items()
+        }
+
+    @classmethod
+    def dump(cls, path='latency_summary.json'):
+        worker = os.environ.get('PYTEST_XDIST_WORKER')
+        if worker:
+            root, ext = os.path.splitext(path)
+            path = '{}_{}{}'.format(root, worker, ext)
+        with open(path, 'w') as f:
+            json.dump(cls.summary(), f, indent=2, ensure_ascii=False)
+        return path
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._samples.clear()
+
+
 class HTTPDriver:
     """
     接口 Driver 类, 支持流式调用
     """
     def __init__(self, base_url=None, cookie_dict=None, cookie_list=None, timeout=None, method=None,
-                 params=None, data=None, path_params=None, headers=None, proxy=None):
+                 params=None, data=None, path_params=None, headers=None, proxy=None, cassette=None, retry=None):
         self.session = requests.Session()
         self.base_url = base_url
         self.params = params
@@ -36,6 +705,9 @@ class HTTPDriver:
         self.json = None
         self.files = None
         self.proxies = {"http": proxy, "https": proxy} if proxy else None
+        self.cassette: Cassette = cassette
+        self.stream = False
+        self.retry: RetryPolicy = retry
         # self.assert_mode = None
         # self.assert_value = None
         # self.assert_key = None
@@ -67,113 +739,169 @@ class HTTPDriver:
         self.resp = Resp(response, self)
         return self.resp
 
-    @step
-    def get(self, url='', **kwargs):
+    def _prepare(self, method, url='', **kwargs):
         """
-        发送 get 请求
+        拼接 URL，并补全该请求方法缺省携带的参数
         """
         if '://' not in url:
             url = urljoin(self.base_url, url)
-        if self.path_params:
-            url = url.format(**self.path_params)
-        kwargs['headers'] = kwargs.get('headers', self.headers)
-        kwargs['params'] = kwargs.get('params', self.params)
+        path_params = kwargs.pop('path_params', self.path_params)
+        if path_params:
+            url = url.format(**path_params)
+        for name in METHOD_ARGS[method]:
+            kwargs[name] = kwargs.get(name, getattr(self, name))
         kwargs['timeout'] = kwargs.get('timeout', self.timeout)
-        kwargs['proxies'] = kwargs.get('timeout', self.proxies)
-        response = self.session.get(url, **kwargs)
-        self.resp = Resp(response, self)
+        kwargs['proxies'] = kwargs.get('proxies', self.proxies)
+        kwargs['stream'] = kwargs.get('stream', self.stream)
+        return url, kwargs
+
+    def _endpoint(self, method, url):
+        if '://' not in url:
+            url = urljoin(self.base_url, url)
+        return '{} {}'.format(method.upper(), url.split('?', 1)[0])
+
+    def _send(self, method, url='', **kwargs):
+        """
+        发送请求并返回独立的 Resp，不修改 self.resp，可在多线程中调用
+        """
+        endpoint = self._endpoint(method, url)
+        url, kwargs = self._prepare(method, url, **kwargs)
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return Resp(self.cassette.replay(self.session, method, url, kwargs), self, kwargs['stream'])
+        PoolRegistry.mount(self.session, url, kwargs['proxies'])
+        upload = kwargs.get('data')
+        if isinstance(upload, UploadStream):
+            upload.rewind()
+        return self._measure(endpoint, kwargs['stream'], upload, lambda: self.session.request(method, url, **kwargs),
+                             self._retry_policy(method, kwargs.get('headers')))
+
+    def _retry_policy(self, method, headers=None):
+        if self.retry is not None and self.retry.allows(method, headers):
+            return self.retry
+        return None
+
+    def _measure(self, endpoint, stream, upload, send, retry=None):
+        """
+        调用 send 发送请求（按 retry 策略重试），记录最后一次尝试的各阶段耗时，并录制到 cassette；
+        重试时之前的尝试和退避等待合计为 retry_wait
+        """
+        start = attempt_start = time.perf_counter()
+
+        def attempt():
+            nonlocal attempt_start
+            _conn_timing.__dict__.clear()
+            attempt_start = time.perf_counter()
+            return send()
+
+        try:
+            if retry is None:
+                response, retries = attempt(), 0
+            else:
+                response, retries = retry.send(attempt, upload if isinstance(upload, UploadStream) else None)
+        except requests.RequestException:
+            # 连接失败、超时等没有响应的请求同样计入统计，status_code 为 None
+            LatencyStats.record(endpoint, time.perf_counter() - start)
+            raise
+        total = time.perf_counter() - attempt_start
+        if self.cassette is not None:
+            self.cassette.record(response)
+        resp = Resp(response, self, stream)
+        # 流式响应的 download 和 total 不含读取响应体的时间
+        ttfb = response.elapsed.total_seconds()
+        resp.metrics.update(
+            connect=getattr(_conn_timing, 'connect', 0.0),
+            tls=getattr(_conn_timing, 'tls', 0.0),
+            ttfb=ttfb,
+            download=max(total - ttfb, 0.0),
+            total=total
+        )
+        if retries:
+            resp.metrics['retries'] = retries
+            resp.metrics['retry_wait'] = attempt_start - start
+        if isinstance(upload, UploadStream):
+            resp.metrics.update(upload.metrics())
+        LatencyStats.record(endpoint, total, response.status_code)
+        return resp
+
+    def _step_send(self, method, url='', **kwargs):
+        # 在 get/post 等方法的 allure 步骤中发送请求，并把耗时附加到该步骤
+        self.resp = self._send(method, url, **kwargs)
+        if StepMode.enabled and not StepMode.lean:
+            attach(json.dumps(self.resp.metrics, indent=2), name='耗时（秒）',
+                   attachment_type=attachment_type.JSON)
         return self.resp
 
+    def _mount_pool(self, pool_maxsize, specs):
+        # 连接池小于并发数时，多出的线程会反复新建、丢弃连接
+        for spec in specs:
+            url, kwargs = self._prepare(spec.get('method', 'get').lower(), spec.get('url', ''),
+                                        path_params=spec.get('path_params', self.path_params))
+            PoolRegistry.mount(self.session, url, spec.get('proxies', kwargs['proxies']), pool_maxsize)
+
+    @step
+    def send_many(self, specs, max_workers=10):
+        """
+        使用线程池并发发送一批请求，按顺序返回各自独立的 Resp，不修改 self.resp
+
+        :param specs: 请求描述的列表，如 {'method': 'get', 'url': 'user/{uid}', 'path_params': {'uid': 1}}，
+            除 method 和 url 外的键值与 get/post 等方法的参数相同
+        :param max_workers: 并发线程数
+        :return: Resp 列表
+        """
+        specs = list(specs)
+        self._mount_pool(max_workers, specs)
+
+        def send(spec):
+            spec = dict(spec)
+            return self._send(spec.pop('method', 'get').lower(), spec.pop('url', ''), **spec)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            resps = list(executor.map(send, specs))
+        logging.info('Sent {} requests with {} workers.'.format(len(resps), max_workers))
+        return resps
+
+    @step
+    def get(self, url='', **kwargs):
+        """
+        发送 get 请求
+        """
+        return self._step_send('get', url, **kwargs)
+
     @step
     def head(self, url='', **kwargs):
         """
         发送 head 请求
         """
-        if '://' not in url:
-            url = urljoin(self.base_url, url)
-        if self.path_params:
-            url = url.format(**self.path_params)
-        kwargs['headers'] = kwargs.get('headers', self.headers)
-        kwargs['params'] = kwargs.get('params', self.params)
-        kwargs['timeout'] = kwargs.get('timeout', self.timeout)
-        kwargs['proxies'] = kwargs.get('timeout', self.proxies)
-        response = self.session.head(url, **kwargs)
-        self.resp = Resp(response, self)
-        return self.resp
+        return self._step_send('head', url, **kwargs)
 
     @step
     def options(self, url='', **kwargs):
         """
         发送 options 请求
         """
-        if '://' not in url:
-            url = urljoin(self.base_url, url)
-        if self.path_params:
-            url = url.format(**self.path_params)
-        kwargs['headers'] = kwargs.get('headers', self.headers)
-        kwargs['params'] = kwargs.get('params', self.params)
-        kwargs['timeout'] = kwargs.get('timeout', self.timeout)
-        kwargs['proxies'] = kwargs.get('timeout', self.proxies)
-        response = self.session.options(url, **kwargs)
-        self.resp = Resp(response, self)
-        return self.resp
+        return self._step_send('options', url, **kwargs)
 
     @step
     def post(self, url='', **kwargs):
         """
         发送 post 请求
         """
-        if '://' not in url:
-            url = urljoin(self.base_url, url)
-        if self.path_params:
-            url = url.format(**self.path_params)
-        kwargs['headers'] = kwargs.get('headers', self.headers)
-        kwargs['data'] = kwargs.get('data', self.data)
-        kwargs['params'] = kwargs.get('params', self.params)
-        kwargs['timeout'] = kwargs.get('timeout', self.timeout)
-        kwargs['proxies'] = kwargs.get('timeout', self.proxies)
-        logging.info('kwargs={}'.format(kwargs))
-        response = self.session.post(url, **kwargs)
-        self.resp = Resp(response, self)
-        return self.resp
+        logging.info('kwargs=%s', brief(kwargs))
+        return self._step_send('post', url, **kwargs)
 
     @step
     def put(self, url='', **kwargs):
         """
         发送 put 请求
         """
-        if '://' not in url:
-            url = urljoin(self.base_url, url)
-        if self.path_params:
-            url = url.format(**self.path_params)
-        kwargs['headers'] = kwargs.get('headers', self.headers)
-        kwargs['data'] = kwargs.get('data', self.data)
-        kwargs['json'] = kwargs.get('json', self.json)
-        kwargs['files'] = kwargs.get('files', self.files)
-        kwargs['timeout'] = kwargs.get('timeout', self.timeout)
-        kwargs['proxies'] = kwargs.get('timeout', self.proxies)
-        response = self.session.put(url, **kwargs)
-        self.resp = Resp(response, self)
-        return self.resp
+        return self._step_send('put', url, **kwargs)
 
     @step
     def delete(self, url='', **kwargs):
         """
         发送 delete 请求
         """
-        if '://' not in url:
-            url = urljoin(self.base_url, url)
-        if self.path_params:
-            url = url.format(**self.path_params)
-        kwargs['headers'] = kwargs.get('headers', self.headers)
-        kwargs['data'] = kwargs.get('data', self.data)
-        kwargs['json'] = kwargs.get('json', self.json)
-        kwargs['files'] = kwargs.get('files', self.files)
-        kwargs['timeout'] = kwargs.get('timeout', self.timeout)
-        kwargs['proxies'] = kwargs.get('timeout', self.proxies)
-        response = self.session.delete(url, **kwargs)
-        self.resp = Resp(response, self)
-        return self.resp
+        return self._step_send('delete', url, **kwargs)
 
 
 class Arrangement:
@@ -248,21 +976,183 @@ class Arrangement:
         self.driver.timeout = timeout
         return self
 
+    @step('设置重试策略')
+    def retry(self, total=3, backoff=0.5, max_backoff=30, jitter=True, statuses=None, methods=None,
+              respect_retry_after=True, budget=None):
+        """
+        设置传输层重试策略，参数见 RetryPolicy；total=0 时不重试
+        """
+        self.driver.retry = RetryPolicy(total, backoff, max_backoff, jitter, statuses, methods,
+                                        respect_retry_after, budget) if total else None
+        return self
+
+    @step('创建请求模板')
+    def template(self, method, url=''):
+        """
+        以当前的初始化参数创建请求模板，用于在循环中反复发送只有少量参数变化的请求
+        """
+        return RequestTemplate(self.driver, method, url)
+
+    @step('流式上传文件')
+    def upload(self, path, field=None, filename=None, content_type='application/octet-stream', chunked=False):
+        """
+        从磁盘流式上传文件，不把文件载入内存，用于 post/put；
+        指定 field 时以 multipart 表单上传，已设置的 form_param 作为其他表单字段
+        """
+        if field is None:
+            body = UploadStream.file(path, content_type, chunked)
+        else:
+            fields = self.driver.data if isinstance(self.driver.data, dict) else None
+            body = UploadStream.multipart(
+                {field: (path, filename or os.path.basename(path), content_type)}, fields, chunked
+            )
+        self.driver.data = body
+        self.driver.headers = dict(self.driver.headers or {}, **{'Content-Type': body.content_type})
+        return self
+
+    @step('流式读取响应')
+    def stream(self, stream=True):
+        self.driver.stream = stream
+        return self
+
+    @step('录制请求和响应到文件')
+    def record(self, path, sensitive_headers=None):
+        self.driver.cassette = Cassette(path, 'record', sensitive_headers)
+        return self
+
+    @step('从录制文件回放响应，不访问网络')
+    def replay(self, path):
+        self.driver.cassette = Cassette(path, 'replay')
+        return self
+
     @step
     def action(self):
         return self.driver
 
 
+class RequestTemplate:
+    """
+    预先准备好的请求，由 Arrangement.template 创建
+
+    创建时完成 URL 拼接、请求头合并、环境代理配置等准备工作，
+    每次发送只重新渲染变化的路径参数、查询参数、请求头和请求体
+    """
+    def __init__(self, driver: HTTPDriver, method, url=''):
+        self.driver = driver
+        self.method = method
+        self.url = url
+        self.endpoint = driver._endpoint(method, url)
+        self.path_params = dict(driver.path_params or {})
+        # 路径参数在每次发送时填充，这里先不填充
+        full_url, self.kwargs = driver._prepare(method, url, path_params=None)
+        session = driver.session
+        self.prepared = session.prepare_request(requests.Request(
+            method=method.upper(),
+            url=full_url,
+            headers=self.kwargs.get('headers'),
+            files=self.kwargs.get('files'),
+            data=self.kwargs.get('data') or {},
+            json=self.kwargs.get('json'),
+            params=self.kwargs.get('params') or {},
+        ))
+        # prepare_url 会把 { } 转义，还原后作为路径参数的模板
+        self.url_pattern = self.prepared.url.replace('%7B', '{').replace('%7D', '}')
+        self.has_path_params = '{' in self.url_pattern
+        self.settings = session.merge_environment_settings(
+            self.prepared.url, self.kwargs['proxies'], self.kwargs['stream'], None, None
+        )
+        self.settings['timeout'] = self.kwargs['timeout']
+        PoolRegistry.mount(session, self.prepared.url, self.kwargs['proxies'])
+
+    def _render(self, path_params=None, params=None, data=None, json=None, headers=None):
+        prepared = self.prepared.copy()
+        url = self.url_pattern
+        if self.has_path_params:
+            url = requests.utils.requote_uri(url.format(**dict(self.path_params, **(path_params or {}))))
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params, doseq=True)
+        prepared.url = url
+        if headers:
+            prepared.headers.update(headers)
+        if data is not None or json is not None:
+            # 请求体的类型可能变化，由 prepare_body 按新的请求体重新生成相关请求头，调用方指定的 Content-Type 除外
+            prepared.headers.pop('Content-Length', None)
+            prepared.headers.pop('Transfer-Encoding', None)
+            if 'Content-Type' not in requests.structures.CaseInsensitiveDict(headers or {}):
+                prepared.headers.pop('Content-Type', None)
+            prepared.prepare_body(data, None, json)
+        # Cookies 可能被之前的响应更新，每次重新生成
+        prepared.headers.pop('Cookie', None)
+        prepared.prepare_cookies(self.driver.session.cookies)
+        return prepared
+
+    @step
+    def send(self, path_params=None, params=None, data=None, json=None, headers=None):
+        """
+        发送请求，params 追加到模板的查询参数后，headers 覆盖模板的请求头，
+        data/json 替换模板的请求体，此时 Content-Type 按新的请求体生成，除非 headers 中指定
+        """
+        driver = self.driver
+        if driver.cassette is not None and driver.cassette.mode == 'replay':
+            kwargs = dict(self.kwargs, path_params=dict(self.path_params, **(path_params or {})))
+            kwargs['params'] = dict(kwargs.get('params') or {}, **(params or {}))
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **(headers or {}))
+            if data is not None or json is not None:
+                kwargs['data'], kwargs['json'] = data, json
+            driver.resp = driver._send(self.method, self.url, **kwargs)
+            return driver.resp
+        prepared = self._render(path_params, params, data, json, headers)
+        driver.resp = driver._measure(
+            self.endpoint, self.settings['stream'], None, lambda: driver.session.send(prepared, **self.settings),
+            driver._retry_policy(self.method, prepared.headers)
+        )
+        return driver.resp
+
+
 class Resp:
     """
     响应内容类
     """
-    def __init__(self, response, driver: HTTPDriver):
+    def __init__(self, response, driver: HTTPDriver, stream=False):
         self.response = response
+        self.stream = stream
         self.driver = driver
         self.session = driver.session
         self.extraction_obj: Extraction = None
         self.assertion_obj: Assertion = None
+        # 各项耗时（秒），如 json_decode
+        self.metrics = dict()
+        self._json = None
+        self._json_decoded = False
+
+    def json(self):
+        """
+        解码 JSON 响应体，只在第一次调用时解码，之后的断言和提取共享同一个结果，不要修改
+        """
+        if not self._json_decoded:
+            start = time.perf_counter()
+            encoding = self.response.encoding
+            if encoding is None or encoding.lower().replace('-', '') == 'utf8':
+                # 直接解码字节，省去一次转换成 str 的开销
+                self._json = json_loads(self.response.content)
+            else:
+                self._json = json_loads(self.response.text)
+            self._json_decoded = True
+            self.metrics['json_decode'] = time.perf_counter() - start
+        return self._json
+
+    def iter_records(self, format=None, chunk_size=64 * 1024):
+        """
+        边下载边解析记录，迭代结束或中途退出时关闭连接
+        """
+        if format is None and 'ndjson' in self.response.headers.get('Content-Type', ''):
+            format = 'ndjson'
+        decoder = codecs.getincrementaldecoder(self.response.encoding or 'utf-8')(errors='replace')
+        try:
+            chunks = (decoder.decode(chunk) for chunk in self.response.iter_content(chunk_size))
+            yield from iter_json_records(chunks, format)
+        finally:
+            self.response.close()
 
     @step('开始提取')
     def extraction(self):
@@ -274,8 +1164,20 @@ class Resp:
         self.assertion_obj = Assertion(self)
         return self.assertion_obj
 
-    def validation(self, yaml):
-        pass
+    @step('契约校验')
+    def validation(self, schema):
+        """
+        使用 YAML/JSON 格式的 JSON Schema 文件校验 JSON 响应体，一次遍历报告所有不符合的 JSON 路径
+        """
+        validator = SchemaCache.validator(schema)
+        violations = ['{}: {}'.format(error.json_path, error.message)
+                      for error in validator.iter_errors(self.json())]
+        if violations:
+            attach('\n'.join(violations), name='契约校验失败', attachment_type=attachment_type.TEXT)
+            raise AssertionError('{} schema violations:\n{}'.format(
+                len(violations), '\n'.join(violations[:20])
+            ))
+        return self
 
 
 class Assertion:
@@ -292,7 +1194,7 @@ class Assertion:
     @step
     @fail_to_log
     def json(self, assert_method, *key_or_kw):
-        json = self.response.json()
+        json = self.resp.json()
         if not key_or_kw:
             assert_method(json)
         elif len(key_or_kw) == 1:
@@ -303,6 +1205,36 @@ class Assertion:
                 assert_method(value)(json_parser(key, json))
         return self
 
+    @step
+    @fail_to_log
+    def each(self, assert_method, key=None, format=None):
+        """
+        逐条断言流式响应中的记录（或记录中 key 对应的值），第一条失败即中止下载
+        """
+        # 跳过每条记录各自的 allure 步骤
+        check = getattr(assert_method, '__wrapped__', assert_method)
+        count = 0
+        records = self.resp.iter_records(format)
+        try:
+            for count, record in enumerate(records, 1):
+                check(json_parser(key, record) if key else record)
+        except AssertionError:
+            logging.error('Assertion failed at record {}, download aborted.'.format(count))
+            raise
+        finally:
+            records.close()
+        logging.info('Asserted {} records.'.format(count))
+        return self
+
+    @step
+    @fail_to_log
+    def elapsed(self, assert_method, phase='total'):
+        """
+        断言耗时（秒），phase 为 connect、tls、ttfb、download 或 total，如 elapsed(Assert.lt(0.3))
+        """
+        assert_method(self.resp.metrics[phase])
+        return self
+
     @step
     @fail_to_log
     def header(self, assert_method, *key_or_kw):
@@ -364,11 +1296,22 @@ class Extraction:
     @step
     @fail_to_log
     def json(self, key=None):
-        json = self.response.json()
+        """
+        返回的对象与 Resp.json 的解码结果共享，不要修改，需要修改时请先 copy.deepcopy
+        """
+        json = self.resp.json()
         if key:
             json = json_parser(key, json)
         return json
 
+    @step
+    @fail_to_log
+    def iter_records(self, format=None, chunk_size=64 * 1024):
+        """
+        逐条返回流式响应中的记录，format 为 array 或 ndjson，缺省时自动判断
+        """
+        return self.resp.iter_records(format, chunk_size)
+
     @step
     @fail_to_log
     def raw(self):
@@ -7,22 +7,61 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.touch_actions import TouchActions
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import UnexpectedAlertPresentException
-from ..util import logging, html_unescape, Assert
-from allure import step, attach, attachment_type
-from urllib.parse import urljoin
+from selenium.common.exceptions import UnexpectedAlertPresentException, TimeoutException, WebDriverException, \
+    StaleElementReferenceException
+from selenium.webdriver.remote.webelement import WebElement
+from ..util import logging, html_unescape, Assert, step, StepMode, brief
+from allure import attach, attachment_type
+from urllib.parse import urljoin, urlsplit
+from urllib.request import urlopen
 from urllib3.exceptions import ProtocolError
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import OrderedDict, deque
 import numpy as np
+import os
+import uuid
+import queue
+import base64
+import hashlib
+import json
+import weakref
+import re
 import time
+import atexit
+import threading
 import cv2
 
 
+def browser_log(webdriver):
+    """
+    失败时输出浏览器日志：开启 DevToolsCapture 时附加最近的记录，否则逐条输出 chromedriver 缓存的控制台日志
+    """
+    capture = DevToolsCapture.of(webdriver)
+    if capture is not None:
+        capture.attach()
+        return
+    for entry in webdriver.get_log('browser'):
+        if entry['level'] == 'SEVERE':
+            logging.error(str(entry))
+        elif entry['level'] == 'WARNING':
+            logging.warning(str(entry))
+        else:
+            logging.info(str(entry))
+
+
 def fail_to_snapshot(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
         try:
-            return func(self, *args, **kwargs)
+            try:
+                return func(self, *args, **kwargs)
+            except StaleElementReferenceException:
+                # 缓存的元素已失效（如 ActionChains 中直接使用元素 id），重新定位后再试一次
+                element = getattr(self, 'selenium_elem', None)
+                if not isinstance(element, CachedElement):
+                    raise
+                element.resolve()
+                return func(self, *args, **kwargs)
         # 有弹窗时，必须关闭弹窗才能截图
         except Exception as e:
             if isinstance(e, UnexpectedAlertPresentException):
@@ -31,34 +70,285 @@ def fail_to_snapshot(func):
                 while tries > 0:
                     try:
                         self.webdriver.switch_to.alert.accept()
-                        attach(
-                            self.webdriver.get_screenshot_as_png(),
-                            name="弹窗导致失败后截图",
-                            attachment_type=attachment_type.PNG
-                        )
-                        for entry in self.webdriver.get_log('browser'):
-                            if entry['level'] == 'SEVERE':
-                                logging.error(str(entry))
-                            elif entry['level'] == 'WARNING':
-                                logging.warning(str(entry))
-                            else:
-                                logging.info(str(entry))
+                        Screenshots.attach(self.webdriver, "弹窗导致失败后截图")
+                        browser_log(self.webdriver)
                         break
                     except Exception:
                         tries -= 1
             else:
-                attach(self.webdriver.get_screenshot_as_png(), name="失败后截图", attachment_type=attachment_type.PNG)
-                for entry in self.webdriver.get_log('browser'):
-                    if entry['level'] == 'SEVERE':
-                        logging.error(str(entry))
-                    elif entry['level'] == 'WARNING':
-                        logging.warning(str(entry))
-                    else:
-                        logging.info(str(entry))
+                Screenshots.attach(self.webdriver, "失败后截图", getattr(self, 'selenium_elem', None))
+                browser_log(self.webdriver)
             raise e
     return wrapper
 
 
+class Screenshots:
+    """
+    截图附件：可以只截取元素、缩小尺寸、有损压缩，同一个测试中与之前相同的截图只附加一行说明
+
+    - format: png 或 jpeg，环境变量 LUTRA_SCREENSHOT_FORMAT
+    - quality: jpeg 的质量，LUTRA_SCREENSHOT_QUALITY
+    - max_width: 宽度超过时等比缩小，0 为不缩小，LUTRA_SCREENSHOT_MAX_WIDTH
+    - scope: page 截取页面，element 在元素操作失败时只截取该元素，LUTRA_SCREENSHOT_SCOPE
+    - background: 在后台线程压缩和写文件，LUTRA_SCREENSHOT_ASYNC=1 开启；依赖 allure-pytest 的内部接口，
+      不可用时记录警告并改为直接附加。队列满时等待，内存占用有上限
+    """
+    format = os.environ.get('LUTRA_SCREENSHOT_FORMAT', 'png')
+    quality = int(os.environ.get('LUTRA_SCREENSHOT_QUALITY', 80))
+    max_width = int(os.environ.get('LUTRA_SCREENSHOT_MAX_WIDTH', 0))
+    scope = os.environ.get('LUTRA_SCREENSHOT_SCOPE', 'page')
+    background = os.environ.get('LUTRA_SCREENSHOT_ASYNC') == '1'
+    queue_size = 8
+    # 当前测试中已附加的截图：sha1 -> 附件名
+    _seen = dict()
+    _test = None
+    _queue = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def attach(cls, webdriver, name, element=None):
+        png = None
+        if element is not None and cls.scope == 'element':
+            try:
+                png = element.screenshot_as_png
+            except Exception:
+                # 元素已失效或不可见时截取页面
+                pass
+        if png is None:
+            png = webdriver.get_screenshot_as_png()
+        # 只在同一个测试中去重，换了测试就重新开始
+        test = os.environ.get('PYTEST_CURRENT_TEST', '').rsplit(' (', 1)[0]
+        if test != cls._test:
+            cls._seen.clear()
+            cls._test = test
+        digest = hashlib.sha1(png).hexdigest()
+        if digest in cls._seen:
+            attach('与截图「{}」相同'.format(cls._seen[digest]), name=name, attachment_type=attachment_type.TEXT)
+            return
+        cls._seen[digest] = name
+        file_type = attachment_type.JPG if cls.format == 'jpeg' else attachment_type.PNG
+        file_name = cls._reserve(name, file_type) if cls.background else None
+        if file_name is None:
+            attach(cls.encode(png), name=name, attachment_type=file_type)
+        else:
+            cls._worker().put((png, file_name))
+
+    @classmethod
+    def encode(cls, png):
+        """
+        按 format/quality/max_width 重新编码 PNG 截图
+        """
+        if cls.format != 'jpeg' and not cls.max_width:
+            return png
+        image = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_COLOR)
+        if cls.max_width and image.shape[1] > cls.max_width:
+            factor = cls.max_width / image.shape[1]
+            image = cv2.resize(image, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        if cls.format == 'jpeg':
+            return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, cls.quality])[1].tobytes()
+        return cv2.imencode('.png', image)[1].tobytes()
+
+    @classmethod
+    def _reserve(cls, name, file_type):
+        # 在当前测试中登记附件（allure-pytest 的 AllureReporter._attach），文件内容之后由后台线程写入
+        import allure_commons
+        for plugin in allure_commons.plugin_manager.get_plugins():
+            reporter = getattr(plugin, 'allure_logger', None)
+            if reporter is None:
+                continue
+            try:
+                return reporter._attach(uuid.uuid4(), name=name, attachment_type=file_type)
+            except Exception as e:
+                logging.warning('Background screenshots are unavailable, attaching directly: %s', brief(e))
+                cls.background = False
+                return None
+        return None
+
+    @classmethod
+    def _worker(cls):
+        with cls._lock:
+            if cls._queue is None:
+                cls._queue = queue.Queue(cls.queue_size)
+                threading.Thread(target=cls._run, name='lutra-screenshots', daemon=True).start()
+                atexit.register(cls.flush)
+        return cls._queue
+
+    @classmethod
+    def _run(cls):
+        import allure_commons
+        while True:
+            png, file_name = cls._queue.get()
+            try:
+                allure_commons.plugin_manager.hook.report_attached_data(body=cls.encode(png), file_name=file_name)
+            except Exception as e:
+                logging.warning('Failed to write screenshot %s: %s', file_name, brief(e))
+            finally:
+                cls._queue.task_done()
+
+    @classmethod
+    def flush(cls):
+        """
+        等待后台线程写完所有截图
+        """
+        if cls._queue is not None:
+            cls._queue.join()
+
+
+class DevToolsCapture:
+    """
+    通过 DevTools 协议持续接收浏览器的控制台日志、网络请求结果和页面异常，保存在有上限的环形缓冲中，
+    失败时只把最近 window 秒的记录作为一个附件；只支持本地 Chrome（连接 chromedriver 返回的 debuggerAddress）
+
+    - 环境变量 LUTRA_DEVTOOLS=1 开启，或 d.arrangement().devtools()；开启后不再让 chromedriver 缓存全部控制台日志
+    - size: 每个浏览器保存的记录条数上限，LUTRA_DEVTOOLS_SIZE
+    - window: 失败时附加最近多少秒的记录，LUTRA_DEVTOOLS_WINDOW
+    """
+    size = int(os.environ.get('LUTRA_DEVTOOLS_SIZE', 1000))
+    window = float(os.environ.get('LUTRA_DEVTOOLS_WINDOW', 30))
+    commands = (
+        ('Runtime.enable', {}),
+        ('Log.enable', {}),
+        # 不需要响应内容，尽量少占浏览器内存
+        ('Network.enable', {'maxTotalBufferSize': 0, 'maxResourceBufferSize': 0}),
+    )
+    _captures = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, url, size=None):
+        from websocket import create_connection
+        # Chrome 111 起拒绝带 Origin 的连接
+        self.connection = create_connection(url, suppress_origin=True)
+        self.events = deque(maxlen=size or self.size)
+        # requestId -> URL，loadingFailed 事件中没有 URL
+        self.requests = OrderedDict()
+        self.lock = threading.Lock()
+        for n, (method, params) in enumerate(self.commands, 1):
+            self.connection.send(json.dumps({'id': n, 'method': method, 'params': params}))
+        self.thread = threading.Thread(target=self._run, name='lutra-devtools', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def of(cls, webdriver):
+        return cls._captures.get(webdriver) if webdriver is not None else None
+
+    @classmethod
+    def start(cls, webdriver):
+        """
+        开始收集，已在收集或浏览器不支持时直接返回
+        """
+        with cls._lock:
+            capture = cls._captures.get(webdriver)
+            if capture is not None:
+                return capture
+            try:
+                capture = cls(cls._target(webdriver))
+            except Exception as e:
+                logging.warning('Failed to connect to DevTools: %s', brief(e))
+                return None
+            cls._captures[webdriver] = capture
+            return capture
+
+    @classmethod
+    def stop(cls, webdriver):
+        with cls._lock:
+            capture = cls._captures.pop(webdriver, None)
+        if capture is not None:
+            capture.close()
+
+    @staticmethod
+    def _target(webdriver):
+        # 当前窗口对应的页面，chromedriver 的窗口句柄就是页面的 target id（旧版本带 CDwindow- 前缀）
+        address = webdriver.capabilities.get('goog:chromeOptions', {}).get('debuggerAddress')
+        if not address:
+            raise WebDriverException('DevTools is only available for local Chrome.')
+        with urlopen('http://{}/json'.format(address), timeout=5) as response:
+            targets = [target for target in json.loads(response.read().decode()) if target.get('type') == 'page']
+        handle = webdriver.current_window_handle.replace('CDwindow-', '')
+        for target in targets:
+            if target['id'] == handle:
+                return target['webSocketDebuggerUrl']
+        return targets[0]['webSocketDebuggerUrl']
+
+    def _run(self):
+        while True:
+            try:
+                message = json.loads(self.connection.recv())
+            except Exception:
+                # 浏览器退出或连接被关闭
+                return
+            method = message.get('method')
+            if not method:
+                continue
+            try:
+                event = self._event(method, message.get('params', {}))
+            except (KeyError, TypeError):
+                continue
+            if event is not None:
+                with self.lock:
+                    self.events.append((time.time(),) + event)
+
+    def _event(self, method, params):
+        if method == 'Runtime.consoleAPICalled':
+            text = ' '.join(str(arg.get('value', arg.get('description', arg.get('type'))))
+                            for arg in params.get('args', ()))
+            return 'console', params['type'], text
+        if method == 'Runtime.exceptionThrown':
+            details = params['exceptionDetails']
+            return 'exception', 'error', details.get('exception', {}).get('description') or details.get('text')
+        if method == 'Log.entryAdded':
+            entry = params['entry']
+            return entry['source'], entry['level'], '{} {}'.format(entry['text'], entry.get('url', ''))
+        if method == 'Network.requestWillBeSent':
+            with self.lock:
+                self.requests[params['requestId']] = '{} {}'.format(params['request']['method'],
+                                                                   params['request']['url'])
+                while len(self.requests) > self.events.maxlen:
+                    self.requests.popitem(last=False)
+        elif method == 'Network.responseReceived':
+            response = params['response']
+            with self.lock:
+                request = self.requests.pop(params['requestId'], response['url'])
+            level = 'error' if response['status'] >= 400 else 'info'
+            return 'network', level, '{} {}'.format(response['status'], request)
+        elif method == 'Network.loadingFailed':
+            with self.lock:
+                request = self.requests.pop(params['requestId'], params['requestId'])
+            return 'network', 'error', '{} {}'.format(params['errorText'], request)
+        return None
+
+    def recent(self, seconds=None):
+        """
+        返回最近 seconds 秒的记录：(时间戳, 类别, 级别, 内容)
+        """
+        since = time.time() - (self.window if seconds is None else seconds)
+        with self.lock:
+            events = list(self.events)
+        return [event for event in events if event[0] >= since]
+
+    def attach(self, seconds=None):
+        seconds = self.window if seconds is None else seconds
+        events = self.recent(seconds)
+        errors = sum(event[2] == 'error' for event in events)
+        logging.info('Browser log: %s entries in the last %gs, %s errors.', len(events), seconds, errors)
+        if events:
+            attach('\n'.join(
+                '{}.{:03d} [{}:{}] {}'.format(time.strftime('%H:%M:%S', time.localtime(t)), int(t % 1 * 1000),
+                                              kind, level, text)
+                for t, kind, level, text in events
+            ), name='浏览器日志（最近 {:g} 秒）'.format(seconds), attachment_type=attachment_type.TEXT)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.requests.clear()
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
 class Expect:
     exist = ec.presence_of_element_located
     visible = ec.visibility_of_element_located
@@ -121,18 +411,11 @@ class XP:
 
     @classmethod
     def attr(cls, attr, value, scope='', relative=True, sibling=None, nth=1, tag='*'):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        return '({}{}[@{}="{}"]{})[{}]'.format(scope, tag, attr, value, sibling, nth)
+        return cls._build(tag, ((('eq', attr, value),),), scope, relative, sibling, nth)
 
     @classmethod
     def partial_attr(cls, attr, value, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[contains(@{}, "{}"){}]{})[{}]'.format(scope, tag, attr, value, and_xp, sibling, nth)
+        return cls._build(tag, cls._and(('contains', attr, value), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def partial_class_name(cls, class_name, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
@@ -144,87 +427,179 @@ class XP:
 
     @classmethod
     def text(cls, text, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[text()="{}"{}]{})[{}]'.format(scope, tag, text, and_xp, sibling, nth)
+        return cls._build(tag, cls._and(('text', text), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def partial_text(cls, text, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[contains(text(), "{}"){}]{})[{}]'.format(scope, tag, text, and_xp, sibling, nth)
+        return cls._build(tag, cls._and(('contains_text', text), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def partial_style(cls, style, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[contains(@style, "{}")]{})[{}]'.format(scope, tag, style, and_xp, sibling, nth)
+        return cls._build(tag, cls._and(('contains', 'style', style), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def id(cls, id_, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[@id="{}"{}]{})[{}]'.format(scope, tag, id_, and_xp, sibling, nth)
+        return cls._build(tag, cls._and(('eq', 'id', id_), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def class_name(cls, class_name, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[contains(concat(" ", normalize-space(@class), " "), " {} "){}]{})[{}]'.format(
-            scope, tag, class_name, and_xp, sibling, nth
-        )
+        return cls._build(tag, cls._and(('class', class_name), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def name(cls, name, scope='', relative=True, sibling=None, nth=1, tag='*', and_xp=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        and_xp = ' and ' + and_xp if and_xp else ''
-        return '({}{}[@name="{}"{}]{})[{}]'.format(scope, tag, name, and_xp, sibling, nth)
+        return cls._build(tag, cls._and(('eq', 'name', name), and_xp), scope, relative, sibling, nth)
 
     @classmethod
     def title(cls, title, scope='', relative=True, sibling=None, nth=1, tag='*'):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        return '({}{}[@title="{}"]{})[{}]'.format(scope, tag, title, sibling, nth)
+        return cls._build(tag, ((('eq', 'title', title),),), scope, relative, sibling, nth)
 
     @classmethod
     def nth(cls, n=1, scope='', relative=False, tag='*', sibling=None):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        return '({}{}{})[{}]'.format(scope, tag, sibling, n)
+        return cls._build(tag, (), scope, relative, sibling, n)
 
     @classmethod
     def tag(cls, tag, scope='', relative=True, sibling=None, nth=1):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        return '({}{}{})[{}]'.format(scope, tag, sibling, nth)
+        return cls._build(tag, (), scope, relative, sibling, nth)
 
     @classmethod
     def q_name(cls, q_name, scope='', relative=True, sibling=None, nth=1):
-        scope = cls.convert_locator_to_xpath(scope)
-        scope += '//' if relative else '/'
-        sibling = '[{}]'.format(sibling) if sibling else ''
-        return '({}*[name()="{}"]{})[{}]'.format(scope, q_name, sibling, nth)
+        return cls._build('*', ((('raw', 'name()="{}"'.format(q_name)),),), scope, relative, sibling, nth)
+
+    @staticmethod
+    def _and(condition, and_xp=None):
+        # 同一个方括号中以 and 连接的条件
+        return ((condition,) + ((('raw', and_xp),) if and_xp else ()),)
+
+    @classmethod
+    def _build(cls, tag, predicates, scope, relative, sibling, nth):
+        if sibling:
+            predicates += ((('raw', sibling),),)
+        return _compile_locator(tag, predicates, scope, relative, nth)
+
+
+# 分步查找的定位信息，见 Locator
+CHAIN = 'lutra chain'
+_CSS_NAME = re.compile(r'^[A-Za-z_][\w-]*$')
+
+
+def _xpath_condition(condition):
+    kind, *args = condition
+    if kind == 'eq':
+        return '@{}="{}"'.format(*args)
+    if kind == 'contains':
+        return 'contains(@{}, "{}")'.format(*args)
+    if kind == 'class':
+        return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(*args)
+    if kind == 'text':
+        return 'text()="{}"'.format(*args)
+    if kind == 'contains_text':
+        return 'contains(text(), "{}")'.format(*args)
+    return args[0]
+
+
+def _css_condition(condition):
+    # 无法等价转换为 CSS 时返回 None
+    kind, *args = condition
+    if kind in ('eq', 'contains') and _CSS_NAME.match(args[0]) and (kind == 'eq' or args[1]):
+        value = str(args[1]).replace('\\', '\\\\').replace('"', '\\"')
+        return '[{}{}="{}"]'.format(args[0], '' if kind == 'eq' else '*', value)
+    if kind == 'class' and args[0] and not re.search(r'\s', args[0]):
+        return '[class~="{}"]'.format(str(args[0]).replace('\\', '\\\\').replace('"', '\\"'))
+    return None
+
+
+def _css_node(tag, predicates):
+    if tag != '*' and not _CSS_NAME.match(tag) or len(predicates) > 1:
+        return None
+    conditions = [_css_condition(condition) for condition in (predicates[0] if predicates else ())]
+    if None in conditions:
+        return None
+    return ('' if tag == '*' and conditions else tag) + ''.join(conditions)
+
+
+@lru_cache(maxsize=1024, typed=True)
+def _compile_locator(tag, predicates, scope, relative, nth):
+    """
+    把 XP 的调用编译为 Locator：字符串值与原来的 XPath 完全相同，chain 为查找第一个元素时实际使用的定位步骤
+    """
+    separator = '//' if relative else '/'
+    # 去掉范围中的名字信息
+    while isinstance(scope, tuple) and len(scope) > 1 and scope[0] not in vars(By).values():
+        scope = scope[1:]
+    if isinstance(scope, tuple) and len(scope) == 1:
+        scope = scope[0]
+    if isinstance(scope, tuple) and scope[0] == By.XPATH and isinstance(scope[1], Locator):
+        scope = scope[1]
+    node = tag + ''.join('[{}]'.format(' and '.join(_xpath_condition(c) for c in bracket)) for bracket in predicates)
+    # 范围的原 XPath、简化 XPath 和分步查找的步骤
+    # XP 构建的范围和 By 定位信息（包括 CSS 选择器）只取第一个（第 n 个）匹配元素，CSS 无法表达，
+    # 只有原样拼接的 XPath 字符串范围匹配其所有元素，可以直接拼接成简化 XPath
+    if isinstance(scope, Locator):
+        scope_simple, scope_xpath, scope_chain = scope.xpath, scope.xpath, scope.chain
+    elif isinstance(scope, tuple) and len(scope) == 2 and scope[0] == By.CSS_SELECTOR:
+        scope_simple, scope_xpath, scope_chain = None, None, (scope,)
+    elif scope:
+        scope_xpath = XP.convert_locator_to_xpath(scope)
+        scope_simple, scope_chain = scope_xpath, ((By.XPATH, scope_xpath),)
+    else:
+        scope_simple = scope_xpath = scope_chain = None
+    xpath = None if scope_chain and scope_xpath is None else \
+        '({}{}{})[{}]'.format(scope_xpath or '', separator, node, nth)
+    node_css = _css_node(tag, predicates)
+    css = simple = None
+    if nth == 1:
+        # 只取第一个元素时，(...)[1] 可以省略；范围保留原 XPath 中的 [n]
+        if node_css is not None and scope_chain is None and relative:
+            css = node_css
+        if scope_chain is None or scope_simple is not None:
+            simple = (scope_simple or '') + separator + node
+    else:
+        # 按文档顺序取第 n 个只能用原 XPath 表达
+        simple = xpath
+    # 查找所有匹配元素（find_all）的步骤，忽略 nth
+    if scope_chain is None and relative and node_css is not None:
+        every = (By.CSS_SELECTOR, node_css),
+    elif scope_chain is None or scope_xpath is not None:
+        every = (By.XPATH, '{}{}{}'.format(scope_xpath or '', separator, node)),
+    else:
+        every = scope_chain + ((By.XPATH, '.{}{}'.format(separator, node)),)
+    conditions = predicates[0] if len(predicates) == 1 else ()
+    if css is not None and tag == '*' and len(conditions) == 1 and conditions[0][:2] == ('eq', 'id'):
+        chain = (By.ID, str(conditions[0][2])),
+    elif css is not None:
+        chain = (By.CSS_SELECTOR, css),
+    elif simple is not None:
+        chain = (By.XPATH, simple),
+    elif nth == 1 and relative and node_css is not None:
+        # 在 CSS 范围的第一个元素内查找
+        chain = scope_chain + ((By.CSS_SELECTOR, node_css),)
+    else:
+        step = '.{}{}'.format(separator, node) if nth == 1 else '(.{}{})[{}]'.format(separator, node, nth)
+        chain = scope_chain + ((By.XPATH, step),)
+    return Locator(xpath or ' >> '.join(value for _, value in chain), chain, xpath, css, simple, every)
+
+
+class Locator(str):
+    """
+    XP 构建的定位信息，字符串值与原来的 XPath 相同，可以照旧拼接使用
+
+    chain 是查找第一个匹配元素时实际使用的定位步骤：没有范围时能用 ID/CSS 表达的使用 ID/CSS，否则使用去掉 (...)[1] 的简化 XPath；
+    范围只取其第一个匹配元素，CSS 范围先找到范围元素，再在其中查找；every 是查找所有匹配元素的步骤，不含 nth
+    """
+    def __new__(cls, value, chain, xpath=None, css=None, simple=None, every=None):
+        locator = super().__new__(cls, value)
+        locator.chain = chain
+        locator.xpath = xpath
+        locator.css = css
+        locator.simple = simple
+        locator.every = every or chain
+        return locator
 
 
 class UIDriver:
     def __init__(self, browser='chrome', base_url=None, timeout=10, interval=0.1, headless=True,
                  remote_server=None, remote_browser=None, width=1366, height=700, proxy='', bypass='',
-                 user_agent=None, mobile_device=None
+                 user_agent=None, mobile_device=None, pooled=False
                  ):
         self.base_url = base_url
         self.timeout = timeout
@@ -242,6 +617,16 @@ class UIDriver:
         self.lutra_elem = None
         self.user_agent = user_agent
         self.mobile_device = mobile_device
+        # 从 WebDriverPool 借用已启动的浏览器，clean 时归还而不是退出
+        self.pooled = pooled
+        # fixed：操作前固定等待 interval 秒；quiet：等待页面静止，见 QuietWait
+        self.wait_mode = os.environ.get('LUTRA_WAIT_MODE', 'fixed')
+        # poll：WebDriverWait 轮询；observer：在页面中用 MutationObserver 等待，见 ObserverWait
+        self.element_wait = os.environ.get('LUTRA_ELEMENT_WAIT', 'poll')
+        # 元素缓存，见 ElementCache
+        self.element_cache = ElementCache() if os.environ.get('LUTRA_ELEMENT_CACHE') else None
+        # 通过 DevTools 持续收集控制台和网络记录，见 DevToolsCapture
+        self.devtools = bool(os.environ.get('LUTRA_DEVTOOLS'))
         while timeout >= 0:
             try:
                 self.session()
@@ -254,6 +639,19 @@ class UIDriver:
                     raise e
 
     def session(self):
+        if self.pooled:
+            self.webdriver = WebDriverPool.borrow(self)
+        else:
+            self.launch()
+        if self.devtools:
+            DevToolsCapture.start(self.webdriver)
+        self.webdriver.implicitly_wait(self.timeout)
+        return self
+
+    def launch(self):
+        """
+        按当前配置启动一个新的浏览器
+        """
         if self.browser == 'safari':
             self.webdriver = webdriver.Safari()
         elif self.browser == 'phantomjs':
@@ -278,9 +676,11 @@ class UIDriver:
             options.add_argument("--window-size={},{}".format(self.width, self.height))
             self.webdriver = webdriver.Firefox(options=options, log_path='geckodriver.log')
         elif self.browser == 'chrome':
-            capabilities = DesiredCapabilities.CHROME
-            capabilities['loggingPrefs'] = {'browser': 'ALL'}
-            capabilities['goog:loggingPrefs'] = {'browser': 'ALL'}
+            capabilities = DesiredCapabilities.CHROME.copy()
+            if not self.devtools:
+                # 由 chromedriver 缓存全部控制台日志，失败时读取
+                capabilities['loggingPrefs'] = {'browser': 'ALL'}
+                capabilities['goog:loggingPrefs'] = {'browser': 'ALL'}
             options = webdriver.ChromeOptions()
             try:
                 options.headless = self.headless
@@ -303,8 +703,7 @@ class UIDriver:
             if self.bypass:
                 options.add_argument('--proxy-bypass-list="{}"'.format(self.bypass))
             self.webdriver = webdriver.Chrome(desired_capabilities=capabilities, options=options)
-        self.webdriver.implicitly_wait(self.timeout)
-        return self
+        return self.webdriver
 
     @step('开始初始化')
     def arrangement(self):
@@ -327,41 +726,84 @@ class UIDriver:
         return self.find(*args, **kw).selenium_elem
 
     @step('模版匹配')
-    def template_match(self, image, similarity=0.8):
-        attach(image, name="待匹配的截图", attachment_type=attachment_type.PNG)
-        snapshot = self.webdriver.get_screenshot_as_png()
-        # snapshot_array = np.asarray(snapshot, dtype=np.float32).astype(np.uint8)
-        attach(snapshot, name="待匹配的截图", attachment_type=attachment_type.PNG)
-        snapshot_array = np.frombuffer(snapshot, np.uint8)
-        src = cv2.imdecode(snapshot_array, cv2.IMREAD_GRAYSCALE)
-        template = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
-        res = cv2.matchTemplate(src, template, cv2.TM_CCOEFF_NORMED)
-        _, confidence, _, _ = cv2.minMaxLoc(res)
-        # loc = np.where(res >= similarity)
-        logging.info('Try to match images, with the confidence={}>={}'.format(confidence, similarity))
-        if confidence < similarity:
+    def template_match(self, image, similarity=0.8, region=None, elem=None, scales=(1.0,)):
+        """
+        在截图中查找模版图片
+
+        :param image: 模版图片的路径
+        :param region: 只在截图的该区域 (x, y, width, height) 中查找，单位为截图的像素
+        :param elem: 只截取该元素并在其中查找，比截取整个页面快得多
+        :param scales: 模版的缩放比例，按与 1 的接近程度依次尝试，匹配成功即停止
+        :return: TemplateMatch，即置信度，rect 为匹配位置（相对截图，指定 elem 时相对元素）
+        """
+        if elem is not None:
+            snapshot = elem.selenium_elem.screenshot_as_png
+        else:
+            snapshot = self.webdriver.get_screenshot_as_png()
+        if not StepMode.lean:
+            attach.file(image, name="模版图片", attachment_type=attachment_type.PNG)
+            attach(snapshot, name="待匹配的截图", attachment_type=attachment_type.PNG)
+        src = cv2.imdecode(np.frombuffer(snapshot, np.uint8), cv2.IMREAD_GRAYSCALE)
+        match = TemplateMatcher.match(src, image, similarity, scales, region)
+        logging.info('Try to match images, with the confidence=%s>=%s, rect=%s', float(match), similarity, match.rect)
+        if match < similarity:
             raise Exception('Template match failed')
-        return confidence
+        return match
+
+    canvas_script = """
+        var canvas = document.getElementById(arguments[0]), region = arguments[1];
+        if (!canvas) return null;
+        var x = region ? region[0] : 0, y = region ? region[1] : 0;
+        var width = region ? region[2] : canvas.width, height = region ? region[3] : canvas.height;
+        var context = canvas.getContext('2d');
+        if (!context) {
+            // WebGL 等其他上下文的画布，先绘制到临时的 2D 画布上
+            var copy = document.createElement('canvas');
+            copy.width = width;
+            copy.height = height;
+            context = copy.getContext('2d');
+            context.drawImage(canvas, x, y, width, height, 0, 0, width, height);
+            x = y = 0;
+        }
+        var rgba = context.getImageData(x, y, width, height).data, gray = new Uint8Array(width * height);
+        // 与 OpenCV 的 COLOR_RGB2GRAY 相同的系数
+        for (var i = 0, j = 0; j < gray.length; i += 4, j++) {
+            gray[j] = (rgba[i] * 9798 + rgba[i + 1] * 19235 + rgba[i + 2] * 3735 + 16384) >> 15;
+        }
+        var chunks = [];
+        for (var k = 0; k < gray.length; k += 0x8000) {
+            chunks.push(String.fromCharCode.apply(null, gray.subarray(k, k + 0x8000)));
+        }
+        return [width, height, btoa(chunks.join(''))];
+    """
+
+    @step('读取 Canvas 像素')
+    def canvas_pixels(self, canvas_id, region=None):
+        """
+        用 getImageData 读取画布（或其中的区域 (x, y, width, height)）的灰度像素，直接返回 NumPy 数组，不经过 PNG 编解码
+        """
+        result = self.webdriver.execute_script(self.canvas_script, canvas_id, list(region) if region else None)
+        if result is None:
+            raise Exception('找不到 Canvas：{}'.format(canvas_id))
+        width, height, data = result
+        return np.frombuffer(base64.b64decode(data), np.uint8).reshape(height, width)
 
     @step('Canvas 模版匹配')
-    def template_match_for_canvas(self, canvas_id, image, similarity=0.8):
-        canvas = self.webdriver.execute_script(
-            'var canvas = document.getElementById("linkScreen"); return canvas.toDataURL().substring(22);'.format(
-                canvas_id
-            )
-        )
-        import base64
-        canvas_decode = base64.b64decode(canvas)
-        canvas_array = np.fromstring(canvas_decode, np.uint8)
-        src = cv2.imdecode(canvas_array, cv2.COLOR_BGR2GRAY)
-        template = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
-        res = cv2.matchTemplate(src, template, cv2.TM_CCOEFF_NORMED)
-        _, confidence, _, _ = cv2.minMaxLoc(res)
-        # loc = np.where(res >= similarity)
-        logging.info('Try to match images, with the confidence={}>={}'.format(confidence, similarity))
-        if confidence < similarity:
+    def template_match_for_canvas(self, canvas_id, image, similarity=0.8, region=None, scales=(1.0,)):
+        """
+        在画布中查找模版图片，region 为画布中的区域 (x, y, width, height)，只传输该区域的像素
+
+        :return: TemplateMatch，rect 为相对画布的位置
+        """
+        src = self.canvas_pixels(canvas_id, region)
+        match = TemplateMatcher.match(src, image, similarity, scales)
+        if region and match.rect:
+            x, y, width, height = match.rect
+            match = TemplateMatch(match, (x + region[0], y + region[1], width, height), match.scale)
+        logging.info('Try to match images, with the confidence=%s>=%s, rect=%s', float(match), similarity, match.rect)
+        if match < similarity:
             raise Exception('Template match failed')
-        return confidence
+        return match
 
     @step('运行 JavaScript')
     @fail_to_snapshot
@@ -371,12 +813,13 @@ class UIDriver:
     @step("刷新")
     @fail_to_snapshot
     def refresh(self):
+        self.clear_element_cache()
         self.webdriver.refresh()
 
-    @fail_to_snapshot
-    def find(self, locator, until=None, until_not=None, timeout=None, interval=None):
+    @staticmethod
+    def _split_locator(locator, every=False):
         """
-        封装的 LutraElem 元素
+        拆分为 (名字, By, 定位信息)；every 时 XP 构建的定位信息使用查找所有匹配元素的步骤
         """
         meta = '未命名'
         # 不是 tuple，就是 XPATH
@@ -390,41 +833,126 @@ class UIDriver:
             else:
                 meta, *locator = locator[0], *locator[1:]
             # 否则就直接可用
-        return self._find(meta, locator[0], locator[1], until, until_not, timeout, interval)
+        by, location = locator[0], locator[1]
+        if isinstance(location, Locator) and by == By.XPATH:
+            # XP 构建的定位信息使用编译后的 ID/CSS/简化 XPath，CSS 范围内的 XPath 需要分步查找
+            chain = location.every if every else location.chain
+            by, location = chain[0] if len(chain) == 1 else (CHAIN, chain)
+        return meta, by, location
+
+    @fail_to_snapshot
+    def find(self, locator, until=None, until_not=None, timeout=None, interval=None):
+        """
+        封装的 LutraElem 元素
+        """
+        meta, by, location = self._split_locator(locator)
+        return self._find(meta, by, location, until, until_not, timeout, interval)
+
+    @fail_to_snapshot
+    @step('寻找所有元素')
+    def find_all(self, locator, attributes=(), interval=None):
+        """
+        一次脚本调用找到所有匹配的元素，同时取回各元素的文本、位置尺寸、可见性等快照
+
+        :param locator: 定位信息；XP 构建的定位信息会忽略 nth，返回所有匹配的元素
+        :param attributes: 需要一并取回的特性名
+        :return: Elems 对象
+        """
+        meta, by, location = self._split_locator(locator, every=True)
+        logging.info('寻找所有元素：%s，定位信息：%s = %s', meta, by, location)
+        self.pause(interval)
+        return Elems(self, (by, location), attributes).refresh()
 
     @step("寻找元素")
     def _find(self, meta, by, location, until=None, until_not=None, timeout=None, interval=None):
         locator = by, location
-        logging.info('寻找元素：{}，定位信息：{} = {}'.format(meta, *locator))
-        interval = float(self.interval if interval is None else interval)
-        time.sleep(interval)
+        logging.info('寻找元素：%s，定位信息：%s = %s', meta, *locator)
+        self.pause(interval)
         # self.snapshot()
-        if until is Expect.invisible:
+        timeout = float(timeout or self.timeout)
+        condition = ObserverWait.conditions.get(until or until_not)
+        if by == CHAIN:
+            if until or until_not:
+                raise Exception('CSS 范围内的定位信息不支持 until/until_not')
+            element = self.webdriver.find_element(*location[0])
+            for step_locator in location[1:]:
+                element = element.find_element(*step_locator)
+        elif self.element_wait == 'observer' and condition:
+            negate = until is None
+            element = ObserverWait.until(self, by, location, condition, negate, timeout)
+            if negate or until is Expect.invisible:
+                return
+        elif until is Expect.invisible:
             self.webdriver.implicitly_wait(0)
-            WebDriverWait(self.webdriver, int(timeout or self.timeout)).until(
+            WebDriverWait(self.webdriver, timeout).until(
                 until(locator)
             )
             self.webdriver.implicitly_wait(self.timeout)
             return
         elif until:
-            element = WebDriverWait(self.webdriver, int(timeout or self.timeout)).until(
+            element = WebDriverWait(self.webdriver, timeout).until(
                 until(locator)
             )
         elif until_not:
-            WebDriverWait(self.webdriver, int(timeout or self.timeout)).until_not(
+            WebDriverWait(self.webdriver, timeout).until_not(
                 until_not(locator)
             )
             return
+        elif self.element_cache is not None:
+            element = self.element_cache.get(self.webdriver, by, location)
         else:
             element = self.webdriver.find_element(*locator)
-        logging.info('元素坐标：{}'.format(element.location))
+        if not StepMode.lean:
+            # 获取坐标需要一次 WebDriver 请求
+            logging.info('元素坐标：%s', element.location)
         self.lutra_elem = Elem(element, self)
         return self.lutra_elem
 
+    def wait_until(self, condition, timeout=None):
+        """
+        等待 condition() 返回真值并返回该值；element_wait 为 observer 时只在 DOM 变化后重新检查，
+        超时时抛出最后一次检查的 AssertionError 或 TimeoutException
+        """
+        timeout = float(timeout or self.timeout)
+        if self.element_wait != 'observer':
+            return WebDriverWait(self.webdriver, timeout).until(lambda x: condition())
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result, error = condition(), None
+            except AssertionError as e:
+                result, error = None, e
+            if result:
+                return result
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if error is not None:
+                    raise error
+                raise TimeoutException('条件在 {} 秒内未满足'.format(timeout))
+            ObserverWait.changed(self, remaining)
+
+    def pause(self, interval=None, extra=0):
+        """
+        操作前的等待：指定 interval 时固定等待 interval + extra 秒；
+        否则在 wait_mode 为 quiet 时等待页面静止，为 fixed 时固定等待 self.interval + extra 秒
+        """
+        if interval is not None or self.wait_mode != 'quiet' or self.webdriver is None:
+            time.sleep(float(self.interval if interval is None else interval) + extra)
+            return
+        QuietWait.wait(self, float(self.interval) + extra)
+
+    def clear_element_cache(self):
+        if self.element_cache is not None:
+            self.element_cache.clear()
+
     @step('关闭并退出浏览器')
     def clean(self, interval=None):
-        interval = float(self.interval if interval is None else interval)
-        time.sleep(interval)
+        self.pause(interval)
+        self.clear_element_cache()
+        if self.pooled:
+            WebDriverPool.release(self)
+            return
+        DevToolsCapture.stop(self.webdriver)
         if self.browser != 'safari':
             try:
                 self.webdriver.close()
@@ -437,9 +965,9 @@ class UIDriver:
 
     @step('访问 URL')
     def goto(self, url=None, interval=None):
-        interval = float(self.interval if interval is None else interval)
-        time.sleep(interval)
+        self.pause(interval)
         url = urljoin(self.base_url, url)
+        self.clear_element_cache()
         self.webdriver.get(url)
         # assert self.webdriver.current_url == url
         return self
@@ -461,8 +989,11 @@ class UIDriver:
         return self
 
     @step('截图')
-    def snapshot(self):
-        attach(self.webdriver.get_screenshot_as_png(), name="截图", attachment_type=attachment_type.PNG)
+    def snapshot(self, elem=None):
+        """
+        截图并附加到报告，指定 elem 时只截取该元素
+        """
+        Screenshots.attach(self.webdriver, "截图", elem.selenium_elem if elem is not None else None)
         return self
 
     @step('获取 Cookies 词典')
@@ -504,11 +1035,13 @@ class UIDriver:
 
     @step('前进')
     def forward(self):
+        self.clear_element_cache()
         self.webdriver.forward()
         return self
 
     @step('后退')
     def back(self):
+        self.clear_element_cache()
         self.webdriver.back()
         return self
 
@@ -516,6 +1049,7 @@ class UIDriver:
     def switch_to_frame(self, elem):
         if isinstance(elem, Elem):
             elem = elem.selenium_elem
+        self.clear_element_cache()
         self.webdriver.switch_to.frame(elem)
         return self
 
@@ -523,6 +1057,7 @@ class UIDriver:
     def switch_to_default_frame(self, elem):
         if isinstance(elem, Elem):
             elem = elem.selenium_elem
+        self.clear_element_cache()
         self.webdriver.switch_to.default_content(elem)
         return self
 
@@ -530,6 +1065,7 @@ class UIDriver:
     def switch_to_parent_frame(self, elem):
         if isinstance(elem, Elem):
             elem = elem.selenium_elem
+        self.clear_element_cache()
         self.webdriver.switch_to.parent_frame(elem)
         return self
 
@@ -581,7 +1117,7 @@ class UIDriver:
     @step('模拟键盘输入')
     @fail_to_snapshot
     def input_keyboard(self, text, interval=None):
-        time.sleep(float(interval or self.interval))
+        self.pause(interval or None)
         ActionChains(self.webdriver).send_keys(text).perform()
         return self
 
@@ -626,6 +1162,515 @@ class UIDriver:
         return self
 
 
+class CachedElement(WebElement):
+    """
+    ElementCache 中的元素，失效（StaleElementReferenceException）时自动重新定位并重试该命令
+    """
+    @classmethod
+    def wrap(cls, element, locator, cache):
+        cached = cls.__new__(cls)
+        cached.__dict__.update(element.__dict__)
+        cached._locator = locator
+        cached._cache = cache
+        return cached
+
+    def resolve(self):
+        element = self._parent.find_element(*self._locator)
+        self._id = element.id
+        self._cache.stale += 1
+        return self
+
+    def _execute(self, command, params=None):
+        try:
+            return super()._execute(command, params)
+        except StaleElementReferenceException:
+            self.resolve()
+            return super()._execute(command, params)
+
+
+class ElementCache:
+    """
+    按定位信息缓存元素，命中时不再发送 find_element 请求；失效的元素由 CachedElement 在使用时透明地重新定位
+
+    goto、刷新、前进后退、切换 iframe 时清空，其他情况下不检查页面：点击链接、JS 跳转等造成的页面变化，
+    由使用旧元素时的 StaleElementReferenceException 发现，并在新页面中重新定位；
+    因此找不到的元素要到使用时才报错，直接调用 webdriver 切换 iframe 后应调用 clear_element_cache
+
+    只缓存不带 until/until_not 的 find；单页应用中被隐藏而未移除的元素不会失效，此类页面不宜开启
+    """
+    def __init__(self):
+        self.elements = dict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, webdriver, by, value):
+        key = by, value.strip()
+        element = self.elements.get(key)
+        if element is not None:
+            self.hits += 1
+            return element
+        self.misses += 1
+        element = self.elements[key] = CachedElement.wrap(webdriver.find_element(by, value), (by, value), self)
+        return element
+
+    def clear(self):
+        self.elements.clear()
+
+    def stats(self):
+        """
+        每次命中省去一次 find_element 请求，每次重新定位（stale）多出一次失败的请求，saved 为实际节省的请求次数
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale, 'size': len(self.elements),
+                'saved': self.hits - self.stale}
+
+
+class TemplateMatch(float):
+    """
+    模版匹配的结果，数值为置信度，与原来返回的置信度兼容；rect 为匹配位置 (x, y, width, height)，scale 为模版的缩放比例
+    """
+    def __new__(cls, confidence, rect=None, scale=1.0):
+        match = super().__new__(cls, confidence)
+        match.rect = rect
+        match.scale = scale
+        return match
+
+    @property
+    def center(self):
+        x, y, width, height = self.rect
+        return x + width // 2, y + height // 2
+
+
+class TemplateMatcher:
+    """
+    模版匹配：按路径和修改时间缓存解码后的灰度模版及其各缩放比例，先在缩小的截图上粗匹配，再在候选位置附近精确匹配
+
+    粗匹配失败时退回全分辨率匹配，结果不会比直接匹配差
+    """
+    max_templates = 64
+    # 每个模版最多缓存的缩放结果数，缩放比例按 scale_digits 位小数取整，截图尺寸变化时不会无限增长
+    max_scales = 16
+    scale_digits = 2
+    # 粗匹配时截图缩小到的宽度，模版缩小后的短边不足 min_coarse_size 像素时直接全分辨率匹配
+    coarse_width = 640
+    min_coarse_size = 12
+    _templates = OrderedDict()
+
+    @classmethod
+    def template(cls, path, scale=1.0):
+        mtime = os.path.getmtime(path)
+        entry = cls._templates.get(path)
+        if entry is None or entry[0] != mtime:
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                raise Exception('无法读取模版图片：{}'.format(path))
+            entry = cls._templates[path] = mtime, image, OrderedDict()
+            while len(cls._templates) > cls.max_templates:
+                cls._templates.popitem(last=False)
+        cls._templates.move_to_end(path)
+        _, image, pyramid = entry
+        scale = max(round(scale, cls.scale_digits), 10 ** -cls.scale_digits)
+        if scale == 1:
+            return image
+        resized = pyramid.get(scale)
+        if resized is None:
+            resized = pyramid[scale] = cv2.resize(image, None, fx=scale, fy=scale,
+                                                  interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+            while len(pyramid) > cls.max_scales:
+                pyramid.popitem(last=False)
+        else:
+            pyramid.move_to_end(scale)
+        return resized
+
+    @staticmethod
+    def _best(src, template, x0=0, y0=0, scale=1.0):
+        _, confidence, _, (x, y) = cv2.minMaxLoc(cv2.matchTemplate(src, template, cv2.TM_CCOEFF_NORMED))
+        height, width = template.shape[:2]
+        return TemplateMatch(confidence, (x0 + x, y0 + y, width, height), scale)
+
+    @classmethod
+    def match(cls, src, path, similarity=0.8, scales=(1.0,), region=None):
+        """
+        在灰度图 src 中查找模版，返回置信度最高的 TemplateMatch
+        """
+        x0 = y0 = 0
+        if region is not None:
+            x0, y0, width, height = (int(v) for v in region)
+            src = src[y0:y0 + height, x0:x0 + width]
+        factor = min(1.0, cls.coarse_width / src.shape[1]) if src.size else 1.0
+        coarse = cv2.resize(src, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA) if factor < 1 else None
+        best, coarse_used = TemplateMatch(-1.0), False
+        for scale in sorted(scales, key=lambda s: abs(s - 1)):
+            template = cls.template(path, scale)
+            height, width = template.shape[:2]
+            if height > src.shape[0] or width > src.shape[1]:
+                continue
+            coarse_template = cls.template(path, scale * factor) \
+                if coarse is not None and min(height, width) * factor >= cls.min_coarse_size else None
+            if coarse_template is not None and coarse_template.shape[0] <= coarse.shape[0] and \
+                    coarse_template.shape[1] <= coarse.shape[1]:
+                coarse_used = True
+                candidate = cls._best(coarse, coarse_template)
+                # 在粗匹配位置附近的窗口中精确匹配
+                pad = int(2 / factor) + 2
+                left = max(int(candidate.rect[0] / factor) - pad, 0)
+                top = max(int(candidate.rect[1] / factor) - pad, 0)
+                right = min(left + width + 2 * pad, src.shape[1])
+                bottom = min(top + height + 2 * pad, src.shape[0])
+                left, top = min(left, right - width), min(top, bottom - height)
+                match = cls._best(src[top:bottom, left:right], template, x0 + left, y0 + top, scale)
+            else:
+                match = cls._best(src, template, x0, y0, scale)
+            if match > best:
+                best = match
+            if best >= similarity:
+                return best
+        if coarse_used:
+            # 粗匹配可能选错位置，失败前在全分辨率上确认一遍
+            for scale in scales:
+                template = cls.template(path, scale)
+                if template.shape[0] <= src.shape[0] and template.shape[1] <= src.shape[1]:
+                    match = cls._best(src, template, x0, y0, scale)
+                    if match > best:
+                        best = match
+                    if best >= similarity:
+                        break
+        return best
+
+
+class QuietWait:
+    """
+    自适应的操作前等待：在页面中注入脚本，统计未完成的 fetch/XHR、正在播放的有限动画和最近一次 DOM 变化，
+    等到文档加载完成、没有未完成的请求和动画、且 DOM 静止 quiet 秒后立即返回，最多等待 timeout 秒
+
+    stats 累计实际等待时间和原本固定等待的时间，report() 返回节省的时间
+    """
+    quiet = 0.05
+    timeout = 5
+    stats = {'waits': 0, 'waited': 0.0, 'fixed': 0.0, 'timeouts': 0}
+    script = """
+        var done = arguments[arguments.length - 1], quiet = arguments[0], timeout = arguments[1];
+        var start = Date.now(), q = window.__lutraQuiet;
+        if (!q) {
+            q = window.__lutraQuiet = {pending: 0, last: start};
+            var settle = function () { q.pending = Math.max(q.pending - 1, 0); q.last = Date.now(); };
+            if (window.fetch) {
+                var fetch = window.fetch;
+                window.fetch = function () {
+                    q.pending++;
+                    try {
+                        return fetch.apply(this, arguments).then(
+                            function (r) { settle(); return r; }, function (e) { settle(); throw e; });
+                    } catch (e) { settle(); throw e; }
+                };
+            }
+            var send = XMLHttpRequest.prototype.send;
+            XMLHttpRequest.prototype.send = function () {
+                q.pending++;
+                this.addEventListener('loadend', settle);
+                try { return send.apply(this, arguments); } catch (e) { settle(); throw e; }
+            };
+            new MutationObserver(function () { q.last = Date.now(); }).observe(
+                document, {subtree: true, childList: true, attributes: true, characterData: true});
+        }
+        var animating = function () {
+            // 无限循环的动画（如加载图标）不算
+            return document.getAnimations && document.getAnimations().some(function (a) {
+                return a.playState === 'running' && a.effect && isFinite(a.effect.getComputedTiming().endTime);
+            });
+        };
+        (function check() {
+            var now = Date.now();
+            if (document.readyState === 'complete' && q.pending === 0 && !animating() && now - q.last >= quiet) {
+                done(true);
+            } else if (now - start >= timeout) {
+                done(false);
+            } else {
+                setTimeout(check, 10);
+            }
+        })();
+    """
+
+    @classmethod
+    def wait(cls, ui_driver, fixed):
+        start = time.perf_counter()
+        try:
+            quiet = ui_driver.webdriver.execute_async_script(cls.script, cls.quiet * 1000, cls.timeout * 1000)
+        except Exception as e:
+            # 脚本无法执行（如弹窗、非 HTML 页面）时退回固定等待
+            logging.info('Quiet wait failed, fall back to fixed interval: %s', brief(e))
+            time.sleep(fixed)
+            quiet = True
+        waited = time.perf_counter() - start
+        cls.stats['waits'] += 1
+        cls.stats['waited'] += waited
+        cls.stats['fixed'] += fixed
+        cls.stats['timeouts'] += not quiet
+        if not quiet:
+            logging.warning('Page did not become quiet in %ss.', cls.timeout)
+        return waited
+
+    @classmethod
+    def report(cls):
+        """
+        返回累计的等待次数、实际等待秒数、固定等待秒数、节省的秒数和超时次数
+        """
+        return dict(cls.stats, saved=cls.stats['fixed'] - cls.stats['waited'])
+
+
+class ObserverWait:
+    """
+    在页面中用 MutationObserver 等待元素状态，一次异步脚本调用在条件满足的同时返回，
+    代替 WebDriverWait 每 0.5 秒一次的 WebDriver 请求；DOM 之外的变化（如样式表加载）每 100 毫秒补充检查一次
+    """
+    conditions = {
+        Expect.exist: 'exist',
+        Expect.visible: 'visible',
+        Expect.invisible: 'invisible',
+        Expect.clickable: 'clickable',
+        Expect.selected: 'selected',
+    }
+    script = """
+        var args = arguments, done = args[args.length - 1];
+        var by = args[0], value = args[1], condition = args[2], negate = args[3], timeout = args[4];
+        var links = function (match) {
+            return Array.prototype.filter.call(document.getElementsByTagName('a'), function (a) {
+                return match(a.innerText.trim());
+            })[0] || null;
+        };
+        var find = function () {
+            switch (by) {
+                case 'xpath':
+                    return document.evaluate(value, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null)
+                        .singleNodeValue;
+                case 'css selector': return document.querySelector(value);
+                case 'id': return document.getElementById(value);
+                case 'name': return document.getElementsByName(value)[0] || null;
+                case 'class name': return document.getElementsByClassName(value)[0] || null;
+                case 'tag name': return document.getElementsByTagName(value)[0] || null;
+                case 'link text': return links(function (text) { return text === value; });
+                case 'partial link text': return links(function (text) { return text.indexOf(value) >= 0; });
+            }
+        };
+        var visible = function (el) {
+            var rect = el.getBoundingClientRect(), style = window.getComputedStyle(el);
+            return rect.width > 0 && rect.height > 0 && style.visibility !== 'hidden' && style.display !== 'none';
+        };
+        var check = function () {
+            var el = find(), met;
+            switch (condition) {
+                case 'exist': met = !!el; break;
+                case 'visible': met = !!el && visible(el); break;
+                case 'invisible': met = !el || !visible(el); break;
+                case 'clickable': met = !!el && visible(el) && !el.disabled; break;
+                case 'selected': met = !!el && !!(el.selected || el.checked); break;
+            }
+            return negate ? !met : met ? el || true : false;
+        };
+        var observer, timer, poll;
+        var finish = function (result) {
+            if (observer) observer.disconnect();
+            clearTimeout(timer);
+            clearInterval(poll);
+            done(result);
+        };
+        var result = check();
+        if (result) return done(result);
+        observer = new MutationObserver(function () { var result = check(); if (result) finish(result); });
+        observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+        poll = setInterval(function () { var result = check(); if (result) finish(result); }, 100);
+        timer = setTimeout(function () { finish(check() || null); }, timeout);
+    """
+    changed_script = """
+        var done = arguments[arguments.length - 1], timer;
+        var observer = new MutationObserver(function () { observer.disconnect(); clearTimeout(timer); done(true); });
+        observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+        timer = setTimeout(function () { observer.disconnect(); done(false); }, arguments[0]);
+    """
+    # chromedriver 缺省的异步脚本超时为 30 秒
+    _script_timeouts = dict()
+
+    @classmethod
+    def _run(cls, ui_driver, seconds, script, *args):
+        webdriver = ui_driver.webdriver
+        if seconds + 1 > cls._script_timeouts.get(id(webdriver), 30):
+            webdriver.set_script_timeout(seconds + 5)
+            cls._script_timeouts[id(webdriver)] = seconds + 5
+        return webdriver.execute_async_script(script, *args)
+
+    @classmethod
+    def until(cls, ui_driver, by, value, condition, negate=False, timeout=None):
+        """
+        等待 (by, value) 定位的第一个元素满足 condition（取反时不满足），返回该元素或 True
+        """
+        timeout = float(timeout or ui_driver.timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                result = cls._run(ui_driver, remaining, cls.script, by, value, condition, negate,
+                                  max(remaining, 0) * 1000)
+            except WebDriverException as e:
+                # 页面跳转会中断异步脚本，在新页面上继续等待
+                if isinstance(e, TimeoutException) or time.monotonic() >= deadline:
+                    raise
+                logging.info('Observer wait interrupted, retrying: %s', brief(e))
+                time.sleep(0.05)
+                continue
+            if result:
+                return result
+            raise TimeoutException('元素在 {} 秒内未{}满足条件 {}：{} = {}'.format(
+                timeout, '不' if negate else '', condition, by, value))
+
+    @classmethod
+    def changed(cls, ui_driver, timeout):
+        """
+        等到页面下一次 DOM 变化，最多等待 timeout 秒，且不超过 1 秒，以便检查 DOM 之外的变化
+        """
+        timeout = min(timeout, 1)
+        try:
+            return cls._run(ui_driver, timeout, cls.changed_script, timeout * 1000)
+        except WebDriverException:
+            time.sleep(0.05)
+            return True
+
+
+class WebDriverPool:
+    """
+    进程级的浏览器池，按 (浏览器, 无头模式, 窗口尺寸, 设备, 代理等) 保存已启动的浏览器
+
+    UIDriver(pooled=True) 时从池中借用，clean 时快速重置后归还：关闭多余窗口，通过 DevTools 协议清空所有 Cookies，
+    以及各窗口历史记录和当前 iframe 中所有源的 Storage，再打开 about:blank；之前页面中 iframe 的源无法枚举，由 max_uses 限制影响范围
+
+    只有本地 Chrome（execute_cdp_cmd）可以彻底重置，其他浏览器 clean 时直接退出；使用 max_uses 次或重置失败的浏览器也会被退出
+    """
+    max_uses = int(os.environ.get('LUTRA_DRIVER_MAX_USES', 50))
+    max_idle = int(os.environ.get('LUTRA_DRIVER_MAX_IDLE', 2))
+    _idle = dict()
+    _uses = dict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def key(ui_driver):
+        return (ui_driver.browser, ui_driver.headless, ui_driver.width, ui_driver.height, ui_driver.mobile_device,
+                ui_driver.proxy, ui_driver.bypass, ui_driver.user_agent, ui_driver.remote_server,
+                ui_driver.remote_browser, ui_driver.devtools)
+
+    @classmethod
+    def prestart(cls, count=1, **kwargs):
+        """
+        预先启动 count 个浏览器放入池中，kwargs 与 UIDriver 的参数相同
+        """
+        cls.max_idle = max(cls.max_idle, count)
+        for ui_driver in [UIDriver(pooled=True, **kwargs) for _ in range(count)]:
+            ui_driver.clean(0)
+
+    @classmethod
+    def borrow(cls, ui_driver):
+        key = cls.key(ui_driver)
+        while True:
+            with cls._lock:
+                idle = cls._idle.get(key)
+                driver = idle.pop() if idle else None
+            if driver is None:
+                driver = ui_driver.launch()
+                cls._uses[id(driver)] = 0
+                logging.info('Launched browser for pool, key: %s.', brief(key))
+                return driver
+            if cls._healthy(driver):
+                return driver
+            cls._quit(driver)
+
+    @classmethod
+    def release(cls, ui_driver):
+        driver, ui_driver.webdriver = ui_driver.webdriver, None
+        if driver is None:
+            return
+        uses = cls._uses.get(id(driver), 0) + 1
+        cls._uses[id(driver)] = uses
+        if uses >= cls.max_uses or not hasattr(driver, 'execute_cdp_cmd') or not cls._reset(driver, ui_driver):
+            cls._quit(driver)
+            return
+        with cls._lock:
+            idle = cls._idle.setdefault(cls.key(ui_driver), [])
+            if len(idle) < cls.max_idle:
+                idle.append(driver)
+                return
+        cls._quit(driver)
+
+    @staticmethod
+    def _healthy(driver):
+        try:
+            driver.current_window_handle
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _origins(driver):
+        """
+        当前窗口的历史记录和当前各 iframe 中的源
+        """
+        urls = [entry['url'] for entry in driver.execute_cdp_cmd('Page.getNavigationHistory', {})['entries']]
+        frames = [driver.execute_cdp_cmd('Page.getFrameTree', {})['frameTree']]
+        while frames:
+            frame = frames.pop()
+            urls.append(frame['frame']['url'])
+            frames.extend(frame.get('childFrames', ()))
+        return {'{}://{}'.format(*urlsplit(url)[:2]) for url in urls if url.startswith(('http://', 'https://'))}
+
+    @classmethod
+    def _reset(cls, driver, ui_driver):
+        try:
+            handles = driver.window_handles
+            origins = set()
+            for handle in handles[::-1]:
+                driver.switch_to.window(handle)
+                origins |= cls._origins(driver)
+                if handle != handles[0]:
+                    driver.close()
+            for origin in sorted(origins):
+                # sessionStorage 属于窗口，Storage.clearDataForOrigin 不包括
+                driver.execute_cdp_cmd('DOMStorage.clear', {
+                    'storageId': {'securityOrigin': origin, 'isLocalStorage': False}
+                })
+                driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            driver.get('about:blank')
+            capture = DevToolsCapture.of(driver)
+            if capture is not None:
+                capture.clear()
+            if not ui_driver.mobile_device:
+                driver.set_window_size(ui_driver.width, ui_driver.height)
+            return True
+        except Exception as e:
+            logging.warning('Failed to reset pooled browser: %s', brief(e))
+            return False
+
+    @classmethod
+    def _quit(cls, driver):
+        cls._uses.pop(id(driver), None)
+        DevToolsCapture.stop(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @classmethod
+    def close_all(cls):
+        """
+        退出池中所有空闲的浏览器
+        """
+        with cls._lock:
+            drivers = [driver for idle in cls._idle.values() for driver in idle]
+            cls._idle.clear()
+        for driver in drivers:
+            cls._quit(driver)
+
+
+atexit.register(WebDriverPool.close_all)
+
+
 class Elem:
     """
     页面元素类, 支持流式调用
@@ -643,13 +1688,12 @@ class Elem:
         return self.driver.find(*args, **kwargs)
 
     def snapshot(self):
-        self.driver.snapshot()
+        self.driver.snapshot(self if Screenshots.scope == 'element' else None)
 
     @fail_to_snapshot
     @step('select 选择选项')
     def select(self, value=None, index=None, visible_text=None, interval=None):
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         select = Select(self.selenium_elem)
         if value:
             select.select_by_value(value)
@@ -662,8 +1706,7 @@ class Elem:
     @fail_to_snapshot
     @step('select 反选选项')
     def deselect(self, deselect_all=False, value=None, index=None, visible_text=None, interval=None):
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         select = Select(self.selenium_elem)
         if deselect_all:
             select.deselect_all()
@@ -682,8 +1725,7 @@ class Elem:
         鼠标悬停
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         if xoffset is not None and yoffset is not None:
             ActionChains(
                 self.driver.webdriver
@@ -701,8 +1743,7 @@ class Elem:
         清空文本框
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         self.selenium_elem.clear()
         return self
 
@@ -713,8 +1754,7 @@ class Elem:
         清空文本框
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         length = len(self.selenium_elem.get_attribute('value'))
         self.selenium_elem.send_keys(length * Keys.BACKSPACE)
         return self
@@ -726,8 +1766,7 @@ class Elem:
         输入文字
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         self.selenium_elem.send_keys(text)
         return self
 
@@ -738,8 +1777,7 @@ class Elem:
         :return: Elem 对象自身
         """
         with step('输入敏感文字'):
-            interval = float(self.driver.interval if interval is None else interval)
-            time.sleep(interval)
+            self.driver.pause(interval)
             self.selenium_elem.send_keys(sensitive_text)
         return self
 
@@ -750,8 +1788,7 @@ class Elem:
         按键
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         self.selenium_elem.send_keys(times * getattr(Keys, key_text.upper()))
         return self
 
@@ -762,8 +1799,7 @@ class Elem:
         点击
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         self.selenium_elem.click()
         return self
 
@@ -774,8 +1810,7 @@ class Elem:
         点击
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         ActionChains(self.driver.webdriver).click(None if no_element else self.selenium_elem).perform()
         # driver.webdriver.execute_script("$(arguments[0]).click();", self.selenium_elem)
         return self
@@ -787,8 +1822,7 @@ class Elem:
         点击
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(1 + interval)
+        self.driver.pause(interval, extra=1)
         TouchActions(self.driver.webdriver).tap(self.selenium_elem).perform()
         return self
 
@@ -799,8 +1833,7 @@ class Elem:
         点击
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         TouchActions(self.driver.webdriver).long_press(self.selenium_elem).perform()
         # driver.webdriver.execute_script("$(arguments[0]).click();", self.selenium_elem)
         return self
@@ -812,8 +1845,7 @@ class Elem:
         Selenium 原生拖拽
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         ActionChains(self.driver.webdriver).\
             drag_and_drop(self.selenium_elem, lutra_elem_to_drop.selenium_elem).\
             perform()
@@ -826,8 +1858,7 @@ class Elem:
         Selenium 原生拖拽
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         ActionChains(self.driver.webdriver).drag_and_drop_by_offset(self.selenium_elem, xoffset, yoffset).perform()
         return self
 
@@ -838,17 +1869,16 @@ class Elem:
         Lutra 拖拽
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         action = ActionChains(self.driver.webdriver)
         action.move_to_element(self.selenium_elem). \
             click_and_hold(self.selenium_elem). \
-            pause(interval)
+            pause(float(self.driver.interval if interval is None else interval))
         for i in range(xoffset):
-            logging.info("横向第 {} 次移动".format(i))
+            logging.info("横向第 %s 次移动", i)
             action.move_by_offset(i, 0).perform()
         for i in range(yoffset):
-            logging.info("纵向第 {} 次移动".format(i))
+            logging.info("纵向第 %s 次移动", i)
             action.move_by_offset(0, i).perform()
         action.release(self.selenium_elem).perform()
         return self
@@ -860,12 +1890,11 @@ class Elem:
         Lutra 拖拽
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         action = ActionChains(self.driver.webdriver)
         action.move_to_element(self.selenium_elem). \
             click_and_hold(self.selenium_elem). \
-            pause(interval)
+            pause(float(self.driver.interval if interval is None else interval))
         if xoffset is None and yoffset is None:
             action.move_to_element(lutra_elem_to_drop.selenium_elem)
         else:
@@ -880,8 +1909,7 @@ class Elem:
         Lutra 拖拽
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
 
         src = self.selenium_elem.location
         dest = lutra_elem_to_drop.selenium_elem.location
@@ -902,8 +1930,7 @@ class Elem:
         Lutra 拖拽
         :return: Elem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
 
         src = self.selenium_elem.location
         src_x, src_y = int(src['x']), int(src['y'])
@@ -926,32 +1953,31 @@ class Elem:
         提交
         :return: LutraElem 对象自身
         """
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
         self.selenium_elem.submit()
         return self
 
     @fail_to_snapshot
     @step('切换到 iframe')
     def switch_to_frame(self, interval=None):
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
+        self.driver.clear_element_cache()
         self.webdriver.switch_to.frame(self.selenium_elem)
         return self
 
     @fail_to_snapshot
     @step('切换到缺省 iframe')
     def switch_to_default_frame(self, interval=None):
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
+        self.driver.clear_element_cache()
         self.webdriver.switch_to.default_content(self.selenium_elem)
         return self
 
     @fail_to_snapshot
     @step('切换到父 iframe')
     def switch_to_parent_frame(self, interval=None):
-        interval = float(self.driver.interval if interval is None else interval)
-        time.sleep(interval)
+        self.driver.pause(interval)
+        self.driver.clear_element_cache()
         self.webdriver.switch_to.parent_frame(self.selenium_elem)
         return self
 
@@ -978,14 +2004,14 @@ class Elem:
         """
         断言 key should be True
         """
-        logging.info('Asserting {} be True'.format(key))
+        logging.info('Asserting %s be True', key)
         if key in ('id', 'text', 'tag_name', 'size', 'is_displayed', 'is_enabled', 'is_selected'):
-            WebDriverWait(self.webdriver, int(timeout or self.driver.timeout)).until(
-                lambda x: getattr(self.selenium_elem, key) is not False
+            self.driver.wait_until(
+                lambda: getattr(self.selenium_elem, key) is not False, timeout
             )
         else:
-            WebDriverWait(self.webdriver, int(timeout or self.driver.timeout)).until(
-                lambda x: self.selenium_elem.get_attribute(key) is not False
+            self.driver.wait_until(
+                lambda: self.selenium_elem.get_attribute(key) is not False, timeout
             )
         return self
 
@@ -994,14 +2020,14 @@ class Elem:
         """
         断言 key should contain value
         """
-        logging.info('Asserting {} contains {}'.format(key, value))
+        logging.info('Asserting %s contains %s', key, brief(value))
         if key in ('id', 'text', 'tag_name', 'size', 'is_displayed', 'is_enabled', 'is_selected'):
-            WebDriverWait(self.webdriver, int(timeout or self.driver.timeout)).until(
-                lambda x: value in getattr(self.selenium_elem, key)
+            self.driver.wait_until(
+                lambda: value in getattr(self.selenium_elem, key), timeout
             )
         else:
-            WebDriverWait(self.webdriver, int(timeout or self.driver.timeout)).until(
-                lambda x: value in self.selenium_elem.get_attribute(key)
+            self.driver.wait_until(
+                lambda: value in self.selenium_elem.get_attribute(key), timeout
             )
         return self
 
@@ -1010,14 +2036,14 @@ class Elem:
         """
         断言 key should be value
         """
-        logging.info('Asserting {} be {}'.format(key, value))
+        logging.info('Asserting %s be %s', key, brief(value))
         if key in ('id', 'text', 'tag_name', 'size', 'is_displayed', 'is_enabled', 'is_selected'):
-            WebDriverWait(self.webdriver, int(timeout or self.driver.timeout)).until(
-                lambda x: getattr(self.selenium_elem, key) == value
+            self.driver.wait_until(
+                lambda: getattr(self.selenium_elem, key) == value, timeout
             )
         else:
-            WebDriverWait(self.webdriver, int(timeout or self.driver.timeout)).until(
-                lambda x: self.selenium_elem.get_attribute(key) == value
+            self.driver.wait_until(
+                lambda: self.selenium_elem.get_attribute(key) == value, timeout
             )
         return self
 
@@ -1049,6 +2075,45 @@ class Arrangement:
         self.driver.interval = interval
         return self
 
+    @step('设置操作前的等待方式')
+    def wait_mode(self, wait_mode):
+        """
+        fixed：固定等待 interval 秒；quiet：等待页面静止（见 QuietWait）
+        """
+        assert wait_mode in ('fixed', 'quiet')
+        self.driver.wait_mode = wait_mode
+        return self
+
+    @step('开启或关闭元素缓存')
+    def element_cache(self, enabled=True):
+        """
+        开启后重复使用同一定位信息时直接返回缓存的元素，见 ElementCache
+        """
+        self.driver.element_cache = ElementCache() if enabled else None
+        return self
+
+    @step('开启或关闭 DevTools 日志收集')
+    def devtools(self, enabled=True):
+        """
+        开启后持续收集控制台和网络记录，失败时附加最近的记录，见 DevToolsCapture
+        """
+        self.driver.devtools = enabled
+        if self.driver.webdriver is not None:
+            if enabled:
+                DevToolsCapture.start(self.driver.webdriver)
+            else:
+                DevToolsCapture.stop(self.driver.webdriver)
+        return self
+
+    @step('设置等待元素的方式')
+    def element_wait(self, element_wait):
+        """
+        poll：WebDriverWait 轮询；observer：在页面中用 MutationObserver 等待（见 ObserverWait）
+        """
+        assert element_wait in ('poll', 'observer')
+        self.driver.element_wait = element_wait
+        return self
+
     @step('设置浏览器')
     def browser(self, browser):
         self.driver.browser = browser
@@ -1110,14 +2175,18 @@ class Assertion:
         self.elem = elem
         self.selenium_elem = elem.selenium_elem
 
+    def _wait(self, check, timeout):
+        if self.elem.driver.element_wait == 'observer':
+            self.elem.driver.wait_until(lambda: check() or True, timeout)
+        else:
+            WebDriverWait(self.elem.webdriver, timeout).until(lambda x: Assert.bool(check()))
+
     @step
     def id(self, assert_method, timeout=None):
         logging.info('Assert id:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.id))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.id), timeout)
         else:
             assert_method(self.selenium_elem.id)
         return self
@@ -1125,11 +2194,9 @@ class Assertion:
     @step
     def displayed_text(self, assert_method, timeout=None):
         logging.info('Assert text:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.text))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.text), timeout)
         else:
             assert_method(self.selenium_elem.text)
         return self
@@ -1137,11 +2204,9 @@ class Assertion:
     @step
     def text(self, assert_method, timeout=None):
         logging.info('Assert text:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.get_attribute('innerText').strip()))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.get_attribute('innerText').strip()), timeout)
         else:
             assert_method(self.selenium_elem.get_attribute('innerText').strip())
         return self
@@ -1149,11 +2214,9 @@ class Assertion:
     @step
     def tag_name(self, assert_method, timeout=None):
         logging.info('Assert tag_name:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.tag_name))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.tag_name), timeout)
         else:
             assert_method(self.selenium_elem.tag_name)
         return self
@@ -1161,11 +2224,9 @@ class Assertion:
     @step
     def size(self, assert_method, timeout=None):
         logging.info('Assert size:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.size))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.size), timeout)
         else:
             assert_method(self.selenium_elem.size)
         return self
@@ -1173,11 +2234,9 @@ class Assertion:
     @step
     def displayed(self, assert_method, timeout=None):
         logging.info('Assert displayed:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.is_displayed))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.is_displayed), timeout)
         else:
             assert_method(self.selenium_elem.is_displayed)
         return self
@@ -1185,11 +2244,9 @@ class Assertion:
     @step
     def enabled(self, assert_method, timeout=None):
         logging.info('Assert enabled:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.is_enabled()))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.is_enabled()), timeout)
         else:
             assert_method(self.selenium_elem.is_enabled)
         return self
@@ -1197,11 +2254,9 @@ class Assertion:
     @step
     def selected(self, assert_method, timeout=None):
         logging.info('Assert selected:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.is_selected()))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.is_selected()), timeout)
         else:
             assert_method(self.selenium_elem.is_selected)
         return self
@@ -1209,11 +2264,9 @@ class Assertion:
     @step
     def attribute(self, assert_method, key, timeout=None):
         logging.info('Assert attribute:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(self.selenium_elem.get_attribute(key)))
-            )
+            self._wait(lambda: assert_method(self.selenium_elem.get_attribute(key)), timeout)
         else:
             assert_method(self.selenium_elem.get_attribute(key))
         return self
@@ -1221,11 +2274,9 @@ class Assertion:
     @step
     def all_selected_options_text(self, assert_method, timeout=None):
         logging.info('Assert all_selected_options_text:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(Select(self.selenium_elem).all_selected_options))
-            )
+            self._wait(lambda: assert_method(Select(self.selenium_elem).all_selected_options), timeout)
         else:
             assert_method(self.selenium_elem.all_selected_options)
         return self
@@ -1233,11 +2284,9 @@ class Assertion:
     @step
     def first_selected_option_text(self, assert_method, timeout=None):
         logging.info('Assert first_selected_option_text:')
-        timeout = int(timeout or self.elem.driver.timeout)
+        timeout = float(timeout or self.elem.driver.timeout)
         if timeout:
-            WebDriverWait(self.elem.webdriver, timeout).until(
-                lambda x: Assert.bool(assert_method(Select(self.selenium_elem).first_selected_option.text))
-            )
+            self._wait(lambda: assert_method(Select(self.selenium_elem).first_selected_option.text), timeout)
         else:
             assert_method(self.selenium_elem.first_selected_option.text)
         return self
@@ -1298,3 +2347,183 @@ class Extraction:
         s = Select(self.selenium_elem)
         return s.first_selected_option.text
 
+
+class Elems:
+    """
+    find_all 找到的一组元素，快照中的数据在本地断言和提取，不再逐个元素发送 WebDriver 请求
+
+    快照中每个元素是一个词典：text、tag_name、rect、displayed、enabled、selected，
+    以及 attributes（find_all/refresh 指定的特性）
+    """
+    script = """
+        var by = arguments[0], value = arguments[1], keys = arguments[2], elements = arguments[3];
+        function findAll(by, value, root) {
+            var found;
+            switch (by) {
+                case 'xpath':
+                    found = [];
+                    var result = document.evaluate(value, root, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+                    for (var i = 0; i < result.snapshotLength; i++) found.push(result.snapshotItem(i));
+                    break;
+                case 'css selector': found = root.querySelectorAll(value); break;
+                case 'id':
+                    found = Array.prototype.filter.call(root.querySelectorAll('[id]'), function (el) {
+                        return el.id === value;
+                    });
+                    break;
+                case 'name':
+                    found = Array.prototype.filter.call(root.querySelectorAll('[name]'), function (el) {
+                        return el.getAttribute('name') === value;
+                    });
+                    break;
+                case 'class name': found = root.getElementsByClassName(value); break;
+                case 'tag name': found = root.getElementsByTagName(value); break;
+                case 'link text':
+                case 'partial link text':
+                    found = Array.prototype.filter.call(root.getElementsByTagName('a'), function (a) {
+                        var text = a.innerText.trim();
+                        return by === 'link text' ? text === value : text.indexOf(value) >= 0;
+                    });
+                    break;
+            }
+            return Array.prototype.slice.call(found);
+        }
+        if (!elements) {
+            if (by === 'lutra chain') {
+                // 分步查找：前面的步骤各取第一个元素作为范围，最后一步取所有元素
+                var root = document;
+                for (var n = 0; root && n < value.length - 1; n++) root = findAll(value[n][0], value[n][1], root)[0];
+                elements = root ? findAll(value[value.length - 1][0], value[value.length - 1][1], root) : [];
+            } else {
+                elements = findAll(by, value, document);
+            }
+        }
+        var snapshots = elements.map(function (el) {
+            var rect = el.getBoundingClientRect(), style = window.getComputedStyle(el), attributes = {};
+            keys.forEach(function (key) {
+                var value = el[key];
+                attributes[key] = value === undefined || value === null || typeof value === 'object' ||
+                    typeof value === 'function' ? el.getAttribute(key) : value;
+            });
+            return {
+                text: (el.innerText || '').trim(),
+                tag_name: el.tagName.toLowerCase(),
+                rect: {x: rect.left + window.pageXOffset, y: rect.top + window.pageYOffset,
+                       width: rect.width, height: rect.height},
+                displayed: rect.width > 0 && rect.height > 0 && style.visibility !== 'hidden' &&
+                    style.display !== 'none',
+                enabled: !el.disabled,
+                selected: !!(el.selected || el.checked),
+                attributes: attributes
+            };
+        });
+        return [elements, snapshots];
+    """
+    fields = ('text', 'tag_name', 'rect', 'displayed', 'enabled', 'selected')
+
+    def __init__(self, driver: UIDriver, locator, attributes=()):
+        self.driver = driver
+        self.locator = locator
+        self.attributes = tuple(attributes)
+        self.selenium_elems = []
+        self.snapshots = []
+
+    def refresh(self, *attributes):
+        """
+        重新查找元素并更新快照，一次 WebDriver 请求
+        """
+        self.attributes += tuple(key for key in attributes if key not in self.attributes)
+        self.selenium_elems, self.snapshots = self.driver.webdriver.execute_script(
+            self.script, self.locator[0], self.locator[1], list(self.attributes), None
+        )
+        return self
+
+    def __len__(self):
+        return len(self.selenium_elems)
+
+    def __iter__(self):
+        return (Elem(element, self.driver) for element in self.selenium_elems)
+
+    def __getitem__(self, index):
+        return Elem(self.selenium_elems[index], self.driver)
+
+    def values(self, key='text'):
+        """
+        所有元素快照中 key 的值，key 不是快照的字段时取 attributes 中的特性
+        """
+        if key not in self.fields and key not in self.attributes:
+            self.refresh(key)
+        if key in self.fields:
+            return [snapshot[key] for snapshot in self.snapshots]
+        return [snapshot['attributes'][key] for snapshot in self.snapshots]
+
+    @step('开始提取')
+    def extraction(self):
+        return ElemsExtraction(self)
+
+    @step('开始断言')
+    def assertion(self):
+        return ElemsAssertion(self)
+
+
+class ElemsAssertion:
+    def __init__(self, elems: Elems):
+        self.elems = elems
+
+    def _check(self, check, timeout=None):
+        # observer 模式下断言失败时，每次 DOM 变化后重新查找并断言，直到超时
+        driver = self.elems.driver
+        if driver.element_wait != 'observer':
+            check()
+            return
+
+        def refresh_and_check():
+            self.elems.refresh()
+            return check() or True
+        try:
+            check()
+        except AssertionError:
+            driver.wait_until(refresh_and_check, timeout)
+
+    @step
+    def count(self, assert_method, timeout=None):
+        logging.info('Assert count:')
+        self._check(lambda: assert_method(len(self.elems)), timeout)
+        return self
+
+    @step
+    def values(self, assert_method, key='text', timeout=None):
+        logging.info('Assert values of %s:', key)
+        self._check(lambda: assert_method(self.elems.values(key)), timeout)
+        return self
+
+    @step
+    def each(self, assert_method, key='text', timeout=None):
+        """
+        对每个元素的 key 执行断言，只记录一个步骤
+        """
+        logging.info('Assert each %s:', key)
+        check = getattr(assert_method, '__wrapped__', assert_method)
+        self._check(lambda: [check(value) for value in self.elems.values(key)], timeout)
+        return self
+
+    @step
+    def action(self):
+        return self.elems
+
+
+class ElemsExtraction:
+    def __init__(self, elems: Elems):
+        self.elems = elems
+
+    @step
+    def count(self):
+        return len(self.elems)
+
+    @step
+    def values(self, key='text'):
+        return self.elems.values(key)
+
+    @step
+    def snapshots(self):
+        return self.elems.snapshots
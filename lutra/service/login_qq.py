@@ -1,13 +1,140 @@
 # coding:utf-8
-from lutra.driver.selenium import UIDriver
-from lutra.page.qqlogin_page import QQLoginPage
+import os
+import json
+import time
+import hashlib
+import requests
+from lutra.driver.requests import HTTPDriver
+from lutra.util import logging, step, file_lock
+
+
+class SessionCache:
+    """
+    登录态的磁盘缓存，按 (uid, base_url) 保存 Cookies 及其过期时间，在多次运行和 pytest-xdist 的各个 worker 之间共享
+
+    缓存目录由环境变量 LUTRA_SESSION_CACHE 指定，缺省为当前目录下的 .lutra_sessions
+    """
+    directory = os.environ.get('LUTRA_SESSION_CACHE', '.lutra_sessions')
+    # 登录态最多复用的秒数，登录凭据的 Cookies 更早过期时以其为准
+    max_age = 3600
+    # 决定登录态是否有效的 Cookies（QQ 登录），其他 Cookies（如统计用的短期 Cookies）的过期时间不影响缓存
+    auth_cookies = ('uin', 'skey', 'p_uin', 'p_skey', 'pt4_token')
+
+    @classmethod
+    def _path(cls, uid, base_url):
+        key = hashlib.sha1('{}\n{}'.format(uid, base_url or '').encode('utf-8')).hexdigest()
+        return os.path.join(cls.directory, key)
+
+    @classmethod
+    def lock(cls, uid, base_url, timeout=None):
+        """
+        同一个账号同一时间只允许一个进程登录
+        """
+        return file_lock(cls._path(uid, base_url) + '.lock', timeout)
+
+    @classmethod
+    def load(cls, uid, base_url):
+        """
+        返回未过期的 Cookies 列表，没有缓存或已过期时返回 None
+        """
+        try:
+            with open(cls._path(uid, base_url) + '.json', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires', 0) <= time.time():
+            return None
+        return entry['cookies']
+
+    @classmethod
+    def expires(cls, cookie_list, auth_cookies=None):
+        """
+        缓存的过期时间：登录凭据 Cookies 中最早的过期时间，最长 max_age 秒
+        """
+        names = set(auth_cookies or cls.auth_cookies)
+        expiries = [item['expiry'] for item in cookie_list if item.get('expiry') and item['name'] in names]
+        return min(expiries + [time.time() + cls.max_age])
+
+    @classmethod
+    def save(cls, uid, base_url, cookie_list, auth_cookies=None):
+        expires = cls.expires(cookie_list, auth_cookies)
+        path = cls._path(uid, base_url) + '.json'
+        os.makedirs(cls.directory, exist_ok=True)
+        # 先写临时文件再替换，其他进程不会读到写了一半的文件；缓存中有登录凭据，只允许当前用户读写
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+            json.dump({'uid': str(uid), 'base_url': base_url, 'expires': expires, 'cookies': cookie_list}, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def invalidate(cls, uid, base_url):
+        try:
+            os.remove(cls._path(uid, base_url) + '.json')
+        except OSError:
+            pass
 
 
 class LoginService:
     @staticmethod
-    def login(http_driver, uid, password, browser='Chrome'):
+    def _apply(http_driver, cookie_list):
+        requests.utils.add_dict_to_cookiejar(
+            http_driver.session.cookies, {item['name']: item['value'] for item in cookie_list}
+        )
+
+    @staticmethod
+    def _probe(http_driver, cookie_list, probe_url):
+        # 用一次轻量请求确认缓存的登录态仍然有效，不修改 http_driver 的状态
+        if not probe_url:
+            logging.warning('Reusing cached session without probe_url, a session revoked by the server will not be '
+                            'detected.')
+            return True
+        probe = HTTPDriver(base_url=http_driver.base_url, cookie_list=cookie_list, timeout=http_driver.timeout)
+        probe.proxies = http_driver.proxies
+        # 不关闭 probe.session：连接池由 PoolRegistry 在所有 HTTPDriver 之间共享
+        try:
+            response = probe.get(probe_url, allow_redirects=False).response
+        except requests.RequestException:
+            return False
+        return response.status_code < 300
+
+    @staticmethod
+    def _browser_login(uid, password, browser):
+        # 命中缓存时不需要 selenium
+        from lutra.driver.selenium import UIDriver
+        from lutra.page.qqlogin_page import QQLoginPage
         ui_driver = UIDriver(browser)
-        QQLoginPage.login(ui_driver, uid, password)
-        cookies = ui_driver.get_cookies()
-        ui_driver.clean()
-        http_driver.set(cookies=cookies)
+        try:
+            QQLoginPage.login(ui_driver, uid, password)
+            return ui_driver.get_cookie_list()
+        finally:
+            ui_driver.clean()
+
+    @staticmethod
+    @step('登录')
+    def login(http_driver, uid, password, browser='Chrome', cache=True, probe_url=None, lock_timeout=300,
+              auth_cookies=None):
+        """
+        使用浏览器登录，并把 Cookies 设置到 http_driver
+
+        :param cache: 是否复用 SessionCache 中未过期的登录态，只在未命中或已失效时启动浏览器
+        :param probe_url: 校验缓存登录态的地址（相对 http_driver.base_url），返回 2xx 视为有效。
+            缺省不校验：服务端已注销的登录态在过期前会被继续使用，建议开启缓存时总是指定
+        :param lock_timeout: 等待其他进程完成登录的最长秒数
+        :param auth_cookies: 决定缓存过期时间的 Cookies 名，缺省为 SessionCache.auth_cookies
+        """
+        base_url = http_driver.base_url
+        if not cache:
+            cookie_list = LoginService._browser_login(uid, password, browser)
+            LoginService._apply(http_driver, cookie_list)
+            return cookie_list
+        cookie_list = SessionCache.load(uid, base_url)
+        if cookie_list is None or not LoginService._probe(http_driver, cookie_list, probe_url):
+            with SessionCache.lock(uid, base_url, lock_timeout):
+                # 等锁期间其他进程可能已经登录完成
+                cookie_list = SessionCache.load(uid, base_url)
+                if cookie_list is None or not LoginService._probe(http_driver, cookie_list, probe_url):
+                    logging.info('Session cache missed, logging in %s with browser.', uid)
+                    cookie_list = LoginService._browser_login(uid, password, browser)
+                    SessionCache.save(uid, base_url, cookie_list, auth_cookies)
+        LoginService._apply(http_driver, cookie_list)
+        return cookie_list
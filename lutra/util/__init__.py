@@ -1,10 +1,19 @@
 # coding:utf-8
+import os
+import re
 import time
+import threading
+import reprlib
+import json
+import operator
 import logging
 import html
+import importlib
 import pytest
-from functools import wraps
-from allure import step, severity_level
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+import allure
+from allure import severity_level
 
 P0 = severity_level.BLOCKER
 P1 = severity_level.CRITICAL
@@ -15,11 +24,273 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s: %(message)s')
 
 
+class StepMode:
+    """
+    allure 步骤和日志的模式
+
+    - enabled: 关闭后被 step 装饰的方法直接调用，不再记录步骤（用于压测等场景）
+    - lean: 精简模式，被 step 装饰的方法每 sample_every 次只记录一次步骤，且不记录参数；
+      日志中的大对象只输出摘要。环境变量 LUTRA_STEP_MODE=lean 开启，=off 关闭步骤，
+      失败重跑时可以关闭 lean 获取完整信息
+    """
+    enabled = os.environ.get('LUTRA_STEP_MODE') != 'off'
+    lean = os.environ.get('LUTRA_STEP_MODE') == 'lean'
+    sample_every = int(os.environ.get('LUTRA_STEP_SAMPLE', 10))
+    _counts = dict()
+    # send_many、压测等会在多个线程中调用被 step 装饰的方法
+    _lock = threading.Lock()
+
+    @classmethod
+    def sampled(cls, title):
+        with cls._lock:
+            n = cls._counts.get(title, 0)
+            cls._counts[title] = n + 1
+        return n % cls.sample_every == 0
+
+
+_brief_repr = reprlib.Repr()
+_brief_repr.maxstring = _brief_repr.maxother = 200
+_brief_repr.maxlist = _brief_repr.maxtuple = _brief_repr.maxdict = _brief_repr.maxset = 10
+_brief_repr.maxlevel = 3
+
+
+class _Brief:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return _brief_repr.repr(self.value) if StepMode.lean else str(self.value)
+
+
+def brief(value):
+    """
+    用作日志参数，如 logging.info('%s', brief(value))，输出日志时才格式化，精简模式下只输出摘要
+    """
+    return _Brief(value)
+
+
+class _Step:
+    def __init__(self, title):
+        self.title = title
+        self.context = None
+
+    def __enter__(self):
+        if StepMode.enabled:
+            self.context = allure.step(self.title)
+            return self.context.__enter__()
+
+    def __exit__(self, *exc_info):
+        if self.context is not None:
+            return self.context.__exit__(*exc_info)
+
+    def __call__(self, func):
+        recorded = allure.step(self.title)(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not StepMode.enabled:
+                return func(*args, **kwargs)
+            if not StepMode.lean:
+                return recorded(*args, **kwargs)
+            # 精简模式下不记录参数，省去对大对象的格式化
+            if StepMode.sampled(self.title):
+                with allure.step(self.title):
+                    return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                # 未被采样的步骤失败时仍然记录
+                with allure.step(self.title):
+                    raise
+        return wrapper
+
+
+def step(title):
+    """
+    与 allure.step 用法相同，受 StepMode 开关控制
+    """
+    if callable(title):
+        return _Step(title.__name__)(title)
+    return _Step(title)
+
+
+def _fast_json_loads():
+    # orjson/ujson 对超过 64 位的整数等内容的处理与标准库不同，需要用环境变量 LUTRA_JSON_BACKEND 显式开启
+    name = os.environ.get('LUTRA_JSON_BACKEND')
+    if name in ('orjson', 'ujson'):
+        try:
+            return importlib.import_module(name).loads
+        except ImportError:
+            logging.warning('JSON backend %s is not installed, using json.', name)
+    return json.loads
+
+
+_json_loads = _fast_json_loads()
+
+
+def set_json_backend(loads):
+    """
+    指定 JSON 解码函数，如 set_json_backend(orjson.loads)；缺省使用标准库
+    """
+    global _json_loads
+    _json_loads = loads
+
+
+def json_loads(s):
+    try:
+        return _json_loads(s)
+    except ValueError:
+        # orjson 不支持 NaN 等标准库接受的内容，交给标准库解码（真正的格式错误也由标准库报告）
+        if _json_loads is json.loads:
+            raise
+        return json.loads(s)
+
+
+class JSONPath:
+    """
+    编译后的取值路径，以 . 分隔，每一段可以是：
+
+    - 键名或下标：items.0.id
+    - 通配符，匹配列表的所有元素或词典的所有值：items.*.id
+    - 切片：items.0:10.id、items.::2.id
+    - 过滤条件，支持 == != > >= < <=，省略比较时判断真值：items.?(price>=9.5).name、items.?(on_sale).name
+
+    只含键名、下标和切片的路径按值返回（切片返回列表，之后的各段作用于切片中的每个元素），其余路径一次遍历返回所有匹配值的列表；
+    形如切片的一段遇到词典时按键名取值，如 schedule.12:30
+    """
+    _segment = re.compile(r'\?\([^)]*\)|[^.]+')
+    _predicate = re.compile(r'^\?\(\s*([^=!<>\s]+)\s*(?:(==|!=|>=|<=|>|<)\s*(.*?))?\s*\)$')
+    _operators = {'==': operator.eq, '!=': operator.ne, '>=': operator.ge, '<=': operator.le,
+                  '>': operator.gt, '<': operator.lt}
+
+    def __init__(self, key):
+        self.key = key
+        self.steps = [self._compile(segment) for segment in self._segment.findall(key)]
+        self.multiple = any(kind in ('all', 'filter') for kind, _ in self.steps)
+
+    def _compile(self, segment):
+        if segment == '*':
+            return 'all', None
+        matched = self._predicate.match(segment)
+        if matched:
+            path, op, literal = matched.groups()
+            if op is None:
+                return 'filter', (compile_path(path), None, None)
+            try:
+                value = json.loads(literal)
+            except ValueError:
+                value = literal.strip('\'"')
+            return 'filter', (compile_path(path), self._operators[op], value)
+        if ':' in segment and re.fullmatch(r'-?\d*(:-?\d*){1,2}', segment):
+            return 'slice', (slice(*(int(i) if i else None for i in segment.split(':'))), segment)
+        return 'key', (segment, int(segment) if re.fullmatch(r'-?\d+', segment) else None)
+
+    def get(self, data):
+        """
+        按路径取值，路径不存在时与直接下标访问一样抛出 KeyError/IndexError
+        """
+        if self.multiple:
+            return self.find(data)
+        for n, (kind, arg) in enumerate(self.steps):
+            if kind == 'slice':
+                if not isinstance(data, list):
+                    data = data[arg[1]]
+                    continue
+                if n + 1 == len(self.steps):
+                    return data[arg[0]]
+                return self._walk(data[arg[0]], self.steps[n + 1:])
+            key, index = arg
+            data = data[index if index is not None and isinstance(data, list) else key]
+        return data
+
+    def find(self, data):
+        """
+        返回所有匹配值的列表，跳过不存在该路径的元素
+        """
+        return self._walk([data], self.steps)
+
+    def _walk(self, nodes, steps):
+        for kind, arg in steps:
+            matches = []
+            for node in nodes:
+                if kind == 'key':
+                    key, index = arg
+                    try:
+                        matches.append(node[index if index is not None and isinstance(node, list) else key])
+                    except (KeyError, IndexError, TypeError):
+                        pass
+                elif kind == 'all':
+                    if isinstance(node, list):
+                        matches.extend(node)
+                    elif hasattr(node, 'values'):
+                        matches.extend(node.values())
+                elif kind == 'slice':
+                    if isinstance(node, list):
+                        matches.extend(node[arg[0]])
+                    elif hasattr(node, 'keys') and arg[1] in node:
+                        matches.append(node[arg[1]])
+                else:
+                    matches.extend(self._filter(node, *arg))
+            nodes = matches
+        return nodes
+
+    @staticmethod
+    def _filter(node, path, op, value):
+        items = node if isinstance(node, list) else node.values() if hasattr(node, 'values') else ()
+        for item in items:
+            found = path.find(item)
+            if not found:
+                continue
+            try:
+                if (op(found[0], value) if op else found[0]):
+                    yield item
+            except TypeError:
+                pass
+
+
+@lru_cache(maxsize=1024)
+def compile_path(key):
+    return JSONPath(key)
+
+
 def json_parser(key, json):
-    for k in key.split('.'):
-        k = int(k) if isinstance(json, list) else k
-        json = json[k]
-    return json
+    return compile_path(key).get(json)
+
+
+@contextmanager
+def file_lock(path, timeout=None):
+    """
+    跨进程的文件锁（如 pytest-xdist 的各个 worker 之间），timeout 秒内拿不到锁时抛出 TimeoutError
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            lock = lambda: msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            unlock = lambda: msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            lock = lambda: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            unlock = lambda: fcntl.flock(f, fcntl.LOCK_UN)
+        while True:
+            try:
+                f.seek(0)
+                lock()
+                break
+            except OSError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError('等待文件锁超时：{}'.format(path))
+                time.sleep(0.1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            unlock()
 
 
 def html_unescape(s):
@@ -43,6 +314,21 @@ class Assert:
                 return False
         return wrapper
 
+    @staticmethod
+    def every(assert_method):
+        """
+        对列表中的每个值执行断言，只记录一个步骤，如 Assert.every(Assert.gt(0))
+        """
+        # 跳过每个值各自的 allure 步骤，上万个值时步骤本身的开销远大于比较
+        check = getattr(assert_method, '__wrapped__', assert_method)
+
+        @step
+        def assert_every_y(ys):
+            logging.info('Asserting every one of %s values:', len(ys))
+            for y in ys:
+                check(y)
+        return assert_every_y
+
     @staticmethod
     @step
     def nor(func):
@@ -54,7 +340,7 @@ class Assert:
     def be(value):
         @step
         def assert_y_is_x(y, x=value):
-            logging.info('Asserting that {} is {}.'.format(y, x))
+            logging.info('Asserting that %s is %s.', brief(y), brief(x))
             assert y is x
         return assert_y_is_x
 
@@ -62,7 +348,7 @@ class Assert:
     def equal_to(value):
         @step
         def assert_y_equal_to_x(y, x=value):
-            logging.info('Asserting that {} equal to {}.'.format(y, x))
+            logging.info('Asserting that %s equal to %s.', brief(y), brief(x))
             assert y == x
         return assert_y_equal_to_x
 
@@ -71,7 +357,7 @@ class Assert:
         @step
         def assert_y_contain_xs(y, xs=values):
             for x in xs:
-                logging.info('Asserting that {} equal to {}.'.format(y, x))
+                logging.info('Asserting that %s equal to %s.', brief(y), brief(x))
                 assert x in y
         return assert_y_contain_xs
 
@@ -79,7 +365,7 @@ class Assert:
     def true():
         @step
         def assert_values_be_true(*values):
-            logging.info('Asserting that {} are true.'.format(values))
+            logging.info('Asserting that %s are true.', brief(values))
             for y in values:
                 assert y is True
         return assert_values_be_true
@@ -88,7 +374,7 @@ class Assert:
     def false():
         @step
         def assert_values_be_false(*values):
-            logging.info('Asserting that {} are false.'.format(values))
+            logging.info('Asserting that %s are false.', brief(values))
             for value in values:
                 assert value is False
         return assert_values_be_false
@@ -97,7 +383,7 @@ class Assert:
     def lt(value):
         @step
         def assert_y_lt_x(y, x=value):
-            logging.info('Asserting that {} < {}.'.format(y, x))
+            logging.info('Asserting that %s < %s.', brief(y), brief(x))
             assert y < x
         return assert_y_lt_x
 
@@ -105,7 +391,7 @@ class Assert:
     def le(value):
         @step
         def assert_y_le_x(y, x=value):
-            logging.info('Asserting that {} <= {}.'.format(y, x))
+            logging.info('Asserting that %s <= %s.', brief(y), brief(x))
             assert y <= x
         return assert_y_le_x
 
@@ -113,7 +399,7 @@ class Assert:
     def gt(value):
         @step
         def assert_y_gt_x(y, x=value):
-            logging.info('Asserting that {} > {}.'.format(y, x))
+            logging.info('Asserting that %s > %s.', brief(y), brief(x))
             assert y > x
         return assert_y_gt_x
 
@@ -121,7 +407,7 @@ class Assert:
     def ge(value):
         @step
         def assert_y_ge_x(y, x=value):
-            logging.info('Asserting that {} >= {}.'.format(y, x))
+            logging.info('Asserting that %s >= %s.', brief(y), brief(x))
             assert y >= x
         return assert_y_ge_x
 
@@ -129,6 +415,6 @@ class Assert:
     def ne(value):
         @step
         def assert_y_ne_x(y, x=value):
-            logging.info('Asserting that {} != {}.'.format(y, x))
+            logging.info('Asserting that %s != %s.', brief(y), brief(x))
             assert y != x
         return assert_y_ne_x
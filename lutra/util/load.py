@@ -0,0 +1,234 @@
+# coding:utf-8
+import json
+import time
+import bisect
+import asyncio
+import inspect
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from . import logging, StepMode
+from ..driver.requests import LatencyStats
+
+# 延迟直方图各桶的上界（毫秒），最后一个桶收集超过 10 秒的请求
+BUCKET_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+BUCKET_LABELS = tuple('<={}ms'.format(bound) for bound in BUCKET_BOUNDS) + ('>{}ms'.format(BUCKET_BOUNDS[-1]),)
+
+
+class LoadRecorder:
+    """
+    单个进程内的压测统计，只保存直方图和计数，内存占用与请求量无关
+    """
+    def __init__(self, start):
+        self.start = start
+        self.lock = threading.Lock()
+        self.histogram = [0] * len(BUCKET_LABELS)
+        # 秒 -> [请求数, 错误数]
+        self.timeline = dict()
+        # endpoint -> [请求数, 错误数, 总耗时]
+        self.endpoints = dict()
+        self.iterations = 0
+        self.failed_iterations = 0
+        # 场景异常 -> 次数
+        self.failures = dict()
+
+    def on_request(self, endpoint, seconds, status_code):
+        error = status_code is None or status_code >= 400
+        second = int(time.time() - self.start)
+        with self.lock:
+            self.histogram[bisect.bisect_left(BUCKET_BOUNDS, seconds * 1000)] += 1
+            tick = self.timeline.setdefault(second, [0, 0])
+            tick[0] += 1
+            tick[1] += error
+            stats = self.endpoints.setdefault(endpoint, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += error
+            stats[2] += seconds
+
+    def on_iteration(self, exception=None):
+        with self.lock:
+            self.iterations += 1
+            if exception is not None:
+                self.failed_iterations += 1
+                key = '{}: {}'.format(type(exception).__name__, exception)[:200]
+                self.failures[key] = self.failures.get(key, 0) + 1
+
+    def data(self):
+        return {
+            'histogram': self.histogram,
+            'timeline': self.timeline,
+            'endpoints': self.endpoints,
+            'iterations': self.iterations,
+            'failed_iterations': self.failed_iterations,
+            'failures': self.failures,
+        }
+
+
+class _Pacer:
+    """
+    按目标速率均匀分配每次执行场景的时间点，所有虚拟用户共享
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        if not self.interval:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next, now)
+            self.next = slot + self.interval
+        return slot - now
+
+
+def _run_user(scenario, user_id, users, ramp_up, start, deadline, pacer, recorder):
+    delay = start + ramp_up * user_id / users - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    while True:
+        delay = pacer.delay()
+        if delay:
+            time.sleep(delay)
+        if time.time() >= deadline:
+            break
+        try:
+            scenario(user_id)
+            recorder.on_iteration()
+        except Exception as e:
+            recorder.on_iteration(e)
+
+
+async def _run_async_user(scenario, user_id, users, ramp_up, start, deadline, pacer, recorder):
+    delay = start + ramp_up * user_id / users - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    while True:
+        delay = pacer.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        if time.time() >= deadline:
+            break
+        try:
+            await scenario(user_id)
+            recorder.on_iteration()
+        except Exception as e:
+            recorder.on_iteration(e)
+
+
+def _run_worker(scenario, user_ids, users, duration, ramp_up, rate, start):
+    """
+    在一个进程中运行一部分虚拟用户：协程场景使用 asyncio 任务，普通场景使用线程
+    """
+    step_enabled, keep_samples = StepMode.enabled, LatencyStats.keep_samples
+    StepMode.enabled = False
+    LatencyStats.keep_samples = False
+    recorder = LoadRecorder(start)
+    LatencyStats.listeners.append(recorder.on_request)
+    pacer = _Pacer(rate)
+    is_async = inspect.iscoroutinefunction(scenario)
+    if not inspect.signature(scenario).parameters:
+        # 场景函数可以不带参数，也可以接收虚拟用户编号
+        scenario = (lambda func: lambda user_id: func())(scenario)
+    args = users, ramp_up, start, start + duration, pacer, recorder
+    try:
+        if is_async:
+            async def run():
+                await asyncio.gather(*(_run_async_user(scenario, user_id, *args) for user_id in user_ids))
+            asyncio.run(run())
+        else:
+            with ThreadPoolExecutor(max_workers=len(user_ids)) as executor:
+                for future in [executor.submit(_run_user, scenario, user_id, *args) for user_id in user_ids]:
+                    future.result()
+    finally:
+        LatencyStats.listeners.remove(recorder.on_request)
+        StepMode.enabled, LatencyStats.keep_samples = step_enabled, keep_samples
+    return recorder.data()
+
+
+def _percentile(histogram, total, p):
+    # 直方图只能给出所在桶的上界
+    count = 0
+    for label, n in zip(BUCKET_LABELS, histogram):
+        count += n
+        if count >= total * p / 100:
+            return label
+    return None
+
+
+def _report(results, users, duration):
+    histogram = [sum(counts) for counts in zip(*(result['histogram'] for result in results))]
+    timeline, endpoints, failures = dict(), dict(), dict()
+    for result in results:
+        for second, (count, errors) in result['timeline'].items():
+            tick = timeline.setdefault(second, [0, 0])
+            tick[0] += count
+            tick[1] += errors
+        for endpoint, (count, errors, seconds) in result['endpoints'].items():
+            stats = endpoints.setdefault(endpoint, [0, 0, 0.0])
+            stats[0] += count
+            stats[1] += errors
+            stats[2] += seconds
+        for failure, count in result['failures'].items():
+            failures[failure] = failures.get(failure, 0) + count
+    requests = sum(histogram)
+    errors = sum(stats[1] for stats in endpoints.values())
+    return {
+        'users': users,
+        'duration': duration,
+        'requests': requests,
+        'throughput': requests / duration if duration else 0,
+        'error_rate': errors / requests if requests else 0,
+        'iterations': sum(result['iterations'] for result in results),
+        'failed_iterations': sum(result['failed_iterations'] for result in results),
+        'failures': failures,
+        'latency': {'p{}'.format(p): _percentile(histogram, requests, p) for p in (50, 95, 99)},
+        'histogram': dict(zip(BUCKET_LABELS, histogram)),
+        'timeline': [
+            {'second': second, 'requests': count, 'errors': errors}
+            for second, (count, errors) in sorted(timeline.items())
+        ],
+        'endpoints': {
+            endpoint: {'requests': count, 'errors': errors, 'mean_ms': seconds * 1000 / count}
+            for endpoint, (count, errors, seconds) in endpoints.items()
+        },
+    }
+
+
+def run_load(scenario, users=10, duration=60, ramp_up=0, rate=None, processes=1, report_path=None):
+    """
+    用 HTTPDriver 编写的场景函数进行压测，压测期间关闭 allure 步骤
+
+    :param scenario: 场景函数，可以不带参数或接收虚拟用户编号；协程函数会以 asyncio 任务运行。
+        多进程时必须定义在模块顶层
+    :param users: 虚拟用户数
+    :param duration: 压测时长（秒）
+    :param ramp_up: 在多少秒内逐个启动全部虚拟用户
+    :param rate: 每秒执行场景的目标次数，缺省时不限速
+    :param processes: 进程数，虚拟用户和目标速率平均分配到各进程
+    :param report_path: 报告的保存路径（JSON）
+    :return: 报告，包括延迟直方图、每秒吞吐量、错误率等
+    """
+    processes = max(1, min(processes, users))
+    groups = [list(range(users))[i::processes] for i in range(processes)]
+    worker_rate = rate / processes if rate else None
+    start = time.time()
+    logging.info('Load test: {} users, {} processes, {}s.'.format(users, processes, duration))
+    if processes == 1:
+        results = [_run_worker(scenario, groups[0], users, duration, ramp_up, worker_rate, start)]
+    else:
+        # 给各进程留出启动时间，保证同时开始
+        start += 1
+        with multiprocessing.get_context().Pool(processes) as pool:
+            results = pool.starmap(_run_worker, [
+                (scenario, group, users, duration, ramp_up, worker_rate, start) for group in groups
+            ])
+    report = _report(results, users, duration)
+    logging.info('Load test finished: {} requests, {:.1f} req/s, error rate {:.2%}, p95 {}.'.format(
+        report['requests'], report['throughput'], report['error_rate'], report['latency']['p95']
+    ))
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
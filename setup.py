@@ -5,7 +5,8 @@ setup(
     description='Lutra Automation Runner',
     packages=find_packages(),
     install_requires=['pytest >= 6.1.1', 'selenium', 'requests', 'allure-pytest >= 2.8.18', 'pytest-bdd >= 4.0.1',
-                      'pytest-xdist', 'pytest-rerunfailures', 'opencv-python', 'numpy'],
+                      'pytest-xdist', 'pytest-rerunfailures', 'opencv-python', 'numpy',
+                      'aiohttp', 'jsonschema', 'PyYAML', 'websocket-client'],
     author='jacejiang',
     python_requires='>=3',
 )
@@ -0,0 +1,82 @@
+# coding:utf-8
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import pytest
+
+
+class LocalServer:
+    """
+    本地 HTTP 服务，记录收到的请求和建立的连接；routes 按路径指定响应函数 route(request) -> (状态码, 响应头, 响应体)
+    """
+    def __init__(self):
+        self.requests = []
+        self.hits = []
+        self.connections = []
+        self.routes = dict()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections.append(self.client_address)
+
+            def _read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if not size:
+                            self.rfile.readline()
+                            return body
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def _handle(self):
+                request = {'method': self.command, 'path': self.path, 'headers': self.headers,
+                           'body': self._read_body()}
+                with server.lock:
+                    server.requests.append(request)
+                    server.hits.append(self.path)
+                    n = len(server.hits)
+                route = server.routes.get(urlsplit(self.path).path)
+                if route is None:
+                    status, headers = 200, {'Content-Type': 'application/json'}
+                    body = json.dumps({'path': self.path, 'n': n}).encode()
+                else:
+                    status, headers, body = route(request)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_OPTIONS = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_port)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = LocalServer()
+    server.start()
+    yield server
+    server.stop()
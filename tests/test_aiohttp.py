@@ -0,0 +1,102 @@
+# coding:utf-8
+import time
+import asyncio
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs
+import pytest
+
+pytest.importorskip('aiohttp')
+from lutra.driver import aiohttp as lutra_aiohttp  # noqa: E402
+from lutra.driver.aiohttp import AsyncHTTPDriver  # noqa: E402
+from lutra.util import Assert  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_cookie_round_trip(server):
+    server.routes['/login'] = lambda request: (200, {'Set-Cookie': 'sid=abc; Path=/'}, b'{}')
+
+    async def scenario():
+        async with AsyncHTTPDriver(base_url=server.url) as driver:
+            await driver.get('login')
+            await driver.get('me')
+            assert server.requests[-1]['headers']['Cookie'] == 'sid=abc'
+            assert driver.session.cookies.get('sid') == 'abc'
+            driver.arrangement().cookies(cookie_dict={'token': 't'})
+            await driver.get('me')
+            assert server.requests[-1]['headers']['Cookie'] == 'token=t'
+
+    run(scenario())
+
+
+def test_send_many_keeps_order(server):
+    def slow(request):
+        time.sleep(float(parse_qs(urlsplit(request['path']).query)['delay'][0]))
+        return 200, {'Content-Type': 'application/json'}, '"{}"'.format(request['path']).encode()
+
+    server.routes['/slow'] = slow
+    specs = [{'url': 'slow', 'params': {'delay': delay, 'n': n}} for n, delay in enumerate((0.3, 0, 0.1, 0))]
+
+    async def scenario():
+        async with AsyncHTTPDriver(base_url=server.url) as driver:
+            return await driver.send_many(specs, max_workers=4)
+
+    resps = run(scenario())
+    assert [resp.json() for resp in resps] == ['/slow?delay={}&n={}'.format(spec['params']['delay'], n)
+                                               for n, spec in enumerate(specs)]
+
+
+def test_metrics_phases(server):
+    async def scenario():
+        async with AsyncHTTPDriver(base_url=server.url) as driver:
+            return await driver.get('a'), await driver.get('b')
+
+    first, second = run(scenario())
+    assert set(first.metrics) == {'connect', 'tls', 'ttfb', 'download', 'total'}
+    assert first.metrics['connect'] > 0
+    assert second.metrics['connect'] == 0
+    assert first.metrics['ttfb'] <= first.metrics['total']
+    first.assertion().elapsed(Assert.lt(5), 'ttfb')
+
+
+def test_steps_do_not_nest(server, monkeypatch):
+    server.routes['/slow'] = lambda request: (time.sleep(0.1), (200, {}, b'{}'))[1]
+    opened, nested = [], []
+
+    @contextmanager
+    def step(title):
+        nested.append(bool(opened))
+        opened.append(title)
+        try:
+            yield
+        finally:
+            opened.pop()
+
+    monkeypatch.setattr(lutra_aiohttp, 'step', step)
+
+    async def scenario():
+        async with AsyncHTTPDriver(base_url=server.url) as driver:
+            await asyncio.gather(driver.get('slow'), driver.post('slow'), driver.send_many([{'url': 'slow'}] * 2))
+
+    run(scenario())
+    assert len(nested) == 3
+    assert not any(nested)
+
+
+@pytest.mark.parametrize('arrange', [
+    lambda arrangement, tmp_path: arrangement.record(str(tmp_path / 'cassette')),
+    lambda arrangement, tmp_path: arrangement.retry(),
+    lambda arrangement, tmp_path: arrangement.stream(),
+    lambda arrangement, tmp_path: arrangement.upload(__file__),
+])
+def test_unsupported_options(server, tmp_path, arrange):
+    async def scenario():
+        async with AsyncHTTPDriver(base_url=server.url) as driver:
+            arrange(driver.arrangement(), tmp_path)
+            await driver.post('a')
+
+    with pytest.raises(NotImplementedError):
+        run(scenario())
+    assert server.requests == []
@@ -0,0 +1,73 @@
+# coding:utf-8
+import socket
+from lutra.driver.requests import HTTPDriver
+from lutra.util.load import BUCKET_LABELS, run_load, _report, _percentile
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+
+
+def result(histogram, timeline, endpoints, iterations=0, failed_iterations=0, failures=None):
+    return {'histogram': histogram + [0] * (len(BUCKET_LABELS) - len(histogram)), 'timeline': timeline,
+            'endpoints': endpoints, 'iterations': iterations, 'failed_iterations': failed_iterations,
+            'failures': failures or {}}
+
+
+def test_percentile():
+    histogram = [50, 40, 9, 1]
+    assert _percentile(histogram, 100, 50) == '<=1ms'
+    assert _percentile(histogram, 100, 90) == '<=2ms'
+    assert _percentile(histogram, 100, 99) == '<=5ms'
+    assert _percentile(histogram, 100, 100) == '<=10ms'
+    assert _percentile([0] * len(BUCKET_LABELS), 0, 50) == '<=1ms'
+
+
+def test_report_merges_workers():
+    results = [
+        result([2, 1], {0: [2, 1], 1: [1, 0]}, {'GET /a': [3, 1, 0.003]}, 3, 1, {'E: x': 1}),
+        result([0, 0, 1], {1: [1, 1]}, {'GET /a': [1, 1, 0.005]}, 1, 0, {'E: x': 2}),
+    ]
+    report = _report(results, users=2, duration=2)
+    assert report['requests'] == 4
+    assert report['throughput'] == 2
+    assert report['error_rate'] == 0.5
+    assert report['iterations'] == 4
+    assert report['failed_iterations'] == 1
+    assert report['failures'] == {'E: x': 3}
+    assert report['timeline'] == [{'second': 0, 'requests': 2, 'errors': 1}, {'second': 1, 'requests': 2, 'errors': 1}]
+    assert report['endpoints'] == {'GET /a': {'requests': 4, 'errors': 2, 'mean_ms': 2.0}}
+    assert report['latency']['p50'] == '<=1ms'
+    assert report['histogram']['<=5ms'] == 1
+
+
+def test_run_load(server, tmp_path):
+    server.routes['/error'] = lambda request: (500, {}, b'{}')
+
+    def scenario(user_id):
+        driver = HTTPDriver(base_url=server.url)
+        driver.get('ok')
+        driver.get('error')
+
+    path = tmp_path / 'report.json'
+    report = run_load(scenario, users=2, duration=0.5, rate=20, report_path=str(path))
+    assert report['requests'] == len(server.requests) > 0
+    assert report['endpoints']['GET {}error'.format(server.url)]['errors'] == report['requests'] / 2
+    assert report['error_rate'] == 0.5
+    assert report['iterations'] == report['requests'] / 2
+    assert path.exists()
+
+
+def test_run_load_counts_transport_failures():
+    url = unused_url()
+
+    def scenario():
+        HTTPDriver(base_url=url).get('x')
+
+    report = run_load(scenario, users=2, duration=0.3, rate=20)
+    assert report['requests'] > 0
+    assert report['error_rate'] == 1
+    assert report['failed_iterations'] == report['iterations'] == report['requests']
+    assert list(report['failures'])[0].startswith('ConnectionError')
@@ -0,0 +1,71 @@
+# coding:utf-8
+import os
+import time
+import pytest
+
+from lutra.driver.requests import HTTPDriver
+from lutra.service.login_qq import SessionCache, LoginService
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(SessionCache, 'directory', str(tmp_path))
+    return tmp_path
+
+
+def test_expires_ignores_non_auth_cookies():
+    now = time.time()
+    cookie_list = [
+        {'name': 'skey', 'value': 'a', 'expiry': now + 1800},
+        {'name': 'pgv_pvid', 'value': 'b', 'expiry': now + 5},
+    ]
+    assert abs(SessionCache.expires(cookie_list) - (now + 1800)) < 1
+
+
+def test_expires_capped_by_max_age():
+    now = time.time()
+    cookie_list = [
+        {'name': 'skey', 'value': 'a', 'expiry': now + 10 * SessionCache.max_age},
+        {'name': 'uin', 'value': 'c'},
+    ]
+    assert abs(SessionCache.expires(cookie_list) - (now + SessionCache.max_age)) < 1
+    assert abs(SessionCache.expires(cookie_list, auth_cookies=('sid',)) - (now + SessionCache.max_age)) < 1
+
+
+def test_save_and_load(cache_dir):
+    cookie_list = [{'name': 'skey', 'value': 'a', 'expiry': time.time() + 600}]
+    SessionCache.save('10001', 'http://a/', cookie_list)
+    assert SessionCache.load('10001', 'http://a/') == cookie_list
+    assert SessionCache.load('10001', 'http://b/') is None
+    path = SessionCache._path('10001', 'http://a/') + '.json'
+    if os.name != 'nt':
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    SessionCache.invalidate('10001', 'http://a/')
+    assert SessionCache.load('10001', 'http://a/') is None
+
+
+def test_load_expired(cache_dir):
+    SessionCache.save('10001', 'http://a/', [{'name': 'skey', 'value': 'a', 'expiry': time.time() - 1}])
+    assert SessionCache.load('10001', 'http://a/') is None
+
+
+def test_probe_keeps_shared_pool(server, cache_dir):
+    server.routes['/api/user/info'] = lambda request: (200, {}, b'{}')
+    driver = HTTPDriver(base_url=server.url)
+    driver.get('a')
+    cookie_list = [{'name': 'skey', 'value': 'a', 'expiry': time.time() + 600}]
+    SessionCache.save('10001', server.url, cookie_list)
+    assert LoginService.login(driver, '10001', 'password', probe_url='api/user/info') == cookie_list
+    driver.get('b')
+    assert len(server.connections) == 1
+    assert 'skey=a' in server.requests[-1]['headers']['Cookie']
+
+
+def test_probe_rejects_revoked_session(server, cache_dir, monkeypatch):
+    server.routes['/api/user/info'] = lambda request: (401, {}, b'{}')
+    fresh = [{'name': 'skey', 'value': 'new'}]
+    monkeypatch.setattr(LoginService, '_browser_login', staticmethod(lambda uid, password, browser: fresh))
+    SessionCache.save('10001', server.url, [{'name': 'skey', 'value': 'old'}])
+    driver = HTTPDriver(base_url=server.url)
+    assert LoginService.login(driver, '10001', 'password', probe_url='api/user/info') == fresh
+    assert SessionCache.load('10001', server.url) == fresh
@@ -0,0 +1,429 @@
+# coding:utf-8
+import os
+import mmap
+import time
+import email
+import socket
+import json
+import pytest
+import requests
+import jsonschema
+from lutra.driver.requests import iter_json_records, LatencyStats, RetryPolicy, HTTPDriver, Cassette, PoolRegistry, \
+    SchemaCache, UploadStream
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    (['{"n":1}\n{"n":2}\n'], [{'n': 1}, {'n': 2}]),
+    (['{"n":1}\n{"n"', ':2}\n', '{"n":3}'], [{'n': 1}, {'n': 2}, {'n': 3}]),
+    (['\n', '  \n{"n":1}\r\n\n'], [{'n': 1}]),
+])
+def test_iter_json_records_ndjson(chunks, expected):
+    assert list(iter_json_records(chunks)) == expected
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    (['[1, 2, 3]'], [1, 2, 3]),
+    (['[1, 3.', '5, 4]'], [1, 3.5, 4]),
+    (['[1, 1e', '5]'], [1, 1e5]),
+    (['[1', '2, 3', '4]'], [12, 34]),
+    (['[{"a": ', '[1, 2]}, "x', 'y", tr', 'ue, null]'], [{'a': [1, 2]}, 'xy', True, None]),
+    ([' ', ' [ ]'], []),
+])
+def test_iter_json_records_array(chunks, expected):
+    assert list(iter_json_records(chunks)) == expected
+
+
+def test_iter_json_records_format():
+    assert list(iter_json_records(['[1]\n[2]\n'], 'ndjson')) == [[1], [2]]
+    assert list(iter_json_records(['[1, 2]'], 'array')) == [1, 2]
+
+
+def test_iter_json_records_invalid():
+    with pytest.raises(ValueError):
+        list(iter_json_records(['[1, {"a": }]']))
+
+
+@pytest.mark.parametrize('samples, p, expected', [
+    (list(range(1, 11)), 50, 5),
+    (list(range(1, 7)), 50, 3),
+    (list(range(1, 101)), 95, 95),
+    (list(range(1, 101)), 99, 99),
+    (list(range(1, 11)), 100, 10),
+    (list(range(1, 11)), 0, 1),
+    ([7], 50, 7),
+])
+def test_latency_percentile(samples, p, expected):
+    assert LatencyStats.percentile(samples, p) == expected
+
+
+def test_latency_summary():
+    LatencyStats.clear()
+    for seconds in (0.3, 0.1, 0.2):
+        LatencyStats.record('GET /a', seconds)
+    try:
+        assert LatencyStats.summary()['GET /a'] == {'count': 3, 'p50': 0.2, 'p95': 0.3, 'p99': 0.3, 'max': 0.3}
+    finally:
+        LatencyStats.clear()
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def sender(*results):
+    results = list(results)
+    calls = []
+
+    def send():
+        calls.append(1)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    send.calls = calls
+    return send
+
+
+def test_retry_policy_allows():
+    policy = RetryPolicy()
+    assert policy.allows('get')
+    assert policy.allows('PUT')
+    assert not policy.allows('post')
+    assert policy.allows('post', {'Idempotency-Key': 'k'})
+    assert RetryPolicy(methods=['post']).allows('POST')
+
+
+def test_retry_policy_retries_statuses(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    first = FakeResponse(503)
+    send = sender(first, FakeResponse(502), FakeResponse(200))
+    response, retries = RetryPolicy(total=3, jitter=False).send(send)
+    assert (response.status_code, retries, len(send.calls)) == (200, 2, 3)
+    assert first.closed
+
+
+def test_retry_policy_gives_up(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    response, retries = RetryPolicy(total=2).send(sender(FakeResponse(503), FakeResponse(503), FakeResponse(503)))
+    assert (response.status_code, retries) == (503, 2)
+    with pytest.raises(requests.ConnectionError):
+        RetryPolicy(total=1).send(sender(requests.ConnectionError(), requests.ConnectionError()))
+    response, retries = RetryPolicy().send(sender(FakeResponse(500)))
+    assert (response.status_code, retries) == (500, 0)
+
+
+def test_retry_policy_budget(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    policy = RetryPolicy(total=5, budget=2)
+    response, retries = policy.send(sender(*[FakeResponse(503)] * 6))
+    assert (retries, policy.used) == (2, 2)
+    response, retries = policy.send(sender(FakeResponse(503)))
+    assert retries == 0
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(backoff=0.5, max_backoff=3, jitter=False)
+    assert [policy.delay(n) for n in (1, 2, 3, 4)] == [0.5, 1, 2, 3]
+    assert policy.delay(1, FakeResponse(503, {'Retry-After': '2'})) == 2
+    assert policy.delay(1, FakeResponse(503, {'Retry-After': '120'})) == 3
+    assert RetryPolicy(respect_retry_after=False, jitter=False).delay(1, FakeResponse(503, {'Retry-After': '2'})) == 0.5
+    assert 0 <= RetryPolicy(backoff=1).delay(1) <= 1
+
+
+def test_cassette_record_and_replay(server, tmp_path):
+    base_url, hits = server.url, server.hits
+    path = str(tmp_path / 'api.cassette')
+    driver = HTTPDriver(base_url=base_url)
+    driver.arrangement().record(path)
+    driver.get('user', params={'id': 1})
+    driver.get('user', params={'id': 1})
+    driver.post('user', data={'name': '甲'})
+    driver.cassette.close()
+    assert len(hits) == 3
+
+    driver = HTTPDriver(base_url=base_url)
+    driver.arrangement().replay(path)
+    # 同一个请求录制了多次时按顺序回放，用完后一直回放最后一次
+    assert [driver.get('user', params={'id': 1}).json()['n'] for _ in range(3)] == [1, 2, 2]
+    assert driver.post('user', data={'name': '甲'}).json() == {'path': '/user', 'n': 3}
+    with pytest.raises(Exception, match='没有匹配的请求'):
+        driver.get('user', params={'id': 2})
+    driver.cassette.close()
+    assert len(hits) == 3
+
+
+def test_cassette_rebuilds_index(server, tmp_path):
+    base_url, hits = server.url, server.hits
+    path = str(tmp_path / 'api.cassette')
+    driver = HTTPDriver(base_url=base_url)
+    driver.arrangement().record(path)
+    driver.get('a')
+    driver.cassette.close()
+    for name in os.listdir(str(tmp_path)):
+        if name != 'api.cassette':
+            os.remove(str(tmp_path / name))
+    cassette = Cassette(path)
+    try:
+        assert cassette.replay(requests.Session(), 'get', base_url + 'a', {}).json() == {'path': '/a', 'n': 1}
+    finally:
+        cassette.close()
+
+
+def test_pool_shared_between_drivers(server):
+    first, second = HTTPDriver(base_url=server.url), HTTPDriver(base_url=server.url)
+    first.get('a')
+    second.get('b')
+    assert len(server.connections) == 1
+
+
+def test_pool_survives_session_close(server):
+    closed = HTTPDriver(base_url=server.url)
+    closed.get('a')
+    closed.session.close()
+    HTTPDriver(base_url=server.url).get('b')
+    assert len(server.connections) == 1
+    PoolRegistry.close_all()
+    HTTPDriver(base_url=server.url).get('c')
+    assert len(server.connections) == 2
+
+
+@pytest.mark.parametrize('arrange, data, json, content_type, body', [
+    (lambda a: a.json({'a': 1}), {'b': 2}, None, 'application/x-www-form-urlencoded', b'b=2'),
+    (lambda a: a.form_param('a', 1), None, {'b': 2}, 'application/json', b'{"b": 2}'),
+])
+def test_template_body_swap(server, arrange, data, json, content_type, body):
+    driver = HTTPDriver(base_url=server.url)
+    template = arrange(driver.arrangement()).template('post', 'items')
+    template.send(data=data, json=json)
+    request = server.requests[-1]
+    assert request['headers']['Content-Type'] == content_type
+    assert request['body'] == body
+    assert int(request['headers']['Content-Length']) == len(body)
+
+
+def test_template_keeps_caller_content_type(server):
+    driver = HTTPDriver(base_url=server.url)
+    template = driver.arrangement().form_param('a', 1).template('post', 'items')
+    template.send(json={'b': 2}, headers={'content-type': 'application/vnd.lutra+json'})
+    assert server.requests[-1]['headers']['Content-Type'] == 'application/vnd.lutra+json'
+    template.send()
+    request = server.requests[-1]
+    assert request['headers']['Content-Type'] == 'application/x-www-form-urlencoded'
+    assert request['body'] == b'a=1'
+
+
+def test_template_overrides(server):
+    driver = HTTPDriver(base_url=server.url)
+    arrangement = driver.arrangement().query_param('a', 1).header_param('X-Token', 'old').path_param('uid', 1)
+    template = arrangement.template('get', 'user/{uid}')
+    template.send(path_params={'uid': 2}, params={'b': [2, 3]}, headers={'X-Token': 'new', 'X-Trace': 't'})
+    request = server.requests[-1]
+    assert request['path'] == '/user/2?a=1&b=2&b=3'
+    assert request['headers']['X-Token'] == 'new'
+    assert request['headers']['X-Trace'] == 't'
+    template.send()
+    request = server.requests[-1]
+    assert request['path'] == '/user/1?a=1'
+    assert request['headers']['X-Token'] == 'old'
+    assert 'X-Trace' not in request['headers']
+
+
+def test_extraction_shares_decoded_json(server):
+    server.routes['/items'] = lambda request: (200, {'Content-Type': 'application/json'},
+                                               b'{"data": {"items": [{"id": 1}, {"id": 2}]}}')
+    resp = HTTPDriver(base_url=server.url).get('items')
+    assert resp.extraction().json() is resp.json()
+    assert resp.extraction().json('data.items.0') is resp.json()['data']['items'][0]
+    assert resp.extraction().json('data.items.*.id') == [1, 2]
+
+
+def test_retry_wait_excluded_from_total(server):
+    statuses = [503, 200]
+    server.routes['/flaky'] = lambda request: (statuses.pop(0), {}, b'{}')
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().retry(total=1, backoff=0.3, jitter=False)
+    metrics = driver.get('flaky').metrics
+    assert metrics['retries'] == 1
+    assert metrics['retry_wait'] >= 0.3
+    assert metrics['total'] < 0.3
+    assert metrics['download'] < 0.3
+
+
+def test_send_many(server):
+    def slow(request):
+        time.sleep(0.2 if '/0' in request['path'] else 0)
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'path': request['path']}).encode()
+
+    for n in range(6):
+        server.routes['/user/{}'.format(n)] = slow
+    driver = HTTPDriver(base_url=server.url)
+    before = driver.get('before')
+    specs = [{'url': 'user/{uid}', 'path_params': {'uid': n}, 'params': {'n': n}} for n in range(6)]
+    specs[1]['method'] = 'POST'
+    resps = driver.send_many(specs, max_workers=3)
+    assert [resp.json()['path'] for resp in resps] == ['/user/{0}?n={0}'.format(n) for n in range(6)]
+    assert len(set(map(id, resps))) == 6
+    assert driver.resp is before
+    assert sorted(request['method'] for request in server.requests) == ['GET'] * 6 + ['POST']
+    # 1 个连接用于之前的请求，线程池最多再新建 3 个
+    assert len(server.connections) <= 4
+
+
+def test_send_many_raises_transport_errors():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+    with pytest.raises(requests.ConnectionError):
+        HTTPDriver(base_url=url).send_many([{'url': 'a'}, {'url': 'b'}])
+
+
+SCHEMA = '''
+type: object
+required: [id, items]
+properties:
+  id: {type: integer}
+  items:
+    type: array
+    items: {type: object, required: [name], properties: {price: {type: number}}}
+'''
+
+
+def test_schema_cache(tmp_path, monkeypatch):
+    path = tmp_path / 'user.yaml'
+    path.write_text(SCHEMA, encoding='utf-8')
+    validator = SchemaCache.validator(str(path))
+    assert SchemaCache.validator(str(path)) is validator
+    path.write_text('{"type": "object", "required": ["id"]}', encoding='utf-8')
+    os.utime(str(path), (time.time() + 10, time.time() + 10))
+    assert SchemaCache.validator(str(path)) is not validator
+    invalid = tmp_path / 'invalid.json'
+    invalid.write_text('{"type": 1}', encoding='utf-8')
+    with pytest.raises(jsonschema.SchemaError):
+        SchemaCache.validator(str(invalid))
+
+
+def test_validation(server, tmp_path):
+    path = tmp_path / 'user.yaml'
+    path.write_text(SCHEMA, encoding='utf-8')
+    bodies = [b'{"id": 1, "items": [{"name": "a", "price": 9.5}]}',
+              b'{"id": "1", "items": [{"price": "free"}, {"name": "b"}]}']
+    server.routes['/user'] = lambda request: (200, {'Content-Type': 'application/json'}, bodies.pop(0))
+    driver = HTTPDriver(base_url=server.url)
+    driver.get('user').validation(str(path))
+    with pytest.raises(AssertionError) as e:
+        driver.get('user').validation(str(path))
+    message = str(e.value)
+    assert message.startswith('3 schema violations')
+    assert '$.id' in message
+    assert '$.items[0]: ' in message
+    assert '$.items[0].price' in message
+
+
+@pytest.fixture
+def upload_file(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(os.urandom(300 * 1024))
+    return path
+
+
+def test_upload_stream_reads_mapped_file(upload_file, tmp_path):
+    empty = tmp_path / 'empty.bin'
+    empty.write_bytes(b'')
+    stream = UploadStream([b'head', str(upload_file), str(empty), b'tail'], 'application/octet-stream',
+                          chunk_size=64 * 1024)
+    assert stream.len == stream.total == upload_file.stat().st_size + 8
+    chunks = []
+    for chunk in stream:
+        if len(chunks) == 1:
+            assert isinstance(stream._mmap, mmap.mmap)
+        chunks.append(chunk)
+    assert b''.join(chunks) == b'head' + upload_file.read_bytes() + b'tail'
+    assert max(map(len, chunks)) == 64 * 1024
+    assert stream._file is None
+    assert stream.metrics()['upload_bytes'] == stream.total
+    stream.rewind()
+    assert stream.read(4) == b'head'
+    assert UploadStream.file(str(upload_file), chunked=True).len == 0
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_upload_file(server, upload_file, chunked):
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().upload(str(upload_file), chunked=chunked)
+    metrics = driver.put('files').metrics
+    request = server.requests[-1]
+    assert request['body'] == upload_file.read_bytes()
+    assert request['headers']['Content-Type'] == 'application/octet-stream'
+    if chunked:
+        assert request['headers']['Transfer-Encoding'] == 'chunked'
+        assert 'Content-Length' not in request['headers']
+    else:
+        assert request['headers']['Content-Length'] == str(upload_file.stat().st_size)
+    assert metrics['upload_bytes'] == upload_file.stat().st_size
+
+
+def test_upload_multipart(server, upload_file):
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().form_param('album', '相册').upload(str(upload_file), 'file', 'photo.bin', 'image/png')
+    driver.post('files')
+    request = server.requests[-1]
+    message = email.message_from_bytes(
+        b'Content-Type: ' + request['headers']['Content-Type'].encode() + b'\r\n\r\n' + request['body']
+    )
+    album, photo = message.get_payload()
+    assert album.get_param('name', header='Content-Disposition') == 'album'
+    assert album.get_payload(decode=True).decode('utf-8') == '相册'
+    assert photo.get_filename() == 'photo.bin'
+    assert photo.get_content_type() == 'image/png'
+    assert photo.get_payload(decode=True) == upload_file.read_bytes()
+
+
+def test_upload_rewinds_on_retry(server, upload_file):
+    statuses = [503, 200]
+    server.routes['/files'] = lambda request: (statuses.pop(0), {}, b'{}')
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().retry(total=1, backoff=0, jitter=False).upload(str(upload_file))
+    resp = driver.put('files')
+    assert resp.metrics['retries'] == 1
+    assert [request['body'] for request in server.requests] == [upload_file.read_bytes()] * 2
+    assert resp.metrics['upload_bytes'] == upload_file.stat().st_size
+
+
+def test_cassette_redacts_sensitive_headers(server, tmp_path):
+    server.routes['/login'] = lambda request: (200, {'Set-Cookie': 'sid=secret-sid; Path=/'}, b'{}')
+    path = str(tmp_path / 'api.cassette')
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().header_param('Authorization', 'Bearer secret-token').record(path)
+    driver.post('login')
+    driver.get('me', headers={'Authorization': 'Bearer secret-token', 'X-Api-Key': 'k'})
+    driver.cassette.close()
+    with open(path, encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+    assert 'secret' not in json.dumps(entries)
+    assert entries[0]['response_headers']['Set-Cookie'] == Cassette.REDACTED
+    assert entries[1]['headers']['Cookie'] == entries[1]['headers']['Authorization'] == Cassette.REDACTED
+    assert entries[1]['headers']['X-Api-Key'] == 'k'
+
+    # 回放时不按这些请求头匹配
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().replay(path)
+    assert driver.get('me', headers={'Authorization': 'Bearer other'}).json()['path'] == '/me'
+    driver.cassette.close()
+
+
+def test_cassette_custom_sensitive_headers(server, tmp_path):
+    path = str(tmp_path / 'api.cassette')
+    driver = HTTPDriver(base_url=server.url)
+    driver.arrangement().record(path, sensitive_headers=['x-api-key'])
+    driver.get('me', headers={'Authorization': 'Bearer t', 'X-Api-Key': 'k'})
+    driver.cassette.close()
+    with open(path, encoding='utf-8') as f:
+        headers = json.loads(f.readline())['headers']
+    assert headers['X-Api-Key'] == Cassette.REDACTED
+    assert headers['Authorization'] == 'Bearer t'
@@ -0,0 +1,682 @@
+# coding:utf-8
+import os
+import json
+import time
+import queue
+import base64
+from types import SimpleNamespace
+from collections import OrderedDict
+import pytest
+
+pytest.importorskip('selenium')
+pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+from selenium.webdriver.common.by import By  # noqa: E402
+from selenium.webdriver.remote.webelement import WebElement  # noqa: E402
+from selenium.common.exceptions import StaleElementReferenceException, WebDriverException, \
+    TimeoutException  # noqa: E402
+from lutra.driver.selenium import XP, UIDriver, ElementCache, WebDriverPool, QuietWait, ObserverWait, \
+    Expect, Elem, Elems, TemplateMatcher, Screenshots, DevToolsCapture  # noqa: E402
+from lutra.driver import selenium as lutra_selenium  # noqa: E402
+from lutra.util import Assert  # noqa: E402
+
+ROW = 'contains(concat(" ", normalize-space(@class), " "), " row ")'
+
+
+def test_unscoped_locator_uses_id_and_css():
+    locator = XP.id('x')
+    assert locator == '(//*[@id="x"])[1]'
+    assert locator.css == '[id="x"]'
+    assert locator.simple == '//*[@id="x"]'
+    assert locator.chain == ((By.ID, 'x'),)
+    assert locator.every == ((By.CSS_SELECTOR, '[id="x"]'),)
+
+
+def test_first_match_scope_keeps_its_index():
+    locator = XP.id('x', scope=XP.class_name('row'))
+    scoped = '(//*[{}])[1]//*[@id="x"]'.format(ROW)
+    assert locator == '({})[1]'.format(scoped)
+    assert locator.css is None
+    assert locator.simple == scoped
+    assert locator.chain == ((By.XPATH, scoped),)
+    assert locator.every == ((By.XPATH, scoped),)
+
+
+def test_nth_in_scope():
+    locator = XP.id('x', scope=XP.class_name('row', nth=2), nth=3)
+    scoped = '(//*[{}])[2]//*[@id="x"]'.format(ROW)
+    assert locator == '({})[3]'.format(scoped)
+    assert locator.css is None
+    assert locator.chain == ((By.XPATH, locator),)
+    assert locator.every == ((By.XPATH, scoped),)
+
+
+def test_xpath_string_scope_matches_all():
+    locator = XP.id('x', scope='//div[@class="row"]')
+    assert locator == '(//div[@class="row"]//*[@id="x"])[1]'
+    assert locator.css is None
+    assert locator.chain == ((By.XPATH, '//div[@class="row"]//*[@id="x"]'),)
+
+
+@pytest.mark.parametrize('locator, chain', [
+    (XP.id('x', scope=(By.CSS_SELECTOR, '.row')), ((By.CSS_SELECTOR, '.row'), (By.CSS_SELECTOR, '[id="x"]'))),
+    (XP.text('a', scope=(By.CSS_SELECTOR, '.row')), ((By.CSS_SELECTOR, '.row'), (By.XPATH, './/*[text()="a"]'))),
+    (XP.id('x', scope=(By.CSS_SELECTOR, '.row'), relative=False), ((By.CSS_SELECTOR, '.row'), (By.XPATH, './*[@id="x"]'))),
+    (XP.id('x', scope=(By.CSS_SELECTOR, '.row'), nth=2), ((By.CSS_SELECTOR, '.row'), (By.XPATH, '(.//*[@id="x"])[2]'))),
+    (XP.tag('td', scope=XP.id('x', scope=(By.CSS_SELECTOR, '.row'))),
+     ((By.CSS_SELECTOR, '.row'), (By.CSS_SELECTOR, '[id="x"]'), (By.CSS_SELECTOR, 'td'))),
+])
+def test_css_scope_chains_from_first_match(locator, chain):
+    assert locator.css is None
+    assert locator.chain == chain
+
+
+def test_split_locator():
+    locator = XP.id('x', scope=(By.CSS_SELECTOR, '.row'))
+    assert UIDriver._split_locator(('名字', XP.id('x'))) == ('名字', By.ID, 'x')
+    assert UIDriver._split_locator(locator) == ('未命名', 'lutra chain', locator.chain)
+    assert UIDriver._split_locator(locator, every=True)[2] == locator.every
+
+
+class FakeWebDriver:
+    """
+    只实现元素查找和元素命令的 WebDriver，stale 中的元素 id 执行命令时抛出 StaleElementReferenceException
+    """
+    def __init__(self):
+        self.finds = []
+        self.commands = []
+        self.stale = set()
+
+    def find_element(self, by, value):
+        self.finds.append((by, value))
+        return WebElement(self, '{}-{}'.format(value, len(self.finds)))
+
+    def execute(self, command, params=None):
+        self.commands.append(command)
+        if params and params.get('id') in self.stale:
+            raise StaleElementReferenceException()
+        return {'value': params.get('id')}
+
+
+def test_element_cache_hits_without_round_trips():
+    webdriver, cache = FakeWebDriver(), ElementCache()
+    element = cache.get(webdriver, By.ID, 'x')
+    assert cache.get(webdriver, By.ID, ' x ') is element
+    assert webdriver.finds == [(By.ID, 'x')]
+    assert webdriver.commands == []
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'stale': 0, 'size': 1, 'saved': 1}
+
+
+def test_element_cache_resolves_stale_elements_on_use():
+    webdriver, cache = FakeWebDriver(), ElementCache()
+    element = cache.get(webdriver, By.ID, 'x')
+    # 页面跳转后旧元素失效
+    webdriver.stale.add(element.id)
+    assert element.text == 'x-2'
+    assert cache.get(webdriver, By.ID, 'x').text == 'x-2'
+    assert len(webdriver.finds) == 2
+    assert cache.stats()['stale'] == 1
+    assert cache.stats()['saved'] == 0
+    cache.clear()
+    cache.get(webdriver, By.ID, 'x')
+    assert len(webdriver.finds) == 3
+
+
+class FakeBrowser:
+    """
+    windows 为 窗口句柄 -> (历史记录, 当前 iframe 的 URL)
+    """
+    def __init__(self, windows):
+        self.windows = dict(windows)
+        self.current_window_handle = next(iter(self.windows))
+        self.switch_to = SimpleNamespace(window=self._switch)
+        self.url = None
+        self.size = None
+        self.quitted = False
+
+    @property
+    def window_handles(self):
+        return list(self.windows)
+
+    def _switch(self, handle):
+        self.current_window_handle = handle
+
+    def close(self):
+        del self.windows[self.current_window_handle]
+
+    def get(self, url):
+        self.url = url
+
+    def set_window_size(self, width, height):
+        self.size = width, height
+
+    def quit(self):
+        self.quitted = True
+
+
+class FakeChrome(FakeBrowser):
+    def __init__(self, windows):
+        super().__init__(windows)
+        self.commands = []
+
+    def execute_cdp_cmd(self, command, params):
+        self.commands.append((command, params))
+        history, frames = self.windows[self.current_window_handle]
+        if command == 'Page.getNavigationHistory':
+            return {'entries': [{'url': url} for url in history]}
+        if command == 'Page.getFrameTree':
+            return {'frameTree': {'frame': {'url': history[-1]},
+                                  'childFrames': [{'frame': {'url': url}} for url in frames]}}
+        return {}
+
+
+def pooled(webdriver):
+    return SimpleNamespace(webdriver=webdriver, browser='chrome', headless=True, width=800, height=600,
+                           mobile_device=None, proxy='', bypass='', user_agent=None, remote_server=None,
+                           remote_browser=None, devtools=False)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(WebDriverPool, '_idle', dict())
+    monkeypatch.setattr(WebDriverPool, '_uses', dict())
+    return WebDriverPool
+
+
+def test_pool_reset_clears_every_origin(pool):
+    browser = FakeChrome({
+        'main': (['https://a.example/login', 'https://b.example:8443/home?x=1'], ['https://ads.example/frame']),
+        'popup': (['about:blank', 'http://c.example/pay'], []),
+    })
+    ui_driver = pooled(browser)
+    pool.release(ui_driver)
+    assert ui_driver.webdriver is None
+    assert not browser.quitted
+    assert browser.window_handles == ['main']
+    assert browser.url == 'about:blank'
+    assert browser.size == (800, 600)
+    origins = ['http://c.example', 'https://a.example', 'https://ads.example', 'https://b.example:8443']
+    cleared = [params['origin'] for command, params in browser.commands if command == 'Storage.clearDataForOrigin']
+    assert cleared == origins
+    sessions = [params['storageId'] for command, params in browser.commands if command == 'DOMStorage.clear']
+    assert sessions == [{'securityOrigin': origin, 'isLocalStorage': False} for origin in origins]
+    assert browser.commands[-1] == ('Network.clearBrowserCookies', {})
+    assert pool.borrow(pooled(None)) is browser
+
+
+def test_pool_quits_browsers_without_devtools(pool):
+    browser = FakeBrowser({'main': (['https://a.example/'], [])})
+    pool.release(pooled(browser))
+    assert browser.quitted
+    assert pool._idle == {}
+
+
+class ScriptedWebDriver:
+    """
+    execute_async_script 依次返回 results 中的值（异常则抛出），并记录调用参数
+    """
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+        self.script_timeout = None
+
+    def execute_async_script(self, script, *args):
+        self.calls.append((script, args))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def set_script_timeout(self, seconds):
+        self.script_timeout = seconds
+
+
+@pytest.fixture
+def quiet_stats(monkeypatch):
+    monkeypatch.setattr(QuietWait, 'stats', {'waits': 0, 'waited': 0.0, 'fixed': 0.0, 'timeouts': 0})
+    sleeps = []
+    monkeypatch.setattr('time.sleep', sleeps.append)
+    return sleeps
+
+
+def test_quiet_wait(quiet_stats):
+    webdriver = ScriptedWebDriver(True, False, WebDriverException('alert open'))
+    ui_driver = SimpleNamespace(webdriver=webdriver)
+    QuietWait.wait(ui_driver, 0.5)
+    assert webdriver.calls[0] == (QuietWait.script, (QuietWait.quiet * 1000, QuietWait.timeout * 1000))
+    QuietWait.wait(ui_driver, 0.5)
+    assert quiet_stats == []
+    # 脚本无法执行时退回固定等待
+    QuietWait.wait(ui_driver, 0.5)
+    assert quiet_stats == [0.5]
+    report = QuietWait.report()
+    assert (report['waits'], report['fixed'], report['timeouts']) == (3, 1.5, 1)
+    assert report['saved'] == pytest.approx(report['fixed'] - report['waited'])
+
+
+def test_pause_modes(quiet_stats):
+    ui_driver = UIDriver.__new__(UIDriver)
+    ui_driver.interval, ui_driver.wait_mode, ui_driver.webdriver = 0.5, 'quiet', ScriptedWebDriver(True)
+    ui_driver.pause(extra=0.25)
+    assert QuietWait.stats['fixed'] == 0.75
+    assert quiet_stats == []
+    # 指定 interval 或 fixed 模式时固定等待
+    ui_driver.pause(0.1)
+    ui_driver.wait_mode = 'fixed'
+    ui_driver.pause(extra=0.25)
+    assert quiet_stats == [0.1, 0.75]
+    assert QuietWait.stats['waits'] == 1
+
+
+def observer_driver(webdriver):
+    ui_driver = UIDriver.__new__(UIDriver)
+    ui_driver.webdriver, ui_driver.timeout, ui_driver.interval = webdriver, 10, 0
+    ui_driver.wait_mode, ui_driver.element_wait, ui_driver.element_cache = 'fixed', 'observer', None
+    return ui_driver
+
+
+def test_observer_until_retries_after_navigation(quiet_stats, monkeypatch):
+    monkeypatch.setattr(ObserverWait, '_script_timeouts', dict())
+    element = SimpleNamespace(location={'x': 0, 'y': 0})
+    webdriver = ScriptedWebDriver(WebDriverException('navigated'), element)
+    assert ObserverWait.until(observer_driver(webdriver), By.ID, 'x', 'visible', timeout=40) is element
+    assert len(webdriver.calls) == 2
+    by, value, condition, negate, milliseconds = webdriver.calls[1][1]
+    assert (by, value, condition, negate) == (By.ID, 'x', 'visible', False)
+    assert 39000 < milliseconds <= 40000
+    # 超过 chromedriver 缺省的 30 秒异步脚本超时
+    assert webdriver.script_timeout > 40
+
+
+def test_observer_until_timeout(quiet_stats):
+    with pytest.raises(TimeoutException, match='未不满足条件 visible'):
+        ObserverWait.until(observer_driver(ScriptedWebDriver(False)), By.ID, 'x', 'visible', negate=True)
+    webdriver = ScriptedWebDriver(TimeoutException('script timeout'))
+    with pytest.raises(TimeoutException, match='script timeout'):
+        ObserverWait.until(observer_driver(webdriver), By.ID, 'x', 'visible')
+    assert len(webdriver.calls) == 1
+
+
+def test_find_uses_observer_wait(quiet_stats):
+    element = SimpleNamespace(location={'x': 0, 'y': 0})
+    webdriver = ScriptedWebDriver(element, True)
+    ui_driver = observer_driver(webdriver)
+    found = ui_driver._find('名字', By.CSS_SELECTOR, '.x', until=Expect.clickable)
+    assert isinstance(found, Elem)
+    assert found.selenium_elem is element
+    assert ui_driver._find('名字', By.CSS_SELECTOR, '.x', until_not=Expect.visible) is None
+    assert [call[1][2:4] for call in webdriver.calls] == [('clickable', False), ('visible', True)]
+
+
+def test_wait_until_rechecks_after_dom_changes(quiet_stats):
+    webdriver = ScriptedWebDriver(True, True)
+    checks = iter([AssertionError('not yet'), None, 'done'])
+
+    def condition():
+        result = next(checks)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert observer_driver(webdriver).wait_until(condition) == 'done'
+    assert [call[0] for call in webdriver.calls] == [ObserverWait.changed_script] * 2
+
+
+class PageWebDriver(ScriptedWebDriver):
+    """
+    Elems 的脚本依次看到 pages 中的页面，每个页面是元素的 (文本, 特性) 列表，最后一个页面之后保持不变
+    """
+    def __init__(self, *pages):
+        super().__init__(*([True] * 10))
+        self.pages = list(pages)
+        self.scripts = []
+
+    def execute_script(self, script, by, value, keys, elements):
+        self.scripts.append((by, value, list(keys), elements))
+        page = self.pages.pop(0) if len(self.pages) > 1 else self.pages[0]
+        elements = [SimpleNamespace(text=text) for text, attributes in page]
+        snapshots = [{'text': text, 'tag_name': 'li', 'rect': {'x': 0, 'y': 20 * n, 'width': 100, 'height': 20},
+                      'displayed': True, 'enabled': True, 'selected': False,
+                      'attributes': {key: attributes.get(key) for key in keys}}
+                     for n, (text, attributes) in enumerate(page)]
+        return elements, snapshots
+
+
+ROWS = [('a', {'data-id': '1'}), ('b', {'data-id': '2'})]
+
+
+def test_find_all_snapshots(quiet_stats):
+    webdriver = PageWebDriver(ROWS)
+    ui_driver = observer_driver(webdriver)
+    elems = ui_driver.find_all(XP.tag('li', scope=(By.CSS_SELECTOR, '.list'), nth=2), ['data-id'])
+    assert webdriver.scripts == [('lutra chain', ((By.CSS_SELECTOR, '.list'), (By.XPATH, './/li')), ['data-id'], None)]
+    assert len(elems) == 2
+    assert [elem.selenium_elem.text for elem in elems] == ['a', 'b']
+    assert isinstance(elems[1], Elem)
+    assert elems.values() == ['a', 'b']
+    assert elems.values('data-id') == ['1', '2']
+    assert elems.extraction().snapshots()[1]['rect']['y'] == 20
+    assert len(webdriver.scripts) == 1
+    # 不在快照中的特性会重新取回一次
+    assert elems.values('href') == [None, None]
+    assert webdriver.scripts[-1][2] == ['data-id', 'href']
+
+
+def test_elems_assertion(quiet_stats):
+    webdriver = PageWebDriver(ROWS[:1], ROWS[:1], ROWS[:1], ROWS)
+    ui_driver = observer_driver(webdriver)
+    ui_driver.element_wait = 'poll'
+    elems = ui_driver.find_all((By.CSS_SELECTOR, 'li'))
+    with pytest.raises(AssertionError):
+        elems.assertion().count(Assert.equal_to(2))
+    # observer 模式下重新查找，直到断言通过
+    ui_driver.element_wait = 'observer'
+    elems = ui_driver.find_all((By.CSS_SELECTOR, 'li'), ['data-id'])
+    elems.assertion().count(Assert.equal_to(2)).each(Assert.gt('0'), 'data-id').values(Assert.equal_to(['a', 'b']))
+    assert len(webdriver.scripts) == 4
+    assert [call[0] for call in webdriver.calls] == [ObserverWait.changed_script]
+    assert elems.extraction().count() == 2
+
+
+def texture(width, height, seed):
+    # 平滑的随机纹理，缩放后仍然可以匹配
+    noise = np.random.RandomState(seed).randint(0, 256, (height // 8 + 1, width // 8 + 1)).astype(np.uint8)
+    return cv2.resize(noise, None, fx=8, fy=8, interpolation=cv2.INTER_CUBIC)[:height, :width]
+
+
+@pytest.fixture
+def screen(tmp_path, monkeypatch):
+    monkeypatch.setattr(TemplateMatcher, '_templates', OrderedDict())
+    src = texture(1280, 800, 1)
+    path = str(tmp_path / 'button.png')
+    cv2.imwrite(path, src[500:560, 900:980])
+    return src, path
+
+
+@pytest.fixture
+def best_calls(monkeypatch):
+    calls = []
+    best = TemplateMatcher._best
+
+    def spy(src, template, *args):
+        calls.append(src.shape)
+        return best(src, template, *args)
+
+    monkeypatch.setattr(TemplateMatcher, '_best', staticmethod(spy))
+    return calls
+
+
+def test_template_match_coarse_to_fine(screen, best_calls):
+    src, path = screen
+    match = TemplateMatcher.match(src, path)
+    assert match > 0.99
+    assert match.rect == (900, 500, 80, 60)
+    assert match.center == (940, 530)
+    # 先在缩小到 640 宽的截图上粗匹配，再在候选位置附近的小窗口中精确匹配
+    assert best_calls[0] == (400, 640)
+    assert best_calls[1][0] < 100 and best_calls[1][1] < 120
+    assert len(best_calls) == 2
+
+
+def test_template_match_region(screen, best_calls):
+    src, path = screen
+    match = TemplateMatcher.match(src, path, region=(800, 400, 300, 200))
+    assert match.rect == (900, 500, 80, 60)
+    assert best_calls == [(200, 300)]
+
+
+def test_template_match_scales(screen):
+    src, path = screen
+    template = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    src = src.copy()
+    src[100:175, 200:300] = cv2.resize(template, (100, 75), interpolation=cv2.INTER_LINEAR)
+    src[500:560, 900:980] = texture(80, 60, 2)
+    match = TemplateMatcher.match(src, path, similarity=0.9, scales=(1.0, 1.25))
+    assert match >= 0.9
+    assert match.scale == 1.25
+    assert match.rect == (200, 100, 100, 75)
+
+
+def test_template_match_failure_rechecks_full_resolution(screen, best_calls):
+    src, path = screen
+    match = TemplateMatcher.match(texture(1280, 800, 3), path)
+    assert match < 0.8
+    assert best_calls[-1] == (800, 1280)
+
+
+def test_template_cache(screen, monkeypatch):
+    src, path = screen
+    monkeypatch.setattr(TemplateMatcher, 'max_scales', 2)
+    image = TemplateMatcher.template(path)
+    assert TemplateMatcher.template(path) is image
+    half = TemplateMatcher.template(path, 0.5)
+    assert half.shape == (30, 40)
+    assert TemplateMatcher.template(path, 0.501) is half
+    TemplateMatcher.template(path, 0.6)
+    TemplateMatcher.template(path, 0.7)
+    assert list(TemplateMatcher._templates[path][2]) == [0.6, 0.7]
+    cv2.imwrite(path, src[:10, :10])
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert TemplateMatcher.template(path).shape == (10, 10)
+
+
+def canvas_gray(rgba):
+    # 与 canvas_script 相同的整数运算
+    rgba = rgba.astype(np.uint32)
+    return ((rgba[..., 0] * 9798 + rgba[..., 1] * 19235 + rgba[..., 2] * 3735 + 16384) >> 15).astype(np.uint8)
+
+
+class CanvasWebDriver:
+    def __init__(self, rgba):
+        self.rgba = rgba
+        self.calls = []
+
+    def execute_script(self, script, canvas_id, region):
+        self.calls.append((canvas_id, region))
+        if canvas_id != 'game':
+            return None
+        x, y, width, height = region or (0, 0, self.rgba.shape[1], self.rgba.shape[0])
+        gray = canvas_gray(self.rgba[y:y + height, x:x + width])
+        return [width, height, base64.b64encode(gray.tobytes()).decode()]
+
+
+def canvas_driver(rgba):
+    ui_driver = UIDriver.__new__(UIDriver)
+    ui_driver.webdriver = CanvasWebDriver(rgba)
+    return ui_driver
+
+
+def test_canvas_gray_matches_opencv():
+    rgb = np.random.RandomState(0).randint(0, 256, (256, 256, 3)).astype(np.uint8)
+    rgba = np.dstack([rgb, np.full((256, 256), 255, np.uint8)])
+    assert np.array_equal(canvas_gray(rgba), cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY))
+
+
+def test_canvas_pixels_reshape():
+    rgba = np.random.RandomState(0).randint(0, 256, (30, 50, 4)).astype(np.uint8)
+    ui_driver = canvas_driver(rgba)
+    pixels = ui_driver.canvas_pixels('game')
+    assert pixels.shape == (30, 50)
+    assert np.array_equal(pixels, canvas_gray(rgba))
+    pixels = ui_driver.canvas_pixels('game', (10, 5, 7, 3))
+    assert pixels.shape == (3, 7)
+    assert np.array_equal(pixels, canvas_gray(rgba[5:8, 10:17]))
+    assert ui_driver.webdriver.calls[-1] == ('game', [10, 5, 7, 3])
+    with pytest.raises(Exception, match='找不到 Canvas'):
+        ui_driver.canvas_pixels('missing')
+
+
+def test_template_match_for_canvas(screen):
+    src, path = screen
+    rgba = np.dstack([src, src, src, np.full(src.shape, 255, np.uint8)])
+    ui_driver = canvas_driver(rgba)
+    match = ui_driver.template_match_for_canvas('game', path, region=(800, 400, 300, 200))
+    assert match.rect == (900, 500, 80, 60)
+    with pytest.raises(Exception, match='Template match failed'):
+        ui_driver.template_match_for_canvas('game', path, region=(0, 0, 300, 200))
+
+
+def png(seed, width=64, height=48):
+    return cv2.imencode('.png', texture(width, height, seed))[1].tobytes()
+
+
+class ScreenWebDriver:
+    def __init__(self, *screens):
+        self.screens = list(screens)
+
+    def get_screenshot_as_png(self):
+        return self.screens.pop(0)
+
+
+@pytest.fixture
+def attachments(monkeypatch):
+    attached = []
+    monkeypatch.setattr(lutra_selenium, 'attach', lambda body, name, attachment_type: attached.append(
+        (name, body, attachment_type)))
+    monkeypatch.setattr(Screenshots, '_seen', dict())
+    monkeypatch.setattr(Screenshots, 'background', False)
+    return attached
+
+
+def test_screenshots_dedupe_per_test(attachments, monkeypatch):
+    first, second = png(1), png(2)
+    webdriver = ScreenWebDriver(first, first, second, first)
+    monkeypatch.setenv('PYTEST_CURRENT_TEST', 'tests/test_a.py::test_a (call)')
+    Screenshots.attach(webdriver, '失败后截图')
+    Screenshots.attach(webdriver, '再次截图')
+    Screenshots.attach(webdriver, '其他截图')
+    assert [(name, body) for name, body, _ in attachments] == [
+        ('失败后截图', first), ('再次截图', '与截图「失败后截图」相同'), ('其他截图', second)
+    ]
+    # 换了测试重新开始去重
+    monkeypatch.setenv('PYTEST_CURRENT_TEST', 'tests/test_a.py::test_b (call)')
+    Screenshots.attach(webdriver, '失败后截图')
+    assert attachments[-1][1] == first
+
+
+def test_screenshots_element_scope(attachments, monkeypatch):
+    monkeypatch.setattr(Screenshots, 'scope', 'element')
+    element = SimpleNamespace(screenshot_as_png=png(3, 16, 16))
+    Screenshots.attach(ScreenWebDriver(png(4)), '失败后截图', element)
+    assert attachments[-1][1] == element.screenshot_as_png
+
+
+def test_screenshots_encode(monkeypatch):
+    monkeypatch.setattr(Screenshots, 'format', 'jpeg')
+    monkeypatch.setattr(Screenshots, 'max_width', 32)
+    jpeg = Screenshots.encode(png(5))
+    assert jpeg[:2] == b'\xff\xd8'
+    assert cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR).shape == (24, 32, 3)
+    monkeypatch.setattr(Screenshots, 'format', 'png')
+    monkeypatch.setattr(Screenshots, 'max_width', 0)
+    assert Screenshots.encode(png(5)) == png(5)
+
+
+def test_screenshots_background(attachments, monkeypatch):
+    import allure_commons
+
+    class Reporter:
+        def __init__(self):
+            self.written = dict()
+            self.allure_logger = self
+
+        def _attach(self, uuid, name, attachment_type):
+            return '{}.{}'.format(name, attachment_type.extension)
+
+        @allure_commons.hookimpl
+        def report_attached_data(self, body, file_name):
+            self.written[file_name] = body
+
+    reporter = Reporter()
+    allure_commons.plugin_manager.register(reporter)
+    try:
+        monkeypatch.setattr(Screenshots, 'background', True)
+        monkeypatch.setattr(Screenshots, 'format', 'jpeg')
+        Screenshots.attach(ScreenWebDriver(png(6)), 'shot')
+        Screenshots.flush()
+    finally:
+        allure_commons.plugin_manager.unregister(reporter)
+    assert attachments == []
+    assert list(reporter.written) == ['shot.jpg']
+    assert reporter.written['shot.jpg'][:2] == b'\xff\xd8'
+
+
+class FakeConnection:
+    """
+    DevTools 的 WebSocket 连接，recv 依次返回 put 的消息，close 后抛出异常
+    """
+    def __init__(self):
+        self.sent = []
+        self.messages = queue.Queue()
+
+    def put(self, method, **params):
+        self.messages.put(json.dumps({'method': method, 'params': params}))
+
+    def send(self, message):
+        self.sent.append(json.loads(message))
+
+    def recv(self):
+        message = self.messages.get()
+        if message is None:
+            raise ConnectionError('closed')
+        return message
+
+    def close(self):
+        self.messages.put(None)
+
+
+@pytest.fixture
+def capture(monkeypatch):
+    websocket = pytest.importorskip('websocket')
+    connection = FakeConnection()
+    monkeypatch.setattr(websocket, 'create_connection', lambda url, **kwargs: connection)
+    capture = DevToolsCapture('ws://127.0.0.1/devtools/page/1', size=3)
+    yield capture
+    capture.close()
+    capture.thread.join(1)
+
+
+def test_devtools_ring_buffer(capture):
+    connection = capture.connection
+    assert [message['method'] for message in connection.sent] == ['Runtime.enable', 'Log.enable', 'Network.enable']
+    for n in range(5):
+        connection.put('Runtime.consoleAPICalled', type='log', args=[{'type': 'string', 'value': n}])
+    deadline = time.time() + 2
+    while (not capture.events or capture.events[-1][3] != '4') and time.time() < deadline:
+        time.sleep(0.01)
+    assert [event[1:] for event in capture.recent()] == [('console', 'log', str(n)) for n in (2, 3, 4)]
+    # 记录之前的请求 URL 的表也不超过上限
+    for n in range(5):
+        connection.put('Network.requestWillBeSent', requestId=str(n), request={'method': 'GET', 'url': '/{}'.format(n)})
+    connection.put('Network.responseReceived', requestId='4', response={'status': 502, 'url': '/4'})
+    connection.put('Network.loadingFailed', requestId='0', errorText='net::ERR_FAILED')
+    connection.put('Runtime.exceptionThrown', exceptionDetails={'text': 'Uncaught', 'exception': {
+        'description': 'TypeError: x is undefined'}})
+    deadline = time.time() + 2
+    while capture.events[-1][1] != 'exception' and time.time() < deadline:
+        time.sleep(0.01)
+    assert [event[1:] for event in capture.recent()] == [
+        ('network', 'error', '502 GET /4'),
+        ('network', 'error', 'net::ERR_FAILED 0'),
+        ('exception', 'error', 'TypeError: x is undefined'),
+    ]
+    assert list(capture.requests) == ['2', '3']
+
+
+def test_devtools_recent_and_attach(capture, monkeypatch):
+    attached = []
+    monkeypatch.setattr(lutra_selenium, 'attach', lambda body, name, attachment_type: attached.append((name, body)))
+    now = time.time()
+    capture.events.extend([(now - 60, 'console', 'log', 'old'), (now - 1, 'console', 'error', 'boom')])
+    assert [event[3] for event in capture.recent()] == ['boom']
+    assert [event[3] for event in capture.recent(120)] == ['old', 'boom']
+    capture.attach()
+    (name, body), = attached
+    assert name == '浏览器日志（最近 30 秒）'
+    assert body.endswith('[console:error] boom')
+    capture.clear()
+    assert capture.recent(120) == []
+    capture.attach()
+    assert len(attached) == 1
@@ -0,0 +1,77 @@
+# coding:utf-8
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from lutra.util import StepMode, step, json_parser, compile_path
+
+
+@pytest.fixture
+def lean(monkeypatch):
+    monkeypatch.setattr(StepMode, 'lean', True)
+    monkeypatch.setattr(StepMode, 'enabled', True)
+    monkeypatch.setattr(StepMode, 'sample_every', 10)
+    monkeypatch.setattr(StepMode, '_counts', dict())
+
+
+def test_step_sampling_across_threads(lean):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sampled = list(executor.map(lambda _: StepMode.sampled('title'), range(1000)))
+    assert sum(sampled) == 100
+    assert StepMode._counts['title'] == 1000
+
+
+def test_sampled_out_step_failure_is_raised(lean):
+    calls = []
+
+    @step
+    def fail(n):
+        calls.append(n)
+        raise AssertionError(n)
+
+    for n in range(3):
+        with pytest.raises(AssertionError):
+            fail(n)
+    assert calls == [0, 1, 2]
+
+
+DATA = {
+    'items': [
+        {'id': 1, 'price': 9.5, 'on_sale': True, 'tags': ['a', 'b']},
+        {'id': 2, 'price': 12, 'on_sale': False, 'tags': []},
+        {'id': 3, 'price': 20, 'on_sale': True},
+    ],
+    'schedule': {'12:30': 'lunch', '9:': 'morning'},
+    'meta': {'total': 3},
+}
+
+
+@pytest.mark.parametrize('key, expected', [
+    ('meta.total', 3),
+    ('items.0.id', 1),
+    ('items.-1.id', 3),
+    ('items.*.id', [1, 2, 3]),
+    ('items.0:2.id', [1, 2]),
+    ('items.::2.id', [1, 3]),
+    ('items.1:', DATA['items'][1:]),
+    ('items.?(price>=12).id', [2, 3]),
+    ('items.?(on_sale).id', [1, 3]),
+    ('items.?(id!=2).price', [9.5, 20]),
+    ('items.*.tags.0', ['a']),
+    ('schedule.12:30', 'lunch'),
+    ('schedule.9:', 'morning'),
+    ('meta.*', [3]),
+])
+def test_json_parser(key, expected):
+    assert json_parser(key, DATA) == expected
+
+
+def test_json_parser_missing_key():
+    with pytest.raises(KeyError):
+        json_parser('meta.missing', DATA)
+    with pytest.raises(KeyError):
+        json_parser('schedule.1:2', DATA)
+    assert compile_path('items.*.missing').find(DATA) == []
+
+
+def test_compile_path_cached():
+    assert compile_path('items.*.id') is compile_path('items.*.id')
+    assert not compile_path('schedule.12:30').multiple